@@ -0,0 +1,132 @@
+"""
+Per-user admission control for the model-backed endpoints.
+
+Before a chat, upload, voice or batch request does any work, the caller's key
+(X-User-Id, or the client address for anonymous callers) must have a free
+in-flight slot and a token in its requests-per-minute bucket; otherwise the
+request is turned away at once with a Retry-After for when that will change.
+The key is also published in a context variable so the LLM gateway's fair
+queue can order model calls by caller. Keys come from the client and are not
+authenticated; this is fair sharing, not protection against abuse.
+"""
+
+import contextvars
+import threading
+import time
+from collections import OrderedDict
+
+from llm_gateway import TokenBucket
+
+# Calls made outside a request (title and summary jobs) queue under this key.
+BACKGROUND_KEY = "background"
+
+current_user = contextvars.ContextVar("red_admission_user", default=BACKGROUND_KEY)
+
+
+def current_user_key() -> str:
+    return current_user.get()
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, message: str, retry_after: float, reason: str):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class _UserState:
+    __slots__ = ("bucket", "in_flight")
+
+    def __init__(self, requests_per_minute: int):
+        self.bucket = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.in_flight = {}
+
+
+class AdmissionTicket:
+    """An admitted request; release() (idempotent) frees its in-flight slot."""
+
+    __slots__ = ("controller", "key", "admitted_at", "released")
+
+    def __init__(self, controller, key: str):
+        self.controller = controller
+        self.key = key
+        self.admitted_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release(self)
+
+
+class AdmissionController:
+    """
+    max_in_flight and requests_per_minute apply per key (0 disables either); keys
+    listed in `weights` get both scaled by their weight, so a trusted service can
+    be given more room than a browser session.
+    """
+
+    def __init__(self, max_in_flight: int = 4, requests_per_minute: int = 60, weights: dict = None,
+                 max_keys: int = 10_000):
+        self.max_in_flight = max_in_flight
+        self.requests_per_minute = requests_per_minute
+        self.weights = weights or {}
+        self.max_keys = max_keys
+        self._users = OrderedDict()
+        self._duration_seconds = 5.0
+        self._lock = threading.Lock()
+
+    def _scaled(self, key: str, limit: int) -> int:
+        weight = float(self.weights.get(key, self.weights.get("*", 1.0)))
+        return max(1, round(limit * weight)) if limit > 0 else 0
+
+    def _state(self, key: str) -> _UserState:
+        state = self._users.get(key)
+        if state is None:
+            state = self._users[key] = _UserState(self._scaled(key, self.requests_per_minute))
+            if len(self._users) > self.max_keys:
+                # Forget the least recently seen idle key; its bucket has refilled by now anyway.
+                for old_key, old_state in self._users.items():
+                    if not old_state.in_flight and old_key != key:
+                        del self._users[old_key]
+                        break
+        self._users.move_to_end(key)
+        return state
+
+    def admit(self, key: str) -> AdmissionTicket:
+        """Admit one request for `key` or raise AdmissionRejected with a Retry-After."""
+        with self._lock:
+            now = time.monotonic()
+            state = self._state(key)
+            max_in_flight = self._scaled(key, self.max_in_flight)
+            if max_in_flight and len(state.in_flight) >= max_in_flight:
+                # The oldest request in flight is the likeliest to finish first.
+                oldest = min(ticket.admitted_at for ticket in state.in_flight)
+                retry_after = max(1.0, self._duration_seconds - (now - oldest))
+                raise AdmissionRejected("Too many requests in progress for this user.", retry_after, "in_flight")
+            if state.bucket is not None:
+                wait = state.bucket.wait_time(1, now)
+                if wait > 0:
+                    raise AdmissionRejected("Request rate limit reached for this user.", wait, "rate")
+                state.bucket.take(1)
+            ticket = AdmissionTicket(self, key)
+            state.in_flight[ticket] = None
+            return ticket
+
+    def _release(self, ticket: AdmissionTicket):
+        with self._lock:
+            state = self._users.get(ticket.key)
+            if state is not None:
+                state.in_flight.pop(ticket, None)
+            duration = time.monotonic() - ticket.admitted_at
+            self._duration_seconds = 0.8 * self._duration_seconds + 0.2 * duration
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            busiest = sorted(self._users.items(), key=lambda item: len(item[1].in_flight), reverse=True)[:5]
+            return {
+                "tracked_users": len(self._users),
+                "in_flight": sum(len(state.in_flight) for state in self._users.values()),
+                "busiest": {key: len(state.in_flight) for key, state in busiest if state.in_flight},
+                "typical_request_seconds": round(self._duration_seconds, 2),
+            }
@@ -1,76 +1,330 @@
-from flask import Flask, request, jsonify, render_template, render_template_string
-from groq import Groq
-import os
-import json
-import base64
-from dotenv import load_dotenv
-from datetime import datetime, timezone
-import firebase_admin
-from firebase_admin import credentials, firestore
-
-
-# Load environment variables from .env file
-load_dotenv()
-
-app = Flask(__name__, template_folder="templates", static_folder="static")
-
-
-# =========================
-# GROQ CONFIG (SECURE)
-# =========================
-
-GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-
-# Check if API key exists
-if not GROQ_API_KEY:
-    print("❌ ERROR: GROQ_API_KEY not found in .env file!")
-    print("Please create a .env file with:")
-    print("GROQ_API_KEY=your_groq_api_key_here")
-    raise ValueError("GROQ_API_KEY environment variable is required!")
-
-client = Groq(api_key=GROQ_API_KEY)
-
-# =========================
-# FIREBASE / FIRESTORE CONFIG
-# =========================
-
-FIREBASE_SERVICE_ACCOUNT_PATH = (os.getenv("FIREBASE_SERVICE_ACCOUNT_PATH") or "").strip()
-if not FIREBASE_SERVICE_ACCOUNT_PATH:
-    # Fallback for local setup when the key file is placed at project root.
-    FIREBASE_SERVICE_ACCOUNT_PATH = "Database_key.json"
-if not os.path.exists(FIREBASE_SERVICE_ACCOUNT_PATH):
-    raise ValueError(
-        "Firebase service account JSON not found. "
-        f"Checked: {FIREBASE_SERVICE_ACCOUNT_PATH}. "
-        "Set FIREBASE_SERVICE_ACCOUNT_PATH in .env to a valid JSON key file."
-    )
-
-if not firebase_admin._apps:
-    cred = credentials.Certificate(FIREBASE_SERVICE_ACCOUNT_PATH)
-    firebase_admin.initialize_app(cred)
-
-firestore_db = firestore.client()
-
-# =========================
-# RED PERSONA (SYSTEM PROMPT)
-# =========================
-
-SYSTEM_PROMPT = (
-    "You are an AI assistant called RED. "
-    "Your name comes from the app's bold red visual theme, which represents speed, focus, and power. "
-    "When users ask who you are or why you're called RED, say that you're RED, "
-    "the AI assistant for this app, and your name reflects its red, high-energy interface design. "
-    "Be helpful, concise, and friendly."
-)
-
-TEXT_EXTENSIONS = {
-    ".txt", ".md", ".csv", ".json", ".xml", ".yaml", ".yml",
-    ".py", ".js", ".ts", ".tsx", ".jsx", ".html", ".css", ".java",
-    ".c", ".cpp", ".h", ".hpp", ".go", ".rs", ".rb", ".php", ".sql",
-    ".sh", ".ps1", ".log", ".ini", ".toml", ".cfg"
-}
+import time
+
+# Import time is reported by /health; the clock starts before any other import.
+IMPORT_STARTED_AT = time.perf_counter()
+
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    g,
+    request,
+    jsonify,
+    render_template,
+    render_template_string,
+    stream_with_context,
+)
+from werkzeug.exceptions import RequestEntityTooLarge
+import os
+import json
+import atexit
+import base64
+import codecs
+import hashlib
+import io
+import itertools
+import math
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dotenv import load_dotenv
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow missing: images are sent to the vision model as uploaded.
+    Image = None
+from datetime import datetime, timezone
+from attachment_cache import create_attachment_cache, hash_stream
+from chat_store import AppendConflict, chat_store_backend, create_chat_store
+import admission
+import metrics
+from admission import AdmissionController, AdmissionRejected
+from idempotency import IdempotencyMismatch, IdempotencyStore, request_fingerprint
+from model_router import ModelRouter, parse_model_tiers
+from llm_gateway import (
+    LLMGateway,
+    ModelHealthTracker,
+    RateLimitExceeded,
+    estimate_tokens,
+    parse_key_weights,
+    parse_model_limits,
+    retry_after_seconds,
+)
+
+
+# Load environment variables from .env file
+load_dotenv()
+
+bp = Blueprint("red", __name__, cli_group=None)
+
+
+# =========================
+# LAZY CLIENTS
+# =========================
+
+class LazyResource:
+    """
+    Process-wide object built on first use (or by warmup()). Attribute access is
+    forwarded, so callers use it like the object itself.
+    """
+
+    def __init__(self, name: str, factory):
+        self.name = name
+        self.factory = factory
+        self.init_seconds = None
+        self._value = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self._value is not None
+
+    def get(self):
+        value = self._value
+        if value is None:
+            with self._lock:
+                if self._value is None:
+                    started = time.perf_counter()
+                    self._value = self.factory()
+                    self.init_seconds = time.perf_counter() - started
+                    print(f"[STARTUP] {self.name} ready in {self.init_seconds * 1000:.0f} ms")
+                value = self._value
+        return value
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
+
+
+# =========================
+# GROQ CONFIG (SECURE)
+# =========================
+
+GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+
+
+def create_llm_gateway() -> LLMGateway:
+    from groq import Groq
+
+    # Check if API key exists
+    if not GROQ_API_KEY:
+        print("❌ ERROR: GROQ_API_KEY not found in .env file!")
+        print("Please create a .env file with:")
+        print("GROQ_API_KEY=your_groq_api_key_here")
+        raise ValueError("GROQ_API_KEY environment variable is required!")
+
+    # Retries are owned by the gateway, so the SDK's own retry loop is disabled.
+    client = Groq(api_key=GROQ_API_KEY, max_retries=0)
+    return LLMGateway(
+        client,
+        GROQ_API_KEY,
+        default_rpm=int(os.getenv("GROQ_RPM", "30")),
+        default_tpm=int(os.getenv("GROQ_TPM", "12000")),
+        model_limits=parse_model_limits(os.getenv("GROQ_MODEL_LIMITS")),
+        max_concurrency=int(os.getenv("GROQ_MAX_CONCURRENCY", "8")),
+        max_retries=int(os.getenv("GROQ_MAX_RETRIES", "3")),
+        timeout=float(os.getenv("GROQ_TIMEOUT_SECONDS", "60")),
+        max_queue_wait=float(os.getenv("GROQ_MAX_QUEUE_WAIT_SECONDS", "20")),
+        observer=metrics.record_llm_call,
+        # Model-call slots are shared out fairly between users (see ADMISSION CONTROL).
+        queue_key=admission.current_user_key,
+        key_weights=USER_WEIGHTS,
+        max_queued_per_key=int(os.getenv("GROQ_MAX_QUEUED_PER_USER", "16")),
+    )
+
+
+llm = LazyResource("groq", create_llm_gateway)
+
+# =========================
+# MODEL ROUTING
+# =========================
+
+# Chat turns and titles are routed by complexity: short, plain prompts go to the
+# fast tier, code/reasoning/long-context ones to the strong tier, and a call that
+# fails on its tier escalates to the next. GROQ_MODEL_TIERS="fast=a;strong=b,c"
+# overrides the tiers (cheapest first); MODEL_ROUTING=0 sends everything to the last.
+CHAT_MODEL = "llama-3.3-70b-versatile"
+FAST_CHAT_MODEL = (os.getenv("GROQ_FAST_MODEL") or "llama-3.1-8b-instant").strip()
+model_router = ModelRouter(
+    parse_model_tiers(os.getenv("GROQ_MODEL_TIERS")) or {"fast": [FAST_CHAT_MODEL], "strong": [CHAT_MODEL]},
+    fast_max_prompt_tokens=int(os.getenv("ROUTER_FAST_MAX_PROMPT_TOKENS", "150")),
+    fast_max_history=int(os.getenv("ROUTER_FAST_MAX_HISTORY", "12")),
+    enabled=(os.getenv("MODEL_ROUTING") or "1").strip().lower() in {"1", "true", "yes", "on"},
+    observer=metrics.record_route,
+)
+
+
+def route_chat(prompt: str, messages: list, attachment: bool = False):
+    """Routing decision for a chat turn; `messages` is the assembled context ending with the prompt."""
+    history_messages = sum(1 for msg in messages if msg.get("role") != "system") - 1
+    return model_router.classify(prompt, history_messages, attachment)
+
+
+# =========================
+# ADMISSION CONTROL
+# =========================
+
+# Requests to these routes must be admitted first: each user may have
+# ADMISSION_USER_MAX_IN_FLIGHT of them running and start ADMISSION_USER_RPM per
+# minute (0 disables either). ADMISSION_USER_WEIGHTS="eval-bot=0.5,partner=2,*=1"
+# scales a user's caps and its share of model-call slots.
+# X-User-Id is whatever the client sends, not authentication: the caps keep
+# well-behaved users from crowding each other out, but a client that changes the
+# header per request gets a fresh allowance each time. Anonymous callers are
+# keyed by address; set TRUSTED_PROXY_COUNT to the number of reverse proxies that
+# append to X-Forwarded-For so that is the browser's address, not the proxy's.
+ADMISSION_ROUTES = {"/api/chat", "/api/chat/upload", "/api/chat/batch", "/api/voice/process"}
+USER_WEIGHTS = parse_key_weights(os.getenv("ADMISSION_USER_WEIGHTS"))
+admission_control = AdmissionController(
+    max_in_flight=int(os.getenv("ADMISSION_USER_MAX_IN_FLIGHT", "4")),
+    requests_per_minute=int(os.getenv("ADMISSION_USER_RPM", "30")),
+    weights=USER_WEIGHTS,
+)
+TRUSTED_PROXY_COUNT = int(os.getenv("TRUSTED_PROXY_COUNT", "0"))
+
+
+def client_address(remote_addr: str, forwarded_for: str = None) -> str:
+    """
+    The caller's address: with TRUSTED_PROXY_COUNT proxies in front, the entry
+    that many hops from the right of X-Forwarded-For (Werkzeug's ProxyFix rule);
+    entries further left are client-supplied and ignored.
+    """
+    if TRUSTED_PROXY_COUNT > 0 and forwarded_for:
+        hops = [hop.strip() for hop in forwarded_for.split(",") if hop.strip()]
+        if len(hops) >= TRUSTED_PROXY_COUNT:
+            return hops[-TRUSTED_PROXY_COUNT]
+    return remote_addr or "unknown"
+
+
+def admission_key(user_id: str, remote_addr: str, forwarded_for: str = None) -> str:
+    # Anonymous callers are told apart by address so they don't share one budget.
+    if user_id != "anonymous":
+        return user_id
+    return f"anonymous@{client_address(remote_addr, forwarded_for)}"
+
+
+def admission_rejection(error: AdmissionRejected):
+    """(payload, retry_after seconds) for a 429 when a request is not admitted."""
+    metrics.record_admission_rejection(error.reason)
+    retry_after = max(1, math.ceil(error.retry_after))
+    payload = {"success": False, "error": f"{error} Please retry in {retry_after}s.", "retry_after": retry_after}
+    return payload, retry_after
+
+# =========================
+# CHAT STORAGE CONFIG
+# =========================
+
+# CHAT_STORE_BACKEND=firestore (default) or sqlite (single node, no service account needed).
+# Checked here rather than when the store is first used, so a typo stops startup.
+CHAT_STORE_BACKEND = chat_store_backend(os.getenv("CHAT_STORE_BACKEND"))
+SQLITE_DB_PATH = (os.getenv("SQLITE_DB_PATH") or "").strip() or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "chats.db"
+)
+FIRESTORE_BATCH_LIMIT = 450
+BULK_WRITE_MAX_ATTEMPTS = 5
+# Write-behind: with WRITE_BEHIND_JOURNAL_DIR set, finished turns are fsynced to a
+# journal there and written to the chat store in the background every
+# WRITE_BEHIND_FLUSH_SECONDS. The directory must survive a restart (not tmpfs).
+# Each worker sees its own queued turns at once and other workers' turns once
+# they are flushed; turns that collide on an index are renumbered, not lost.
+WRITE_BEHIND_JOURNAL_DIR = (os.getenv("WRITE_BEHIND_JOURNAL_DIR") or "").strip()
+WRITE_BEHIND_FLUSH_SECONDS = float(os.getenv("WRITE_BEHIND_FLUSH_SECONDS", "0.5"))
+
+
+firebase_init_lock = threading.Lock()
+
+
+def init_firebase_app():
+    import firebase_admin
+    from firebase_admin import credentials
+
+    firebase_service_account_path = (os.getenv("FIREBASE_SERVICE_ACCOUNT_PATH") or "").strip()
+    if not firebase_service_account_path:
+        # Fallback for local setup when the key file is placed at project root.
+        firebase_service_account_path = "Database_key.json"
+    if not os.path.exists(firebase_service_account_path):
+        raise ValueError(
+            "Firebase service account JSON not found. "
+            f"Checked: {firebase_service_account_path}. "
+            "Set FIREBASE_SERVICE_ACCOUNT_PATH in .env to a valid JSON key file."
+        )
+
+    # The sync and async clients may be created from different threads.
+    with firebase_init_lock:
+        if not firebase_admin._apps:
+            cred = credentials.Certificate(firebase_service_account_path)
+            firebase_admin.initialize_app(cred)
+
+
+def init_firestore_client():
+    from firebase_admin import firestore
+
+    init_firebase_app()
+    return firestore.client()
+
+
+def init_firestore_async_client():
+    from firebase_admin import firestore_async
+
+    init_firebase_app()
+    return firestore_async.client()
+
+
+def create_app_chat_store():
+    store = create_chat_store(
+        CHAT_STORE_BACKEND,
+        SQLITE_DB_PATH,
+        init_firestore_client,
+        batch_limit=FIRESTORE_BATCH_LIMIT,
+        bulk_write_max_attempts=BULK_WRITE_MAX_ATTEMPTS,
+    )
+    if not WRITE_BEHIND_JOURNAL_DIR:
+        return store
+    from write_behind import WriteBehindChatStore
+
+    store = WriteBehindChatStore(store, WRITE_BEHIND_JOURNAL_DIR, flush_interval=WRITE_BEHIND_FLUSH_SECONDS)
+    # A clean shutdown writes out the queue; after a crash the journal is replayed instead.
+    atexit.register(store.close)
+    return store
+
+
+chat_store = LazyResource(f"chat store ({CHAT_STORE_BACKEND})", create_app_chat_store)
+
+# =========================
+# RED PERSONA (SYSTEM PROMPT)
+# =========================
+
+SYSTEM_PROMPT = (
+    "You are an AI assistant called RED. "
+    "Your name comes from the app's bold red visual theme, which represents speed, focus, and power. "
+    "When users ask who you are or why you're called RED, say that you're RED, "
+    "the AI assistant for this app, and your name reflects its red, high-energy interface design. "
+    "Be helpful, concise, and friendly."
+)
+
+TEXT_EXTENSIONS = {
+    ".txt", ".md", ".csv", ".json", ".xml", ".yaml", ".yml",
+    ".py", ".js", ".ts", ".tsx", ".jsx", ".html", ".css", ".java",
+    ".c", ".cpp", ".h", ".hpp", ".go", ".rs", ".rb", ".php", ".sql",
+    ".sh", ".ps1", ".log", ".ini", ".toml", ".cfg"
+}
 MAX_UPLOAD_BYTES = 8 * 1024 * 1024
+# Text up to this size goes into a single prompt; larger files are map-reduced in chunks.
 MAX_TEXT_EXTRACT_BYTES = 120_000
+MAX_ANALYSIS_TEXT_BYTES = int(os.getenv("MAX_ANALYSIS_TEXT_BYTES", str(1024 * 1024)))
+MAP_REDUCE_CHUNK_CHARS = int(os.getenv("MAP_REDUCE_CHUNK_CHARS", "24000"))
+MAP_REDUCE_MAX_CHUNKS = int(os.getenv("MAP_REDUCE_MAX_CHUNKS", "16"))
+MAP_REDUCE_WORKERS = int(os.getenv("MAP_REDUCE_WORKERS", "4"))
+# Map calls may wait this long for the map model's token budget; parts are planned to fit inside it.
+MAP_REDUCE_MAX_WAIT_SECONDS = float(os.getenv("MAP_REDUCE_MAX_WAIT_SECONDS", "45"))
+MAP_NOTE_MAX_TOKENS = 500
+MAP_MODEL = (os.getenv("GROQ_MAP_MODEL") or "llama-3.1-8b-instant").strip()
+UPLOAD_CHUNK_BYTES = 64 * 1024
+# Room for the non-file form fields (prompt, incognito history) on top of the file itself.
+MAX_FORM_OVERHEAD_BYTES = 1024 * 1024
+# Uploaded images are downscaled and re-encoded before they are base64-encoded for the model.
+VISION_IMAGE_MAX_EDGE = int(os.getenv("VISION_IMAGE_MAX_EDGE", "1536"))
+VISION_IMAGE_FORMAT = (os.getenv("VISION_IMAGE_FORMAT") or "JPEG").strip().upper()
+VISION_IMAGE_QUALITY = int(os.getenv("VISION_IMAGE_QUALITY", "85"))
 VISION_MODEL = (os.getenv("GROQ_VISION_MODEL") or "").strip()
 VISION_MODELS = []
 _vision_models_env = (os.getenv("GROQ_VISION_MODELS") or "").strip()
@@ -86,563 +340,2344 @@ for fallback_model in [
 ]:
     if fallback_model not in VISION_MODELS:
         VISION_MODELS.append(fallback_model)
-
-def now_utc_iso() -> str:
-    return datetime.now(timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z")
-
-
-def request_user_id() -> str:
-    user_id = (request.headers.get("X-User-Id") or "anonymous").strip()
-    return user_id if user_id else "anonymous"
-
-
-def history_preview(history: list) -> str:
-    if not history:
-        return ""
-    for msg in reversed(history):
-        content = (msg.get("content") or "").strip()
-        if content:
-            return content[:90]
-    return ""
-
-
-def chats_collection(user_id: str):
-    return firestore_db.collection("users").document(user_id).collection("chats")
-
-
-def chat_doc_ref(user_id: str, session_id: str):
-    return chats_collection(user_id).document(session_id)
-
-
-def parse_bool(raw_value) -> bool:
-    return str(raw_value or "").strip().lower() in {"1", "true", "yes", "on"}
-
-
-def load_incognito_history(raw_history):
-    if isinstance(raw_history, list):
-        return raw_history
-    if isinstance(raw_history, str) and raw_history.strip():
-        try:
-            parsed = json.loads(raw_history)
-            return parsed if isinstance(parsed, list) else []
-        except Exception:
-            return []
-    return []
-
-
-def build_messages(prompt: str, user_id: str, session_id: str, is_incognito: bool, incognito_history: list):
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-    existing_chat = {}
-
-    if is_incognito:
-        history = incognito_history or []
-    else:
-        existing_doc = chat_doc_ref(user_id, session_id).get()
-        existing_chat = existing_doc.to_dict() if existing_doc.exists else {}
-        history = existing_chat.get("history", [])
-
-    for msg in history:
-        role = "user" if msg.get("role") == "user" else "assistant"
-        content = msg.get("content", "")
-        if content:
-            messages.append({"role": role, "content": content})
-
-    messages.append({"role": "user", "content": prompt})
-    return messages, existing_chat
-
-
-def persist_chat(user_id: str, session_id: str, prompt: str, assistant_text: str):
-    existing_doc = chat_doc_ref(user_id, session_id).get()
-    existing_chat = existing_doc.to_dict() if existing_doc.exists else {}
-    existing_history = existing_chat.get("history", [])
-    is_first_message = not existing_history
-    timestamp = now_utc_iso()
-    updated_history = existing_history + [
-        {"role": "user", "content": prompt},
-        {"role": "assistant", "content": assistant_text},
-    ]
-
-    if is_first_message:
-        chat_title = generate_chat_title(prompt)
-    else:
-        chat_title = existing_chat.get("title")
-
-    chat_doc_ref(user_id, session_id).set(
-        {
-            "id": session_id,
-            "user_id": user_id,
-            "title": chat_title or "New Chat",
-            "history": updated_history,
-            "preview": history_preview(updated_history),
-            "created_at": existing_chat.get("created_at") or timestamp,
-            "updated_at": timestamp,
-        }
-    )
-    return chat_title
-
-
-def extract_text_from_upload(filename: str, mimetype: str, file_bytes: bytes):
-    ext = os.path.splitext(filename or "")[1].lower()
-    is_probably_text = (mimetype or "").startswith("text/") or ext in TEXT_EXTENSIONS
-    if not is_probably_text:
-        return "", False
-
-    clipped = file_bytes[:MAX_TEXT_EXTRACT_BYTES]
-    truncated = len(file_bytes) > MAX_TEXT_EXTRACT_BYTES
-
-    for enc in ("utf-8", "utf-16", "latin-1"):
-        try:
-            return clipped.decode(enc), truncated
-        except Exception:
-            continue
-    return clipped.decode("utf-8", errors="ignore"), truncated
-
-
-def normalize_response_text(content) -> str:
-    """Handle API responses that may return either plain text or typed chunks."""
-    if isinstance(content, str):
-        return content
-    if isinstance(content, list):
-        parts = []
-        for chunk in content:
-            if isinstance(chunk, dict) and chunk.get("type") == "text":
-                txt = chunk.get("text", "")
-                if txt:
-                    parts.append(txt)
-        return "\n".join(parts).strip()
-    return str(content or "").strip()
-
-def generate_chat_title(first_message: str) -> str:
-    """Generate a short title for the chat based on first user message."""
-    try:
-        messages = [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {
-                "role": "user",
-                "content": (
-                    "Generate a very short title (max 4-5 words) for a chat that starts with: "
-                    f"'{first_message[:120]}'. Only return the title, nothing else."
-                ),
-            },
-        ]
-        response = client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=messages,
-            max_tokens=32,
-            temperature=0.5,
-        )
-        title = response.choices[0].message.content.strip()
-        title = title.replace('"', "").replace("'", "")
-        return title[:50] if title else (first_message[:30] + "..." if len(first_message) > 30 else first_message)
-    except Exception as e:
-        print(f"[TITLE ERROR] {e}")
-        return first_message[:30] + "..." if len(first_message) > 30 else first_message
-
-
-def owner_profile_override(prompt: str):
-    """Return fixed RED owner profile response when prompt asks about founder/creator/owner."""
-    if not prompt:
-        return None
-    normalized = " ".join(prompt.lower().strip().split())
-    keyword_groups = [
-        ("owner", "red"),
-        ("creator", "red"),
-        ("founder", "red"),
-    ]
-    is_owner_question = any(a in normalized and b in normalized for a, b in keyword_groups)
-    if not is_owner_question:
-        return None
-    return (
-        "Abhinav Pratap Singh, a B.Tech CSE Student.\n\n"
-        "GitHub: https://github.com/Abhinav-droid-sys\n"
-        "LinkedIn: https://www.linkedin.com/in/abhinav-pratap-singh-998911369"
-    )
-
-
-# =========================
-# ROUTES
-# =========================
-
-@app.route("/")
-def index():
-    return render_template("index.html")
-
-@app.route("/login")
-def login():
-    return render_template("login.html")
-
-
-@app.route("/privacy")
-def privacy():
-    # A minimal privacy page — you can expand this further (save as template if you prefer)
-    content = """
-    <!doctype html>
-    <html lang="en">
-    <head>
-      <meta charset="utf-8" />
-      <meta name="viewport" content="width=device-width, initial-scale=1" />
-      <title>Privacy — RED</title>
-      <style>
-        body { font-family: Inter, system-ui, Arial; background:#070708; color: #eee; padding:30px; }
-        .card { max-width:800px; margin:30px auto; background:#0f0f10; border-radius:12px; padding:24px; border:1px solid #222; }
-        a { color:#FF6B6B; text-decoration:none; font-weight:700; }
-      </style>
-    </head>
-    <body>
-      <div class="card">
-        <h1>Privacy & Data</h1>
-        <p>This is a brief privacy note for <strong>RED</strong>.</p>
-        <ul>
-          <li>By default messages are stored locally in your browser (localStorage).</li>
-          <li>If you use <em>Incognito</em> mode in the app, messages are kept only temporarily (in memory) and not saved to localStorage.</li>
-          <li>Server-side requests are sent to the Groq API to generate assistant responses. Inputs sent to the server will be processed by the underlying model provider.</li>
-          <li>We recommend avoiding sharing highly-sensitive personal data (SSNs, passwords, payment details) in chats.</li>
-        </ul>
-        <p>If you need a formal privacy policy for compliance, add a more detailed page here with contact & retention details.</p>
-        <p><a href="/">Back to RED</a></p>
-      </div>
-    </body>
-    </html>
-    """
-    return render_template_string(content)
-
-@app.route("/health")
-def health():
-    return jsonify({"status": "ok", "time": datetime.utcnow().isoformat() + "Z"}), 200
-
-
-@app.route("/api/voice/process", methods=["POST"])
-def process_voice_text():
-    """
-    Normalize and translate spoken input text to a clean prompt.
-    Request JSON:
-    {
-      "text": "spoken transcript",
-      "target_lang": "en"
-    }
-    """
-    try:
-        data = request.get_json(force=True)
-        text = (data.get("text") or "").strip()
-        target_lang = (data.get("target_lang") or "en").strip().lower()
-
-        if not text:
-            return jsonify({"success": False, "error": "text is required"}), 400
-
-        instruction = (
-            "You are a voice transcript post-processor. "
-            "Clean obvious ASR mistakes when confidence is high, normalize punctuation, "
-            "and translate to natural {} if input is another language. "
-            "Do not add meaning, explanations, or extra text. "
-            "Return only the final cleaned sentence."
-        ).format("English" if target_lang == "en" else target_lang)
-
-        response = client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[
-                {"role": "system", "content": instruction},
-                {"role": "user", "content": text},
-            ],
-            temperature=0.1,
-            max_tokens=300,
-            top_p=1.0,
-            stream=False,
-        )
-        processed = (response.choices[0].message.content or "").strip()
-        if not processed:
-            processed = text
-        return jsonify({"success": True, "processed_text": processed})
-    except Exception as e:
-        print(f"[VOICE PROCESS ERROR] {e}")
-        return jsonify({"success": False, "processed_text": text if 'text' in locals() else ""}), 200
-
-
-@app.route("/api/chat", methods=["POST"])
-def chat():
-    """
-    Request JSON format from frontend:
-    {
-      "prompt": "user text",
-      "session_id": "chat_xxx",
-      "is_incognito": true/false,
-      "history": [ { "role": "user"|"assistant", "content": "..." }, ... ]
-    }
-
-    Response JSON:
-    {
-      "success": true/false,
-      "response": "assistant text",
-      "chat_title": "optional title or null",
-      "error": "message on failure"
-    }
-    """
-    try:
-        data = request.get_json(force=True)
-        prompt = data.get("prompt", "").strip()
-        session_id = (data.get("session_id", "default") or "default").strip()
-        user_id = request_user_id()
-        is_incognito = bool(data.get("is_incognito", False))
-        incognito_history = data.get("history", []) or []
-
-        if not prompt:
-            return jsonify({"success": False, "error": "No prompt provided"})
-
-        # Fixed profile response for founder/owner/creator queries.
-        assistant_text = owner_profile_override(prompt)
-
-        if not assistant_text:
-            messages, _ = build_messages(prompt, user_id, session_id, is_incognito, incognito_history)
-
-            # Call Groq
-            response = client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
-                messages=messages,
-                temperature=0.7,
-                max_tokens=2048,
-                top_p=1.0,
-                stream=False,
-            )
-            assistant_text = response.choices[0].message.content
-
-        chat_title = None
-        if not is_incognito:
-            chat_title = persist_chat(user_id, session_id, prompt, assistant_text)
-
-        return jsonify({"success": True, "response": assistant_text, "chat_title": chat_title})
-
-    except Exception as e:
-        error_msg = str(e)
-        print(f"[CHAT ERROR] {error_msg}")
-
-        if "rate" in error_msg.lower() or "429" in error_msg:
-            return jsonify({"success": False, "error": "Rate limit reached. Please wait a moment. (Free tier: 30 requests/minute)"}), 429
-        return jsonify({"success": False, "error": "Internal server error"}), 500
-
-
-@app.route("/api/chat/upload", methods=["POST"])
-def chat_upload():
-    """
-    Multipart request format:
-      - prompt: optional user text
-      - session_id: chat session id
-      - is_incognito: true/false
-      - history: optional JSON string list for incognito mode
-      - file: uploaded file/image
-    """
-    try:
-        prompt = (request.form.get("prompt") or "").strip()
-        session_id = (request.form.get("session_id", "default") or "default").strip()
-        user_id = request_user_id()
-        is_incognito = parse_bool(request.form.get("is_incognito"))
-        incognito_history = load_incognito_history(request.form.get("history"))
-        upload = request.files.get("file")
-
-        if not upload:
-            return jsonify({"success": False, "error": "No file provided"}), 400
-
-        filename = (upload.filename or "attachment").strip() or "attachment"
-        mimetype = (upload.mimetype or "application/octet-stream").strip().lower()
-        file_bytes = upload.read() or b""
-
-        if not file_bytes:
-            return jsonify({"success": False, "error": "Uploaded file is empty"}), 400
-        if len(file_bytes) > MAX_UPLOAD_BYTES:
-            return jsonify({"success": False, "error": "File too large. Max size is 8MB."}), 400
-
-        effective_prompt = prompt or "Please analyze this attachment and summarize key insights."
-        assistant_text = owner_profile_override(effective_prompt) if not file_bytes else None
-        file_summary = f"{filename} ({mimetype}, {len(file_bytes)} bytes)"
-
-        if not assistant_text:
-            if mimetype.startswith("image/"):
-                messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-                if is_incognito:
-                    history = incognito_history
-                else:
-                    history_doc = chat_doc_ref(user_id, session_id).get()
-                    history = (history_doc.to_dict() or {}).get("history", []) if history_doc.exists else []
-                for msg in history:
-                    role = "user" if msg.get("role") == "user" else "assistant"
-                    content = msg.get("content", "")
-                    if content:
-                        messages.append({"role": role, "content": content})
-
-                encoded = base64.b64encode(file_bytes).decode("utf-8")
-                user_payload = [
-                    {
-                        "type": "text",
-                        "text": (
-                            f"{effective_prompt}\n\n"
-                            f"Attached image: {filename} ({mimetype}). "
-                            "Describe it, extract useful details, and answer the user query."
-                        ),
-                    },
-                    {"type": "image_url", "image_url": {"url": f"data:{mimetype};base64,{encoded}"}},
-                ]
-                messages.append({"role": "user", "content": user_payload})
-
-                vision_errors = []
-                for vision_model in VISION_MODELS:
-                    try:
-                        response = client.chat.completions.create(
-                            model=vision_model,
-                            messages=messages,
-                            temperature=0.4,
-                            max_tokens=1800,
-                            top_p=1.0,
-                            stream=False,
-                        )
-                        assistant_text = normalize_response_text(response.choices[0].message.content)
-                        if assistant_text:
-                            break
-                    except Exception as vision_error:
-                        vision_errors.append(f"{vision_model}: {vision_error}")
-
-                if not assistant_text:
-                    detail = vision_errors[0] if vision_errors else "No response from vision model"
-                    detail_lower = detail.lower()
-                    if "model" in detail_lower and ("not found" in detail_lower or "decommissioned" in detail_lower):
-                        return jsonify(
-                            {
-                                "success": False,
-                                "error": (
-                                    "Image analysis model is unavailable. "
-                                    "Set GROQ_VISION_MODEL or GROQ_VISION_MODELS in .env to an active vision-capable model."
-                                ),
-                                "detail": detail[:260],
-                            }
-                        ), 500
-                    return jsonify(
-                        {
-                            "success": False,
-                            "error": "Image upload reached the AI provider but failed during analysis.",
-                            "detail": detail[:260],
-                        }
-                    ), 502
-            else:
-                extracted_text, was_truncated = extract_text_from_upload(filename, mimetype, file_bytes)
-                if extracted_text.strip():
-                    text_notice = "\n\n[Note: File text was truncated for analysis.]" if was_truncated else ""
-                    analysis_prompt = (
-                        f"{effective_prompt}\n\n"
-                        f"Attached file: {filename}\n"
-                        f"MIME type: {mimetype}\n\n"
-                        f"File content:\n{extracted_text}{text_notice}"
-                    )
-                else:
-                    analysis_prompt = (
-                        f"{effective_prompt}\n\n"
-                        f"Attached file: {filename}\n"
-                        f"MIME type: {mimetype}\n"
-                        "The file is binary or unsupported for text extraction. "
-                        "Respond based only on metadata and ask the user for a supported text format if needed."
-                    )
-
-                messages, _ = build_messages(analysis_prompt, user_id, session_id, is_incognito, incognito_history)
-                response = client.chat.completions.create(
-                    model="llama-3.3-70b-versatile",
-                    messages=messages,
-                    temperature=0.5,
-                    max_tokens=1800,
-                    top_p=1.0,
-                    stream=False,
-                )
-                assistant_text = normalize_response_text(response.choices[0].message.content)
-
-        chat_title = None
-        if not is_incognito:
-            prompt_to_store = f"{effective_prompt}\n\n[Attachment: {file_summary}]"
-            chat_title = persist_chat(user_id, session_id, prompt_to_store, assistant_text)
-
-        return jsonify(
-            {
-                "success": True,
-                "response": assistant_text,
-                "chat_title": chat_title,
-                "file_summary": file_summary,
-            }
-        )
-    except Exception as e:
-        error_msg = str(e)
-        print(f"[UPLOAD CHAT ERROR] {error_msg}")
-        if "rate" in error_msg.lower() or "429" in error_msg:
-            return jsonify({"success": False, "error": "Rate limit reached. Please wait a moment."}), 429
-        return jsonify({"success": False, "error": "Internal server error", "detail": error_msg[:260]}), 500
-
-
-@app.route("/api/chats", methods=["GET"])
-def get_chats():
-    """Return list of all named chat sessions for sidebar."""
-    try:
-        user_id = request_user_id()
-        docs = chats_collection(user_id).order_by("updated_at", direction=firestore.Query.DESCENDING).stream()
-        chats = []
-        for doc in docs:
-            d = doc.to_dict() or {}
-            chats.append(
-                {
-                    "id": d.get("id") or doc.id,
-                    "title": d.get("title") or "New Chat",
-                    "updated_at": d.get("updated_at"),
-                    "created_at": d.get("created_at"),
-                    "preview": d.get("preview") or history_preview(d.get("history", [])),
-                }
-            )
-        return jsonify({"success": True, "chats": chats})
-    except Exception as e:
-        return jsonify({"success": False, "error": str(e), "chats": []}), 500
-
-
-@app.route("/api/chat/history", methods=["POST"])
-def get_chat_history():
-    """Return full history for a session_id."""
-    try:
-        data = request.get_json(force=True)
-        session_id = (data.get("session_id") or "").strip()
-        if not session_id:
-            return jsonify({"success": False, "error": "session_id is required"}), 400
-        user_id = request_user_id()
-        doc = chat_doc_ref(user_id, session_id).get()
-        history = (doc.to_dict() or {}).get("history", []) if doc.exists else []
-        return jsonify({"success": True, "history": history})
-    except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
-
-
-@app.route("/api/chat/delete", methods=["POST"])
-def delete_chat():
-    """Delete a stored chat session."""
-    try:
-        data = request.get_json(force=True)
-        session_id = (data.get("session_id") or "").strip()
-        if not session_id:
-            return jsonify({"success": False, "error": "session_id is required"}), 400
-        user_id = request_user_id()
-        chat_doc_ref(user_id, session_id).delete()
-
-        return jsonify({"success": True})
-    except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
-
-
-@app.route("/api/chats/clear", methods=["POST"])
-def clear_chats():
-    """Delete all stored chat sessions for current user."""
-    try:
-        user_id = request_user_id()
-        docs = list(chats_collection(user_id).stream())
-        for doc in docs:
-            doc.reference.delete()
-        return jsonify({"success": True, "deleted": len(docs)})
-    except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
-
-
-if __name__ == "__main__":
-    print("=" * 60)
-    print("🚀 RED AI Assistant ")
-    print("🤖 Persona: RED (named after the red, high-energy UI)")
-    print("=" * 60)
-    print(f"✅ Groq API Key Loaded: {GROQ_API_KEY[:9]}...***")
-    print("=" * 60)
-    app.run(debug=True, host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
+
+# Vision models are reordered by observed latency/success; hedging races the next
+# model once the current one is slower than its usual p90.
+VISION_HEDGE = (os.getenv("GROQ_VISION_HEDGE") or "").strip().lower() in {"1", "true", "yes", "on"}
+vision_health = ModelHealthTracker(default_hedge_delay=float(os.getenv("GROQ_VISION_HEDGE_DELAY_SECONDS", "6")))
+hedge_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("GROQ_VISION_HEDGE_WORKERS", "8")), thread_name_prefix="vision-hedge"
+)
+map_reduce_executor = ThreadPoolExecutor(max_workers=MAP_REDUCE_WORKERS, thread_name_prefix="map-reduce")
+# Processed attachments keyed by content hash: ATTACHMENT_CACHE_BACKEND=memory|disk|off.
+attachment_cache = create_attachment_cache(
+    os.getenv("ATTACHMENT_CACHE_BACKEND"),
+    os.getenv("ATTACHMENT_CACHE_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".attachment_cache"),
+    int(os.getenv("ATTACHMENT_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    float(os.getenv("ATTACHMENT_CACHE_TTL_SECONDS", str(24 * 3600))),
+)
+
+# Transcript clean-up is short and near-deterministic, so a small model is plenty.
+VOICE_MODEL = (os.getenv("GROQ_VOICE_MODEL") or "llama-3.1-8b-instant").strip()
+VOICE_CACHE_SIZE = int(os.getenv("VOICE_CACHE_SIZE", "2048"))
+VOICE_CACHE_TTL_SECONDS = float(os.getenv("VOICE_CACHE_TTL_SECONDS", str(24 * 3600)))
+# Clean English transcripts up to this many words skip the model (0 disables the fast path).
+VOICE_FAST_PATH_MAX_WORDS = int(os.getenv("VOICE_FAST_PATH_MAX_WORDS", "30"))
+SUMMARY_MODEL = (os.getenv("GROQ_SUMMARY_MODEL") or "llama-3.1-8b-instant").strip()
+# Title and summary jobs run here, off the request path.
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", "2"))
+BACKGROUND_QUEUE_LIMIT = int(os.getenv("BACKGROUND_QUEUE_LIMIT", "64"))
+background_executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="chat-bg")
+background_slots = threading.BoundedSemaphore(BACKGROUND_QUEUE_LIMIT)
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "512"))
+CHAT_CACHE_TTL_SECONDS = float(os.getenv("CHAT_CACHE_TTL_SECONDS", "60"))
+# Finished chat turns are replayed to retries with the same Idempotency-Key for this long.
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "600"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+# How long a duplicate waits on the original request before giving up with 409.
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "120"))
+# Messages live in users/{uid}/chats/{sid}/messages; only the newest ones are read per turn.
+CONTEXT_MESSAGE_LIMIT = int(os.getenv("CONTEXT_MESSAGE_LIMIT", "40"))
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+CHATS_PAGE_SIZE = int(os.getenv("CHATS_PAGE_SIZE", "30"))
+# Sidebar listing never downloads message bodies.
+CHAT_LIST_FIELDS = ["id", "title", "updated_at", "created_at", "preview"]
+# Estimated tokens of past messages sent with each prompt; older turns are summarized.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+# Messages the summary does not cover yet are sent verbatim on top of the budget,
+# as long as summary and messages together stay under this many tokens.
+CONTEXT_TOKEN_LIMIT = int(os.getenv("CONTEXT_TOKEN_LIMIT", str(2 * CONTEXT_TOKEN_BUDGET)))
+SUMMARY_MIN_NEW_MESSAGES = int(os.getenv("SUMMARY_MIN_NEW_MESSAGES", "6"))
+SUMMARY_MAX_MESSAGES_PER_PASS = 60
+DELETE_PAGE_SIZE = int(os.getenv("DELETE_PAGE_SIZE", "500"))
+# /api/chat/batch: items per request, items in flight per request, and the shared pool.
+BATCH_MAX_ITEMS = int(os.getenv("CHAT_BATCH_MAX_ITEMS", "100"))
+BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "8"))
+batch_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("CHAT_BATCH_WORKERS", "32")), thread_name_prefix="chat-batch"
+)
+
+
+def now_utc_iso() -> str:
+    return datetime.now(timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z")
+
+
+def request_user_id() -> str:
+    user_id = (request.headers.get("X-User-Id") or "anonymous").strip()
+    return user_id if user_id else "anonymous"
+
+
+def history_preview(history: list) -> str:
+    if not history:
+        return ""
+    for msg in reversed(history):
+        content = (msg.get("content") or "").strip()
+        if content:
+            return content[:90]
+    return ""
+
+
+class ChatCache:
+    """
+    Process-local LRU/TTL cache keyed by (user_id, session_id).
+    Cached dicts are shared between callers and must be treated as read-only.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, chat = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return chat
+
+    def put(self, key, chat: dict):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), chat)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def patch(self, key, fields: dict):
+        """Apply a partial update to a cached chat without refreshing its age."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, chat = entry
+                self._entries[key] = (stored_at, {**chat, **fields})
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_user(self, user_id: str):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == user_id]:
+                del self._entries[key]
+
+
+chat_cache = ChatCache(CHAT_CACHE_SIZE, CHAT_CACHE_TTL_SECONDS)
+# Newest messages of each chat: {"start": first index, "end": message_count, "messages": [...]}.
+message_tail_cache = ChatCache(CHAT_CACHE_SIZE, CHAT_CACHE_TTL_SECONDS)
+
+
+def load_chat(user_id: str, session_id: str) -> dict:
+    """
+    Return the chat metadata (or {}), reading the chat store only on a cache miss.
+    The cached copy can trail writes made by other workers, so model context uses
+    read_chat() instead; a stale copy elsewhere costs at most CHAT_CACHE_TTL_SECONDS.
+    """
+    cached = chat_cache.get((user_id, session_id))
+    if cached is not None:
+        return cached
+    return read_chat(user_id, session_id)
+
+
+def read_chat(user_id: str, session_id: str) -> dict:
+    """
+    Return the chat metadata as stored right now and refresh the cached copy. The
+    message tail cache is keyed by message count, so it stops matching by itself
+    once another worker has appended.
+    """
+    with metrics.stage("storage_read"):
+        chat = chat_store.get_chat(user_id, session_id)
+    chat_cache.put((user_id, session_id), chat)
+    return chat
+
+
+def forget_chat(user_id: str, session_id: str):
+    chat_cache.discard((user_id, session_id))
+    message_tail_cache.discard((user_id, session_id))
+
+
+def is_legacy_chat(chat: dict) -> bool:
+    """Chats written before the messages subcollection keep everything in `history`."""
+    return "history" in chat
+
+
+def chat_message_count(chat: dict) -> int:
+    if is_legacy_chat(chat):
+        return len(chat.get("history") or [])
+    return int(chat.get("message_count") or 0)
+
+
+def fetch_messages(user_id: str, session_id: str, chat: dict, limit: int, before: int = None) -> list:
+    """
+    Return up to `limit` messages, oldest first, ending just before index `before`
+    (the newest message when omitted). Served from the tail cache when it covers
+    the requested range.
+    """
+    count, start, end = message_range(chat, limit, before)
+    if start >= end:
+        return []
+    if is_legacy_chat(chat):
+        return chat["history"][start:end]
+
+    key = (user_id, session_id)
+    cached = cached_messages(key, count, start, end)
+    if cached is not None:
+        return cached
+    with metrics.stage("storage_read"):
+        page = chat_store.fetch_messages(user_id, session_id, start, end)
+    remember_messages(key, count, start, end, page)
+    return page
+
+
+def message_range(chat: dict, limit: int, before: int = None):
+    """Return (message_count, start, end) for up to `limit` messages ending before `before`."""
+    count = chat_message_count(chat)
+    end = count if before is None else max(0, min(int(before), count))
+    return count, max(0, end - max(0, limit)), end
+
+
+def cached_messages(key, count: int, start: int, end: int):
+    tail = message_tail_cache.get(key)
+    if tail and tail["end"] == count and tail["start"] <= start:
+        offset = tail["start"]
+        return tail["messages"][start - offset:end - offset]
+    return None
+
+
+def remember_messages(key, count: int, start: int, end: int, page: list):
+    if end == count:
+        message_tail_cache.put(key, {"start": start, "end": count, "messages": page})
+
+
+def migrate_legacy_chat(user_id: str, session_id: str, chat: dict) -> dict:
+    """
+    Move a legacy `history` array into the messages subcollection and drop it from
+    the chat document. Returns the migrated metadata; no-op for migrated chats.
+    """
+    if not is_legacy_chat(chat):
+        return chat
+    with metrics.stage("storage_write"):
+        migrated = chat_store.migrate_legacy_chat(user_id, session_id, chat)
+    chat_cache.put((user_id, session_id), migrated)
+    message_tail_cache.discard((user_id, session_id))
+    return migrated
+
+
+def parse_index(raw_value, default=None):
+    """A non-negative integer request parameter; `default` when absent. Raises ValueError when malformed."""
+    if raw_value is None or raw_value == "":
+        return default
+    if isinstance(raw_value, bool) or (isinstance(raw_value, float) and not raw_value.is_integer()):
+        raise ValueError(f"not an integer: {raw_value!r}")
+    value = int(raw_value)
+    if value < 0:
+        raise ValueError(f"negative: {value}")
+    return value
+
+
+def parse_bool(raw_value) -> bool:
+    return str(raw_value or "").strip().lower() in {"1", "true", "yes", "on"}
+
+
+def load_incognito_history(raw_history):
+    if isinstance(raw_history, list):
+        return raw_history
+    if isinstance(raw_history, str) and raw_history.strip():
+        try:
+            parsed = json.loads(raw_history)
+            return parsed if isinstance(parsed, list) else []
+        except Exception:
+            return []
+    return []
+
+
+def fit_history_to_budget(history: list, budget: int) -> int:
+    """Return how many of the newest messages fit into `budget` estimated tokens."""
+    used = 0
+    kept = 0
+    for msg in reversed(history):
+        cost = estimate_tokens(msg.get("content", ""))
+        if used + cost > budget:
+            break
+        used += cost
+        kept += 1
+    return kept
+
+
+def build_context(user_id: str, session_id: str, is_incognito: bool, incognito_history: list):
+    """
+    Return the system prompt, the stored summary of older turns and as many recent
+    messages as fit in CONTEXT_TOKEN_BUDGET, plus the chat metadata. Messages that
+    fall out of the window are folded into the summary by a background job; until
+    it has caught up they stay in the window (see assemble_context()).
+    """
+    if is_incognito:
+        return assemble_context(incognito_history or [])
+    existing_chat = read_chat(user_id, session_id)
+    history = fetch_messages(user_id, session_id, existing_chat, CONTEXT_MESSAGE_LIMIT)
+    return assemble_context(history, existing_chat, (user_id, session_id))
+
+
+def assemble_context(history: list, existing_chat: dict = None, chat_key=None):
+    """
+    Turn loaded history into model messages (shared by the sync and async paths).
+    `chat_key` is (user_id, session_id) for stored chats, None for incognito ones.
+
+    The prompt is either the summary plus every message after summary_upto, or,
+    when that is more than was loaded or CONTEXT_TOKEN_LIMIT allows, just the
+    newest messages that fit CONTEXT_TOKEN_BUDGET. Never a summary followed by a
+    gap.
+    """
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    existing_chat = existing_chat or {}
+    kept = fit_history_to_budget(history, CONTEXT_TOKEN_BUDGET)
+
+    if chat_key is None:
+        history = history[len(history) - kept:]
+    else:
+        message_count = chat_message_count(existing_chat)
+        loaded_from = message_count - len(history)
+        window_start = message_count - kept
+        summary_upto = int(existing_chat.get("summary_upto") or 0)
+        summary = (existing_chat.get("summary") or "").strip() if summary_upto > 0 else ""
+        unsummarized = history[max(0, summary_upto - loaded_from):]
+        bridge_tokens = estimate_tokens(summary) + sum(estimate_tokens(msg.get("content", "")) for msg in unsummarized)
+        if summary_upto >= loaded_from and bridge_tokens <= CONTEXT_TOKEN_LIMIT:
+            history = unsummarized
+        else:
+            # The summary is too far behind to bridge; a plain recent window beats a hole.
+            summary = ""
+            history = history[len(history) - kept:]
+        if summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+        if window_start - summary_upto >= SUMMARY_MIN_NEW_MESSAGES:
+            schedule_chat_summary(chat_key[0], chat_key[1], window_start)
+
+    for msg in history:
+        role = "user" if msg.get("role") == "user" else "assistant"
+        content = msg.get("content", "")
+        if content:
+            messages.append({"role": role, "content": content})
+
+    return messages, existing_chat
+
+
+def build_messages(prompt: str, user_id: str, session_id: str, is_incognito: bool, incognito_history: list):
+    messages, existing_chat = build_context(user_id, session_id, is_incognito, incognito_history)
+    messages.append({"role": "user", "content": prompt})
+    return messages, existing_chat
+
+
+def persist_chat(user_id: str, session_id: str, prompt: str, assistant_text: str, existing_chat: dict = None):
+    """
+    Store the turn and return (chat_title, title_pending). On the first message the
+    chat is saved with a provisional title and the real one is generated in the
+    background; title_pending tells the client to refresh /api/chats later.
+
+    `existing_chat` is the metadata the prompt was built from, so a turn reads the
+    chat once. If another worker appended since, the store rejects the indexes and
+    the turn is retried against a fresh read.
+    """
+    if existing_chat is None:
+        existing_chat = load_chat(user_id, session_id)
+    existing_chat = migrate_legacy_chat(user_id, session_id, existing_chat)
+    turn = prepare_turn(user_id, session_id, existing_chat, prompt, assistant_text)
+    # Append-only: the new messages plus a small metadata merge, committed atomically.
+    try:
+        with metrics.stage("storage_write"):
+            chat_store.append_messages(user_id, session_id, turn["messages"], turn["chat_fields"])
+    except AppendConflict as e:
+        # Another worker stored a turn since the read: follow it and try once more.
+        print(f"[CHAT STORE] {session_id}: index {turn['messages'][0]['index']} taken, retrying ({e})")
+        forget_chat(user_id, session_id)
+        existing_chat = read_chat(user_id, session_id)
+        turn = prepare_turn(user_id, session_id, existing_chat, prompt, assistant_text)
+        with metrics.stage("storage_write"):
+            chat_store.append_messages(user_id, session_id, turn["messages"], turn["chat_fields"])
+    return finish_stored_turn(user_id, session_id, existing_chat, turn, prompt)
+
+
+def prepare_turn(user_id: str, session_id: str, existing_chat: dict, prompt: str, assistant_text: str) -> dict:
+    """Build the new message rows and chat metadata for one user/assistant turn."""
+    message_count = chat_message_count(existing_chat)
+    is_first_message = message_count == 0
+    timestamp = now_utc_iso()
+    new_messages = [
+        {"index": message_count, "role": "user", "content": prompt, "created_at": timestamp},
+        {"index": message_count + 1, "role": "assistant", "content": assistant_text, "created_at": timestamp},
+    ]
+
+    title_pending = False
+    if is_first_message:
+        chat_title = fallback_chat_title(prompt)
+        title_pending = True
+    else:
+        chat_title = existing_chat.get("title")
+        title_pending = bool(existing_chat.get("title_pending"))
+
+    chat_fields = {
+        "id": session_id,
+        "user_id": user_id,
+        "message_count": message_count + len(new_messages),
+        "preview": history_preview(new_messages) or existing_chat.get("preview", ""),
+        "created_at": existing_chat.get("created_at") or timestamp,
+        "updated_at": timestamp,
+    }
+    if not title_pending or is_first_message:
+        chat_fields["title"] = chat_title or "New Chat"
+        chat_fields["title_pending"] = title_pending
+    return {
+        "messages": new_messages,
+        "chat_fields": chat_fields,
+        "chat_title": chat_title,
+        "title_pending": title_pending,
+        "is_first_message": is_first_message,
+    }
+
+
+def rebase_turn(existing_chat: dict, turn: dict) -> dict:
+    """
+    Renumber a prepared turn (or several merged ones) to follow `existing_chat`
+    as it is now, after another writer took the indexes it was built for.
+    """
+    count = chat_message_count(existing_chat)
+    offset = count - turn["messages"][0]["index"]
+    chat_fields = {
+        **turn["chat_fields"],
+        "message_count": count + len(turn["messages"]),
+        "created_at": existing_chat.get("created_at") or turn["chat_fields"]["created_at"],
+    }
+    rebased = {
+        **turn,
+        "messages": [{**msg, "index": msg["index"] + offset} for msg in turn["messages"]],
+        "chat_fields": chat_fields,
+    }
+    if count and turn["is_first_message"]:
+        # The other writer created the chat, so its title stands.
+        chat_fields.pop("title", None)
+        chat_fields.pop("title_pending", None)
+        rebased.update(
+            chat_title=existing_chat.get("title"),
+            title_pending=bool(existing_chat.get("title_pending")),
+            is_first_message=False,
+        )
+    return rebased
+
+
+def finish_stored_turn(user_id: str, session_id: str, existing_chat: dict, turn: dict, prompt: str):
+    """Refresh the caches after a stored turn and queue the title job; returns (chat_title, title_pending)."""
+    key = (user_id, session_id)
+    chat_fields = turn["chat_fields"]
+    new_messages = turn["messages"]
+    message_count = chat_message_count(existing_chat)
+    # Re-read the cache entry so fields patched by background jobs meanwhile are kept.
+    chat_cache.put(key, {**(chat_cache.get(key) or existing_chat), **chat_fields})
+    tail = message_tail_cache.get(key)
+    if tail and tail["end"] == message_count:
+        new_count = chat_fields["message_count"]
+        kept = (tail["messages"] + new_messages)[-max(CONTEXT_MESSAGE_LIMIT, HISTORY_PAGE_SIZE):]
+        message_tail_cache.put(key, {"start": new_count - len(kept), "end": new_count, "messages": kept})
+    elif turn["is_first_message"]:
+        message_tail_cache.put(key, {"start": 0, "end": len(new_messages), "messages": new_messages})
+
+    title_pending = turn["title_pending"]
+    if turn["is_first_message"]:
+        title_pending = schedule_chat_title(user_id, session_id, prompt)
+    return turn["chat_title"], title_pending
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def read_upload_limited(stream, limit: int) -> bytearray:
+    """Read an upload in chunks, giving up as soon as it grows past `limit` bytes."""
+    buffer = bytearray()
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            return buffer
+        buffer += chunk
+        if len(buffer) > limit:
+            raise UploadTooLarge()
+
+
+def detect_text_encoding(sample: bytes) -> str:
+    """Pick a codec once from the first bytes instead of trial-decoding the whole file."""
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    if sample.count(b"\x00") > len(sample) // 4:
+        # BOM-less UTF-16: ASCII text has a NUL in every other byte.
+        return "utf-16-le" if sample[1::2].count(0) >= sample[0::2].count(0) else "utf-16-be"
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "latin-1"
+
+
+def extract_text_from_upload(filename: str, mimetype: str, stream):
+    """
+    Consume an upload stream chunk by chunk. Returns (text, truncated, total_bytes);
+    only the first MAX_ANALYSIS_TEXT_BYTES of text-like files are decoded and the
+    rest is merely counted. Raises UploadTooLarge past MAX_UPLOAD_BYTES.
+    """
+    ext = os.path.splitext(filename or "")[1].lower()
+    is_probably_text = (mimetype or "").startswith("text/") or ext in TEXT_EXTENSIONS
+    decoder = None
+    parts = []
+    decoded_bytes = 0
+    total_bytes = 0
+
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        total_bytes += len(chunk)
+        if total_bytes > MAX_UPLOAD_BYTES:
+            raise UploadTooLarge()
+        if not is_probably_text or decoded_bytes >= MAX_ANALYSIS_TEXT_BYTES:
+            continue
+        piece = chunk[:MAX_ANALYSIS_TEXT_BYTES - decoded_bytes]
+        decoded_bytes += len(piece)
+        if decoder is None:
+            decoder = codecs.getincrementaldecoder(detect_text_encoding(piece))(errors="replace")
+        parts.append(decoder.decode(piece))
+
+    truncated = total_bytes > decoded_bytes and is_probably_text
+    if decoder is not None and not truncated:
+        parts.append(decoder.decode(b"", final=True))
+    return "".join(parts), truncated, total_bytes
+
+
+def structural_units(filename: str, text: str):
+    """
+    Split text into units that should not be cut apart: fenced code blocks and
+    paragraphs for Markdown, blank-line separated blocks for code and prose, and
+    single lines for CSV and logs. Returns (header, units); the CSV header row is
+    returned separately so every chunk can repeat it.
+    """
+    ext = os.path.splitext(filename or "")[1].lower()
+    lines = text.splitlines(keepends=True)
+    if ext in {".csv", ".log"}:
+        header = lines[0] if ext == ".csv" and lines else ""
+        return header, lines[1:] if header else lines
+
+    units = []
+    current = []
+    in_fence = False
+    for line in lines:
+        if line.lstrip().startswith("```"):
+            in_fence = not in_fence
+        current.append(line)
+        if not in_fence and not line.strip():
+            units.append("".join(current))
+            current = []
+    if current:
+        units.append("".join(current))
+    return "", units
+
+
+def split_text_into_chunks(filename: str, text: str, chunk_chars: int) -> list:
+    """Greedily pack structural units into chunks of at most `chunk_chars` characters."""
+    header, units = structural_units(filename, text)
+    budget = max(1000, chunk_chars - len(header))
+    chunks = []
+    current = ""
+    for unit in units:
+        # Units larger than a chunk fall back to lines, then to hard cuts.
+        pieces = [unit] if len(unit) <= budget else unit.splitlines(keepends=True)
+        for piece in pieces:
+            while len(piece) > budget:
+                chunks.append(piece[:budget])
+                piece = piece[budget:]
+            if len(current) + len(piece) > budget and current:
+                chunks.append(current)
+                current = ""
+            current += piece
+    if current:
+        chunks.append(current)
+    return [header + chunk for chunk in chunks]
+
+
+def analyse_text_chunk(question: str, filename: str, index: int, total: int, chunk: str) -> str:
+    response = llm.complete(
+        model=MAP_MODEL,
+        messages=[
+            {
+                "role": "system",
+                "content": (
+                    "You analyse one part of a larger file for a later summarizer. "
+                    "Extract the facts, figures, errors, anomalies and code structure relevant to the user's request. "
+                    "Be terse; use bullet points; do not speculate about other parts."
+                ),
+            },
+            {
+                "role": "user",
+                "content": f"User request: {question}\n\nFile: {filename} (part {index} of {total})\n\n{chunk}",
+            },
+        ],
+        temperature=0.2,
+        max_tokens=MAP_NOTE_MAX_TOKENS,
+        # Parts are planned to fit MAP_MODEL's budget, so waiting for it beats failing the part.
+        queue_wait=MAP_REDUCE_MAX_WAIT_SECONDS,
+    )
+    return normalize_response_text(response.choices[0].message.content)
+
+
+def map_plan():
+    """
+    (chunk_chars, max_parts, workers) for the map step, from MAP_MODEL's limits:
+    two parts fit in a full token bucket, a file gets no more parts than the
+    bucket plus MAP_REDUCE_MAX_WAIT_SECONDS of refill can pay for, and no more
+    run at once than the bucket admits together.
+    """
+    rpm, tpm = llm.get().limits(MAP_MODEL)
+    overhead = MAP_NOTE_MAX_TOKENS + 200
+    chunk_tokens = max(500, min(MAP_REDUCE_CHUNK_CHARS // 4, tpm // 2 - overhead))
+    part_tokens = chunk_tokens + overhead
+    window = 1 + MAP_REDUCE_MAX_WAIT_SECONDS / 60
+    max_parts = max(1, min(MAP_REDUCE_MAX_CHUNKS, int(tpm * window // part_tokens), int(rpm * window)))
+    workers = max(1, min(MAP_REDUCE_WORKERS, tpm // part_tokens))
+    return chunk_tokens * 4, max_parts, workers
+
+
+def map_text_chunks(question: str, filename: str, text: str, plan: tuple, cache_key: str = None):
+    """
+    Map step for large text attachments: split `text` at structural boundaries and
+    analyse up to max_parts chunks that have no note yet, `workers` at a time.
+    Returns (chunks, notes) with one note per chunk in file order, None where the
+    chunk was not analysed (over the budget, or its call failed). Notes are cached
+    under `cache_key`, so each retry maps the next chunks that are still missing
+    and repeated requests cover the whole file.
+    """
+    chunk_chars, max_parts, workers = plan
+    chunks = split_text_into_chunks(filename, text, chunk_chars)
+    notes = [None] * len(chunks)
+    if cache_key:
+        cached = attachment_cache.get_json(cache_key)
+        if cached and len(cached.get("notes") or []) == len(chunks):
+            notes = cached["notes"]
+            print(f"[MAP CACHE] {filename}: reusing {sum(note is not None for note in notes)} part notes")
+
+    todo = [index for index, note in enumerate(notes) if note is None][:max_parts]
+    running = {}
+    while todo or running:
+        while todo and len(running) < workers:
+            index = todo.pop(0)
+            future = map_reduce_executor.submit(
+                metrics.bind_context(analyse_text_chunk), question, filename, index + 1, len(chunks), chunks[index]
+            )
+            running[future] = index
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            index = running.pop(future)
+            try:
+                notes[index] = future.result() or "(no relevant content)"
+            except Exception as e:
+                print(f"[MAP ERROR] {filename} part {index + 1}: {e}")
+
+    if cache_key and any(note is not None for note in notes):
+        attachment_cache.put_json(cache_key, {"notes": notes})
+    return chunks, notes
+
+
+def prepare_image_for_vision(filename: str, mimetype: str, file_bytes: bytes):
+    """
+    Downscale an image to VISION_IMAGE_MAX_EDGE, re-encode it as VISION_IMAGE_FORMAT
+    and drop EXIF/metadata. Returns (bytes, mimetype); the original is returned
+    when Pillow is unavailable, the image cannot be decoded, or re-encoding would
+    not make it smaller.
+    """
+    if Image is None:
+        return file_bytes, mimetype
+    try:
+        with Image.open(io.BytesIO(file_bytes)) as source:
+            image = ImageOps.exif_transpose(source)
+            image.thumbnail((VISION_IMAGE_MAX_EDGE, VISION_IMAGE_MAX_EDGE), Image.LANCZOS)
+            if VISION_IMAGE_FORMAT == "JPEG" and image.mode != "RGB":
+                # JPEG has no alpha channel; flatten transparency onto white.
+                rgba = image.convert("RGBA")
+                flattened = Image.new("RGB", rgba.size, (255, 255, 255))
+                flattened.paste(rgba, mask=rgba.getchannel("A"))
+                image = flattened
+            output = io.BytesIO()
+            image.save(output, format=VISION_IMAGE_FORMAT, quality=VISION_IMAGE_QUALITY, optimize=True)
+    except Exception as e:
+        print(f"[IMAGE PREP ERROR] {filename}: {e}")
+        return file_bytes, mimetype
+
+    prepared = output.getvalue()
+    if len(prepared) >= len(file_bytes):
+        print(f"[IMAGE PREP] {filename}: kept original ({len(file_bytes)} bytes)")
+        return file_bytes, mimetype
+    print(
+        f"[IMAGE PREP] {filename}: {len(file_bytes)} -> {len(prepared)} bytes "
+        f"({len(file_bytes) - len(prepared)} saved, {image.width}x{image.height})"
+    )
+    return prepared, f"image/{VISION_IMAGE_FORMAT.lower()}"
+
+
+def load_attachment(upload) -> dict:
+    """
+    Hash the upload, then extract its text or prepare the image for the vision model
+    (both cached by content hash). Returns None when the file exceeds MAX_UPLOAD_BYTES.
+    """
+    filename = (upload.filename or "attachment").strip() or "attachment"
+    mimetype = (upload.mimetype or "application/octet-stream").strip().lower()
+    attachment = {
+        "filename": filename,
+        "mimetype": mimetype,
+        "ext": os.path.splitext(filename)[1].lower(),
+        "is_image": mimetype.startswith("image/"),
+    }
+
+    # Hash first (cheap, bounded) so repeated uploads skip decoding and recompression.
+    content_hash, file_size = hash_stream(upload.stream, UPLOAD_CHUNK_BYTES, MAX_UPLOAD_BYTES)
+    if content_hash is None:
+        return None
+    attachment["content_hash"] = content_hash
+    attachment["file_size"] = file_size
+    if not file_size:
+        return attachment
+
+    if attachment["is_image"]:
+        image_key = f"image:{content_hash}:{VISION_IMAGE_MAX_EDGE}:{VISION_IMAGE_FORMAT}:{VISION_IMAGE_QUALITY}"
+        cached_image = attachment_cache.get_image(image_key)
+        if cached_image:
+            image_bytes, image_mimetype = cached_image
+        else:
+            file_bytes = read_upload_limited(upload.stream, MAX_UPLOAD_BYTES)
+            image_bytes, image_mimetype = prepare_image_for_vision(filename, mimetype, file_bytes)
+            del file_bytes
+            attachment_cache.put_image(image_key, image_bytes, image_mimetype)
+        attachment["image_bytes"] = image_bytes
+        attachment["image_mimetype"] = image_mimetype
+    else:
+        text_key = f"text:{content_hash}:{mimetype}:{attachment['ext']}:{MAX_ANALYSIS_TEXT_BYTES}"
+        cached_text = attachment_cache.get_json(text_key)
+        if cached_text:
+            extracted_text, was_truncated = cached_text["text"], cached_text["truncated"]
+        else:
+            extracted_text, was_truncated, _ = extract_text_from_upload(filename, mimetype, upload.stream)
+            attachment_cache.put_json(text_key, {"text": extracted_text, "truncated": was_truncated})
+        attachment["text"] = extracted_text
+        attachment["truncated"] = was_truncated
+    return attachment
+
+
+def vision_user_message(effective_prompt: str, attachment: dict) -> dict:
+    # pop() so the raw image bytes can be freed once they are base64-encoded.
+    encoded = base64.b64encode(attachment.pop("image_bytes")).decode("utf-8")
+    return {
+        "role": "user",
+        "content": [
+            {
+                "type": "text",
+                "text": (
+                    f"{effective_prompt}\n\n"
+                    f"Attached image: {attachment['filename']} ({attachment['mimetype']}). "
+                    "Describe it, extract useful details, and answer the user query."
+                ),
+            },
+            {"type": "image_url", "image_url": {"url": f"data:{attachment['image_mimetype']};base64,{encoded}"}},
+        ],
+    }
+
+
+def vision_failure(vision_errors: list):
+    """(payload, status) for an image upload none of the vision models could answer."""
+    detail = vision_errors[0] if vision_errors else "No response from vision model"
+    detail_lower = detail.lower()
+    if "model" in detail_lower and ("not found" in detail_lower or "decommissioned" in detail_lower):
+        return {
+            "success": False,
+            "error": (
+                "Image analysis model is unavailable. "
+                "Set GROQ_VISION_MODEL or GROQ_VISION_MODELS in .env to an active vision-capable model."
+            ),
+            "detail": detail[:260],
+        }, 500
+    return {
+        "success": False,
+        "error": "Image upload reached the AI provider but failed during analysis.",
+        "detail": detail[:260],
+    }, 502
+
+
+def text_analysis_prompt(effective_prompt: str, attachment: dict) -> str:
+    """Prompt for a text attachment; files too large for one prompt are map-reduced first (blocking)."""
+    filename = attachment["filename"]
+    mimetype = attachment["mimetype"]
+    extracted_text = attachment["text"]
+    was_truncated = attachment["truncated"]
+    if len(extracted_text) > MAX_TEXT_EXTRACT_BYTES:
+        # Too large for one prompt: analyse chunks in parallel, then reduce below.
+        question_hash = hashlib.sha256(effective_prompt.encode("utf-8")).hexdigest()[:16]
+        plan = map_plan()
+        notes_key = (
+            f"notes:{attachment['content_hash']}:{question_hash}:{attachment['ext']}:{plan[0]}:{MAP_MODEL}"
+        )
+        chunks, notes = map_text_chunks(effective_prompt, filename, extracted_text, plan, notes_key)
+        total = len(chunks)
+        missing = [index for index, note in enumerate(notes) if note is None]
+        # Parts without notes go in as raw excerpts, sharing what the single-prompt path would have sent.
+        excerpt_budget = max(0, MAX_TEXT_EXTRACT_BYTES - sum(len(note or "") for note in notes)) // max(1, len(missing))
+        sections = []
+        for index, (chunk, note) in enumerate(zip(chunks, notes), start=1):
+            if note is not None:
+                sections.append(f"### Part {index} of {total}\n{note}")
+            elif excerpt_budget:
+                excerpt = chunk[:excerpt_budget]
+                cut = " (truncated)" if len(excerpt) < len(chunk) else ""
+                sections.append(f"### Part {index} of {total}: not analysed, raw excerpt{cut}\n{excerpt}")
+        notices = []
+        if missing:
+            notices.append(
+                f"{total - len(missing)} of {total} parts of the file were analysed; "
+                "the rest are represented by raw excerpts or left out because the file is very large. "
+                "Asking about the same file again analyses the next parts."
+            )
+        if was_truncated:
+            notices.append("Only the beginning of the file was read because it is very large.")
+        coverage_notice = "".join(f"\n\n[Note: {notice}]" for notice in notices)
+        return (
+            f"{effective_prompt}\n\n"
+            f"Attached file: {filename}\n"
+            f"MIME type: {mimetype}\n\n"
+            f"The file was split into {total} parts that were analysed separately. "
+            "Combine the notes below into a single answer to the request, resolving overlaps.\n\n"
+            + "\n\n".join(sections)
+            + coverage_notice
+        )
+    if extracted_text.strip():
+        text_notice = "\n\n[Note: File text was truncated for analysis.]" if was_truncated else ""
+        return (
+            f"{effective_prompt}\n\n"
+            f"Attached file: {filename}\n"
+            f"MIME type: {mimetype}\n\n"
+            f"File content:\n{extracted_text}{text_notice}"
+        )
+    return (
+        f"{effective_prompt}\n\n"
+        f"Attached file: {filename}\n"
+        f"MIME type: {mimetype}\n"
+        "The file is binary or unsupported for text extraction. "
+        "Respond based only on metadata and ask the user for a supported text format if needed."
+    )
+
+
+def voice_messages(text: str, target_lang: str) -> list:
+    instruction = (
+        "You are a voice transcript post-processor. "
+        "Clean obvious ASR mistakes when confidence is high, normalize punctuation, "
+        "and translate to natural {} if input is another language. "
+        "Do not add meaning, explanations, or extra text. "
+        "Return only the final cleaned sentence."
+    ).format("English" if target_lang == "en" else target_lang)
+    return [
+        {"role": "system", "content": instruction},
+        {"role": "user", "content": text},
+    ]
+
+
+# =========================
+# VOICE FAST PATH
+# =========================
+
+voice_cache = ChatCache(VOICE_CACHE_SIZE, VOICE_CACHE_TTL_SECONDS)
+VOICE_ALLOWED_CHARS = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 .,?!'-:;%$")
+ENGLISH_FUNCTION_WORDS = {
+    "a", "an", "the", "and", "or", "but", "if", "of", "to", "in", "on", "at", "for", "with", "from", "by",
+    "about", "as", "into", "is", "are", "was", "were", "be", "been", "am", "do", "does", "did", "have",
+    "has", "had", "can", "could", "will", "would", "should", "may", "might", "must", "not", "no", "yes",
+    "i", "me", "my", "you", "your", "he", "she", "it", "its", "we", "our", "they", "them", "their", "this",
+    "that", "these", "those", "what", "why", "how", "who", "when", "where", "which", "there", "here",
+    "please", "thanks", "thank", "hello", "hi", "hey", "ok", "okay", "so", "some", "any", "all", "more",
+    "i'm", "it's", "don't", "can't", "what's", "let's", "tell", "give", "make", "show", "explain", "write",
+}
+QUESTION_OPENERS = {
+    "what", "why", "how", "who", "whom", "whose", "when", "where", "which", "is", "are", "was", "were",
+    "am", "do", "does", "did", "can", "could", "will", "would", "should", "shall", "may", "have", "has",
+}
+# Common words of other languages written in Latin script (Spanish, French, German, Portuguese,
+# Italian, romanised Hindi); any of them sends the transcript to the model for translation.
+FOREIGN_MARKER_WORDS = {
+    "el", "la", "los", "las", "de", "del", "que", "es", "esta", "est", "estoy", "por", "para", "con", "una",
+    "uno", "y", "pero", "donde", "como", "se", "je", "tu", "il", "nous", "vous", "suis", "les", "des", "du",
+    "et", "mais", "oui", "avec", "pour", "ich", "und", "der", "das", "ist", "nicht", "ein", "eine",
+    "habe", "bin", "mit", "auf", "wie", "não", "sim", "eu", "voce", "você", "non", "sono", "che", "mujhe",
+    "mera", "meri", "hai", "hain", "kya", "nahi", "nahin", "aur", "ka", "ki", "ke", "ek", "kaise", "kyun",
+    "kahan", "haan", "tum", "aap", "yeh", "woh", "bhi", "karo", "chahiye", "vamos", "hola", "gracias",
+    "bonjour", "merci", "danke", "bitte", "namaste",
+}
+
+
+def voice_cache_key(text: str, target_lang: str):
+    return " ".join(text.split()).casefold(), target_lang
+
+
+def tidy_english_transcript(text: str):
+    """
+    Return the transcript with capitalisation and end punctuation fixed when it
+    is short, plain English with no sign of ASR trouble; None when it needs the model.
+    """
+    words = text.split()
+    if not words or len(words) > VOICE_FAST_PATH_MAX_WORDS:
+        return None
+    if any(ch not in VOICE_ALLOWED_CHARS for ch in text):
+        return None
+    bare = [word.strip(".,?!:;'\"-").lower() for word in words]
+    # A stutter ("the the") is the typical recogniser slip worth a model pass.
+    if any(a and a == b for a, b in zip(bare, bare[1:])):
+        return None
+    # Many languages share short words with English ("a", "no", "do", "an"), so a transcript has
+    # to look clearly English: three words or more, no foreign markers, at least half function words.
+    if len(words) < 3 or any(word in FOREIGN_MARKER_WORDS for word in bare):
+        return None
+    if 2 * sum(word in ENGLISH_FUNCTION_WORDS for word in bare) < len(words):
+        return None
+
+    words = ["I" + word[1:] if word.lower() in {"i", "i'm", "i've", "i'll", "i'd"} else word for word in words]
+    tidy = " ".join(words)
+    tidy = tidy[0].upper() + tidy[1:]
+    if tidy[-1] not in ".?!":
+        tidy = tidy.rstrip(",;:-") + ("?" if bare[0] in QUESTION_OPENERS else ".")
+    return tidy
+
+
+def voice_shortcut(text: str, target_lang: str):
+    """(processed_text, source) without a model call when possible, else None."""
+    cached = voice_cache.get(voice_cache_key(text, target_lang))
+    if cached is not None:
+        return cached, "cache"
+    if target_lang == "en" and VOICE_FAST_PATH_MAX_WORDS > 0:
+        tidy = tidy_english_transcript(text)
+        if tidy is not None:
+            return tidy, "local"
+    return None
+
+
+def remember_voice_text(text: str, target_lang: str, processed: str):
+    voice_cache.put(voice_cache_key(text, target_lang), processed)
+
+
+def normalize_response_text(content) -> str:
+    """Handle API responses that may return either plain text or typed chunks."""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        parts = []
+        for chunk in content:
+            if isinstance(chunk, dict) and chunk.get("type") == "text":
+                txt = chunk.get("text", "")
+                if txt:
+                    parts.append(txt)
+        return "\n".join(parts).strip()
+    return str(content or "").strip()
+
+
+def completion_text(response) -> str:
+    """Answer text of a non-streaming completion; "" when the model sent nothing (the router then escalates)."""
+    return normalize_response_text(response.choices[0].message.content).strip()
+
+
+# Every model tier answered with nothing: reported to the client, never stored as a turn.
+EMPTY_ANSWER_PAYLOAD = {"success": False, "error": "The model returned an empty answer. Please try again."}
+
+
+def rate_limit_retry_after(error):
+    """Seconds to advertise in Retry-After when `error` is a rate limit, else None."""
+    if isinstance(error, RateLimitExceeded):
+        return max(1, math.ceil(error.retry_after))
+    from groq import RateLimitError
+
+    if isinstance(error, RateLimitError):
+        return max(1, math.ceil(retry_after_seconds(error)))
+    return None
+
+
+def wants_event_stream() -> bool:
+    """True when the client asked for Server-Sent Events instead of a JSON body."""
+    return "text/event-stream" in (request.headers.get("Accept") or "").lower()
+
+
+def sse_event(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+def iter_completion_deltas(completion_stream):
+    """Yield the text deltas of a streaming Groq chat completion."""
+    for chunk in completion_stream:
+        if not chunk.choices:
+            continue
+        delta = normalize_response_text(chunk.choices[0].delta.content)
+        if delta:
+            yield delta
+
+
+def open_text_stream(**completion_kwargs):
+    """
+    Start a streaming completion and return an iterator of text deltas, or None
+    when the model produced no text. The first delta is pulled eagerly so provider
+    errors (rate limits, unknown models) surface before the HTTP response starts.
+    """
+    with metrics.stage("llm_first_token"):
+        deltas = iter_completion_deltas(llm.complete(stream=True, **completion_kwargs))
+        first_delta = next(deltas, "")
+    if not first_delta:
+        return None
+    return itertools.chain([first_delta], deltas)
+
+
+def sse_chat_response(deltas, on_complete, extra_fields=None, on_empty=None):
+    """
+    Stream assistant text to the browser as `delta` events, then hand the full text
+    to `on_complete` (persistence) and finish with a `done` event shaped like the
+    regular JSON response. A stream without any text ends with an `error` event
+    instead; nothing is stored and `on_empty` is called.
+    """
+
+    def generate():
+        parts = []
+        try:
+            for delta in deltas:
+                parts.append(delta)
+                yield sse_event("delta", {"content": delta})
+            assistant_text = "".join(parts)
+            if not assistant_text.strip():
+                if on_empty is not None:
+                    on_empty()
+                yield sse_event("error", EMPTY_ANSWER_PAYLOAD)
+                return
+            chat_title, title_pending = on_complete(assistant_text)
+            done_payload = {
+                "success": True,
+                "response": assistant_text,
+                "chat_title": chat_title,
+                "title_pending": title_pending,
+            }
+            done_payload.update(extra_fields or {})
+            yield sse_event("done", done_payload)
+        except Exception as e:
+            print(f"[STREAM ERROR] {e}")
+            yield sse_event("error", {"success": False, "error": "Stream interrupted", "detail": str(e)[:260]})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def timed_vision_call(model: str, call):
+    started = time.monotonic()
+    try:
+        result = call(model)
+    except Exception as e:
+        vision_health.record_failure(model, e)
+        raise
+    if result:
+        vision_health.record_success(model, time.monotonic() - started)
+    else:
+        vision_health.record_failure(model)
+    return result
+
+
+def run_vision_models(call):
+    """
+    Try VISION_MODELS in health order until `call(model)` returns something non-empty.
+    With GROQ_VISION_HEDGE on, the next model is started in parallel whenever the
+    newest attempt outlives its p90 latency, and the first answer wins. Losing
+    attempts are left to finish in the background and their results dropped.
+    Returns (result, errors).
+    """
+    models = vision_health.ordered(VISION_MODELS)
+    errors = []
+
+    if not VISION_HEDGE:
+        for model in models:
+            try:
+                result = timed_vision_call(model, call)
+                if result:
+                    return result, errors
+            except Exception as e:
+                errors.append(f"{model}: {e}")
+        return None, errors
+
+    pending = {}
+    remaining = list(models)
+    last_model = None
+
+    def launch():
+        nonlocal last_model
+        last_model = remaining.pop(0)
+        pending[hedge_executor.submit(metrics.bind_context(timed_vision_call), last_model, call)] = last_model
+
+    launch()
+    while pending:
+        timeout = vision_health.hedge_delay(last_model) if remaining else None
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            print(f"[VISION HEDGE] {last_model} slower than {timeout:.2f}s, starting {remaining[0]}")
+            launch()
+            continue
+        for future in done:
+            model = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                errors.append(f"{model}: {e}")
+                continue
+            if result:
+                return result, errors
+        if not pending and remaining:
+            launch()
+    return None, errors
+
+
+def fallback_chat_title(first_message: str) -> str:
+    return first_message[:30] + "..." if len(first_message) > 30 else first_message
+
+
+def generate_chat_title(first_message: str) -> str:
+    """Generate a short title for the chat based on first user message."""
+    try:
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": (
+                    "Generate a very short title (max 4-5 words) for a chat that starts with: "
+                    f"'{first_message[:120]}'. Only return the title, nothing else."
+                ),
+            },
+        ]
+        title = model_router.call(
+            model_router.for_task("title"),
+            lambda model: completion_text(llm.complete(model=model, messages=messages, max_tokens=32, temperature=0.5)),
+        )
+        title = title.replace('"', "").replace("'", "")
+        return title[:50] if title else fallback_chat_title(first_message)
+    except Exception as e:
+        print(f"[TITLE ERROR] {e}")
+        return fallback_chat_title(first_message)
+
+
+def store_generated_title(user_id: str, session_id: str, first_message: str):
+    with metrics.stage("title_generation"):
+        title = generate_chat_title(first_message)
+    try:
+        # A chat deleted in the meantime must stay deleted, so only existing chats are updated.
+        title_fields = {"title": title or "New Chat", "title_pending": False}
+        with metrics.stage("storage_write"):
+            chat_store.update_chat(user_id, session_id, title_fields)
+        chat_cache.patch((user_id, session_id), title_fields)
+    except Exception as e:
+        print(f"[TITLE STORE ERROR] {e}")
+
+
+def submit_background(fn, *args) -> bool:
+    """Run fn(*args) on the background pool; returns False when the queue is full."""
+    if not background_slots.acquire(blocking=False):
+        return False
+    try:
+        future = background_executor.submit(fn, *args)
+    except Exception:
+        background_slots.release()
+        raise
+    future.add_done_callback(lambda _: background_slots.release())
+    return True
+
+
+def schedule_chat_title(user_id: str, session_id: str, first_message: str) -> bool:
+    """
+    Queue title generation on the background pool. Returns False when the queue is
+    full, in which case the provisional title is kept.
+    """
+    if submit_background(store_generated_title, user_id, session_id, first_message):
+        return True
+    print("[TITLE] queue full, keeping provisional title")
+    chat_store.update_chat(user_id, session_id, {"title_pending": False})
+    chat_cache.patch((user_id, session_id), {"title_pending": False})
+    return False
+
+
+summaries_in_flight = set()
+summaries_lock = threading.Lock()
+
+
+def summarize_messages(previous_summary: str, new_messages: list) -> str:
+    transcript = "\n".join(
+        f"{'User' if msg.get('role') == 'user' else 'Assistant'}: {msg.get('content', '')}" for msg in new_messages
+    )
+    response = llm.complete(
+        model=SUMMARY_MODEL,
+        messages=[
+            {
+                "role": "system",
+                "content": (
+                    "You maintain a running summary of a conversation between a user and an AI assistant. "
+                    "Merge the existing summary with the new messages. Keep facts, decisions, names, numbers "
+                    "and open questions; drop pleasantries. Reply with the updated summary only, under 250 words."
+                ),
+            },
+            {
+                "role": "user",
+                "content": f"Existing summary:\n{previous_summary or '(none)'}\n\nNew messages:\n{transcript}",
+            },
+        ],
+        temperature=0.2,
+        max_tokens=400,
+    )
+    return normalize_response_text(response.choices[0].message.content)
+
+
+def update_chat_summary(user_id: str, session_id: str, window_start: int):
+    key = (user_id, session_id)
+    try:
+        chat = read_chat(user_id, session_id)
+        summary_upto = int(chat.get("summary_upto") or 0)
+        end = min(window_start, summary_upto + SUMMARY_MAX_MESSAGES_PER_PASS)
+        new_messages = fetch_messages(user_id, session_id, chat, end - summary_upto, end)
+        if not new_messages:
+            return
+        with metrics.stage("summary_generation"):
+            summary = summarize_messages(chat.get("summary") or "", new_messages)
+        if not summary:
+            return
+        summary_fields = {"summary": summary, "summary_upto": end}
+        with metrics.stage("storage_write"):
+            chat_store.update_chat(user_id, session_id, summary_fields)
+        chat_cache.patch(key, summary_fields)
+    except Exception as e:
+        print(f"[SUMMARY ERROR] {e}")
+    finally:
+        with summaries_lock:
+            summaries_in_flight.discard(key)
+
+
+def schedule_chat_summary(user_id: str, session_id: str, window_start: int):
+    """Fold messages older than the context window into the stored summary, once per chat at a time."""
+    key = (user_id, session_id)
+    with summaries_lock:
+        if key in summaries_in_flight:
+            return
+        summaries_in_flight.add(key)
+    if not submit_background(update_chat_summary, user_id, session_id, window_start):
+        with summaries_lock:
+            summaries_in_flight.discard(key)
+
+
+def owner_profile_override(prompt: str):
+    """Return fixed RED owner profile response when prompt asks about founder/creator/owner."""
+    if not prompt:
+        return None
+    normalized = " ".join(prompt.lower().strip().split())
+    keyword_groups = [
+        ("owner", "red"),
+        ("creator", "red"),
+        ("founder", "red"),
+    ]
+    is_owner_question = any(a in normalized and b in normalized for a, b in keyword_groups)
+    if not is_owner_question:
+        return None
+    return (
+        "Abhinav Pratap Singh, a B.Tech CSE Student.\n\n"
+        "GitHub: https://github.com/Abhinav-droid-sys\n"
+        "LinkedIn: https://www.linkedin.com/in/abhinav-pratap-singh-998911369"
+    )
+
+
+# =========================
+# IDEMPOTENT CHAT TURNS
+# =========================
+
+chat_flights = IdempotencyStore(
+    IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_ENTRIES, stale_after_seconds=max(300.0, 2 * IDEMPOTENCY_WAIT_SECONDS)
+)
+
+
+def chat_turn_key(user_id: str, session_id: str, prompt: str, is_incognito: bool, incognito_history: list):
+    """
+    (key, fingerprint) for a chat turn: the client's Idempotency-Key when sent,
+    otherwise the turn itself, i.e. the prompt and how much history it follows.
+    """
+    fingerprint = request_fingerprint(session_id, prompt, is_incognito)
+    client_key = (request.headers.get("Idempotency-Key") or "").strip()[:200]
+    if client_key:
+        return ("key", user_id, client_key), fingerprint
+    history_length = len(incognito_history) if is_incognito else chat_message_count(load_chat(user_id, session_id))
+    return ("turn", user_id, request_fingerprint(session_id, prompt, is_incognito, history_length)), fingerprint
+
+
+def replayed_chat_response(flight, streaming: bool):
+    """Answer a duplicate chat request from the flight it coalesced with."""
+    metrics.record_idempotent_replay("stored" if flight.done else "inflight")
+    headers = {"Idempotent-Replayed": "true"}
+    if streaming:
+        return sse_replay_response(flight, headers)
+    if not flight.wait(IDEMPOTENCY_WAIT_SECONDS):
+        return (
+            jsonify({"success": False, "error": "The original request is still in progress. Please retry shortly."}),
+            409,
+            {"Retry-After": "2", **headers},
+        )
+    return jsonify(flight.payload), flight.status, headers
+
+
+def sse_replay_response(flight, headers: dict):
+    """sse_chat_response() for a duplicate: the flight's deltas so far, then live ones, then its result."""
+
+    def generate():
+        seen = 0
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+        while True:
+            chunks, done = flight.chunks_after(seen, max(0.0, deadline - time.monotonic()))
+            for chunk in chunks:
+                yield sse_event("delta", {"content": chunk})
+            seen += len(chunks)
+            if done:
+                break
+            if not chunks and time.monotonic() >= deadline:
+                yield sse_event("error", {"success": False, "error": "The original request is still in progress."})
+                return
+        payload = flight.payload
+        if payload.get("success") and not seen and payload.get("response"):
+            # The original was not streamed; send its answer as one delta.
+            yield sse_event("delta", {"content": payload["response"]})
+        yield sse_event("done" if payload.get("success") else "error", payload)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **headers},
+    )
+
+
+# =========================
+# ROUTES
+# =========================
+
+@bp.app_errorhandler(RequestEntityTooLarge)
+def request_too_large(_error):
+    return jsonify({"success": False, "error": "File too large. Max size is 8MB."}), 413
+
+
+@bp.route("/")
+def index():
+    return render_template("index.html")
+
+@bp.route("/login")
+def login():
+    return render_template("login.html")
+
+
+@bp.route("/privacy")
+def privacy():
+    # A minimal privacy page — you can expand this further (save as template if you prefer)
+    content = """
+    <!doctype html>
+    <html lang="en">
+    <head>
+      <meta charset="utf-8" />
+      <meta name="viewport" content="width=device-width, initial-scale=1" />
+      <title>Privacy — RED</title>
+      <style>
+        body { font-family: Inter, system-ui, Arial; background:#070708; color: #eee; padding:30px; }
+        .card { max-width:800px; margin:30px auto; background:#0f0f10; border-radius:12px; padding:24px; border:1px solid #222; }
+        a { color:#FF6B6B; text-decoration:none; font-weight:700; }
+      </style>
+    </head>
+    <body>
+      <div class="card">
+        <h1>Privacy & Data</h1>
+        <p>This is a brief privacy note for <strong>RED</strong>.</p>
+        <ul>
+          <li>By default messages are stored locally in your browser (localStorage).</li>
+          <li>If you use <em>Incognito</em> mode in the app, messages are kept only temporarily (in memory) and not saved to localStorage.</li>
+          <li>Server-side requests are sent to the Groq API to generate assistant responses. Inputs sent to the server will be processed by the underlying model provider.</li>
+          <li>We recommend avoiding sharing highly-sensitive personal data (SSNs, passwords, payment details) in chats.</li>
+        </ul>
+        <p>If you need a formal privacy policy for compliance, add a more detailed page here with contact & retention details.</p>
+        <p><a href="/">Back to RED</a></p>
+      </div>
+    </body>
+    </html>
+    """
+    return render_template_string(content)
+
+@bp.route("/health")
+def health():
+    store = chat_store.get() if chat_store.ready else None
+    return jsonify(
+        {
+            "status": "ok",
+            "time": datetime.utcnow().isoformat() + "Z",
+            "vision_models": vision_health.snapshot(),
+            "startup": startup_snapshot(),
+            "admission": admission_control.snapshot(),
+            "write_behind": store.snapshot() if hasattr(store, "snapshot") else None,
+            "routing": model_router.snapshot(),
+            "chat_turns": chat_flights.snapshot(),
+        }
+    ), 200
+
+
+@bp.route("/metrics")
+def metrics_endpoint():
+    """Prometheus text exposition of request, stage and Groq call metrics."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@bp.route("/_ah/warmup")
+def warmup_route():
+    """Warmup request (App Engine convention; any platform can call it before routing traffic)."""
+    warmup()
+    return jsonify({"success": True, "startup": startup_snapshot()})
+
+
+@bp.route("/api/voice/process", methods=["POST"])
+def process_voice_text():
+    """
+    Normalize and translate spoken input text to a clean prompt.
+    Request JSON:
+    {
+      "text": "spoken transcript",
+      "target_lang": "en"
+    }
+    """
+    try:
+        data = request.get_json(force=True)
+        text = (data.get("text") or "").strip()
+        target_lang = (data.get("target_lang") or "en").strip().lower()
+
+        if not text:
+            return jsonify({"success": False, "error": "text is required"}), 400
+
+        shortcut = voice_shortcut(text, target_lang)
+        if shortcut is not None:
+            metrics.record_voice_result(shortcut[1])
+            return jsonify({"success": True, "processed_text": shortcut[0], "source": shortcut[1]})
+
+        response = llm.complete(
+            model=VOICE_MODEL,
+            messages=voice_messages(text, target_lang),
+            temperature=0.1,
+            max_tokens=300,
+            top_p=1.0,
+            stream=False,
+        )
+        processed = (response.choices[0].message.content or "").strip()
+        if processed:
+            remember_voice_text(text, target_lang, processed)
+        else:
+            processed = text
+        metrics.record_voice_result("model")
+        return jsonify({"success": True, "processed_text": processed, "source": "model"})
+    except Exception as e:
+        print(f"[VOICE PROCESS ERROR] {e}")
+        return jsonify({"success": False, "processed_text": text if 'text' in locals() else ""}), 200
+
+
+@bp.route("/api/chat", methods=["POST"])
+def chat():
+    """
+    Request JSON format from frontend:
+    {
+      "prompt": "user text",
+      "session_id": "chat_xxx",
+      "is_incognito": true/false,
+      "history": [ { "role": "user"|"assistant", "content": "..." }, ... ]
+    }
+
+    Response JSON:
+    {
+      "success": true/false,
+      "response": "assistant text",
+      "chat_title": "optional title or null",
+      "title_pending": true while the final title is still being generated,
+      "error": "message on failure"
+    }
+
+    With `Accept: text/event-stream` the answer is streamed instead: a series of
+    `delta` events ({"content": "..."}) followed by one `done` event carrying the
+    JSON body above, or an `error` event if the stream breaks mid-way.
+
+    Duplicates of a turn (same Idempotency-Key header, or without one the same
+    prompt against the same history) share one model call and one stored turn:
+    they attach to the request still running or, once it has succeeded, get its
+    stored result, marked with `Idempotent-Replayed: true`. Reusing a key for a
+    different prompt is a 422.
+    """
+    flight = None
+    try:
+        data = request.get_json(force=True)
+        prompt = data.get("prompt", "").strip()
+        session_id = (data.get("session_id", "default") or "default").strip()
+        user_id = request_user_id()
+        is_incognito = bool(data.get("is_incognito", False))
+        incognito_history = data.get("history", []) or []
+        streaming = wants_event_stream()
+
+        if not prompt:
+            return jsonify({"success": False, "error": "No prompt provided"})
+
+        try:
+            flight, leader = chat_flights.begin(
+                *chat_turn_key(user_id, session_id, prompt, is_incognito, incognito_history)
+            )
+        except IdempotencyMismatch as e:
+            return jsonify({"success": False, "error": str(e)}), 422
+        if not leader:
+            return replayed_chat_response(flight, streaming)
+
+        # Fixed profile response for founder/owner/creator queries.
+        assistant_text = owner_profile_override(prompt)
+        deltas = [assistant_text] if assistant_text else None
+        existing_chat = None
+
+        if not assistant_text:
+            messages, existing_chat = build_messages(prompt, user_id, session_id, is_incognito, incognito_history)
+            route = route_chat(prompt, messages)
+            completion_kwargs = dict(
+                messages=messages,
+                temperature=0.7,
+                max_tokens=2048,
+                top_p=1.0,
+            )
+
+            # Call Groq
+            if streaming:
+                deltas = model_router.call(
+                    route, lambda model: open_text_stream(model=model, **completion_kwargs)
+                ) or iter(())
+            else:
+                assistant_text = model_router.call(
+                    route, lambda model: completion_text(llm.complete(model=model, stream=False, **completion_kwargs))
+                )
+
+        def finish_turn(final_text):
+            try:
+                chat_title, title_pending = (
+                    (None, False)
+                    if is_incognito
+                    else persist_chat(user_id, session_id, prompt, final_text, existing_chat)
+                )
+            except Exception:
+                flight.fail({"success": False, "error": "Internal server error"}, 500)
+                raise
+            flight.finish(
+                {"success": True, "response": final_text, "chat_title": chat_title, "title_pending": title_pending}
+            )
+            return chat_title, title_pending
+
+        if streaming:
+            return sse_chat_response(
+                flight.relay(deltas), finish_turn, on_empty=lambda: flight.fail(EMPTY_ANSWER_PAYLOAD, 502)
+            )
+
+        if not assistant_text:
+            flight.fail(EMPTY_ANSWER_PAYLOAD, 502)
+            return jsonify(EMPTY_ANSWER_PAYLOAD), 502
+        finish_turn(assistant_text)
+        return jsonify(flight.payload)
+
+    except RequestEntityTooLarge:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        print(f"[CHAT ERROR] {error_msg}")
+
+        retry_after = rate_limit_retry_after(e)
+        if retry_after is not None:
+            payload = {
+                "success": False,
+                "error": "Rate limit reached. Please wait a moment. (Free tier: 30 requests/minute)",
+            }
+            if flight is not None:
+                flight.fail(payload, 429)
+            return jsonify(payload), 429, {"Retry-After": str(retry_after)}
+        payload = {"success": False, "error": "Internal server error"}
+        if flight is not None:
+            flight.fail(payload, 500)
+        return jsonify(payload), 500
+
+
+# =========================
+# BATCH CHAT
+# =========================
+
+def batch_groups(items: list):
+    """
+    Split /api/chat/batch items into units of work. Items of the same stored session
+    form one group and run in order (each turn sees the previous one); every other
+    item is a group of its own. Returns (groups, rejected): groups are
+    (session_id or None, jobs), rejected are (job, error message).
+    """
+    sessions = {}
+    groups = []
+    rejected = []
+    for index, item in enumerate(items):
+        item = item if isinstance(item, dict) else {}
+        session_id = str(item.get("session_id") or "").strip()
+        if parse_bool(item.get("is_incognito")):
+            session_id = ""
+        job = {
+            "index": index,
+            "id": item.get("id"),
+            "prompt": str(item.get("prompt") or "").strip(),
+            "session_id": session_id or None,
+        }
+        if not job["prompt"]:
+            rejected.append((job, "No prompt provided"))
+            continue
+        if not session_id:
+            groups.append((None, [job]))
+        elif session_id in sessions:
+            sessions[session_id].append(job)
+        else:
+            sessions[session_id] = [job]
+            groups.append((session_id, sessions[session_id]))
+    return groups, rejected
+
+
+def batch_item_error(error) -> dict:
+    retry_after = rate_limit_retry_after(error)
+    if retry_after is not None:
+        return {"success": False, "error": "Rate limit reached", "retry_after": retry_after}
+    return {"success": False, "error": "Model call failed"}
+
+
+def run_batch_group(user_id: str, session_id, jobs: list, results: queue.Queue, stop: threading.Event, broken: set):
+    """
+    Answer one group's jobs in order, putting (job, payload, stored) on `results`.
+    `stored` is (chat before the turn, prepared turn) for turns still to be written
+    by the request thread; context for later jobs is carried forward locally.
+    """
+    skipped = {"success": False, "error": "Skipped after an earlier item of this session failed"}
+    try:
+        existing_chat, history = {}, []
+        if session_id:
+            existing_chat = migrate_legacy_chat(user_id, session_id, load_chat(user_id, session_id))
+            history = fetch_messages(user_id, session_id, existing_chat, CONTEXT_MESSAGE_LIMIT)
+    except Exception as e:
+        print(f"[BATCH ERROR] loading {session_id}: {e}")
+        for job in jobs:
+            results.put((job, {"success": False, "error": "Could not load chat"}, None))
+        return
+
+    for job in jobs:
+        if stop.is_set():
+            return
+        if session_id in broken:
+            results.put((job, skipped, None))
+            continue
+        try:
+            assistant_text = owner_profile_override(job["prompt"])
+            if not assistant_text:
+                messages, _ = assemble_context(history, existing_chat, (user_id, session_id) if session_id else None)
+                messages.append({"role": "user", "content": job["prompt"]})
+                completion_kwargs = dict(messages=messages, temperature=0.7, max_tokens=2048, top_p=1.0)
+                assistant_text = model_router.call(
+                    route_chat(job["prompt"], messages),
+                    lambda model: completion_text(llm.complete(model=model, **completion_kwargs)),
+                )
+        except Exception as e:
+            print(f"[BATCH ERROR] item {job['index']}: {e}")
+            results.put((job, batch_item_error(e), None))
+            if session_id:
+                broken.add(session_id)
+            continue
+        if not assistant_text:
+            results.put((job, EMPTY_ANSWER_PAYLOAD, None))
+            if session_id:
+                broken.add(session_id)
+            continue
+
+        payload = {"success": True, "response": assistant_text}
+        if not session_id:
+            results.put((job, payload, None))
+            continue
+        turn = prepare_turn(user_id, session_id, existing_chat, job["prompt"], assistant_text)
+        results.put((job, payload, (existing_chat, turn)))
+        existing_chat = {**existing_chat, **turn["chat_fields"]}
+        history = (history + turn["messages"])[-CONTEXT_MESSAGE_LIMIT:]
+
+
+def store_batch_turns(user_id: str, finished: list, broken: set):
+    """
+    Write the stored turns among `finished` results with one append_turns() call.
+    Consecutive turns of one chat are merged so each chat is written once; payloads
+    get chat_title/title_pending, or an error if their turn was not saved.
+    """
+    by_session = {}
+    for job, payload, stored in finished:
+        if stored is None:
+            continue
+        session_id = job["session_id"]
+        if session_id in broken:
+            payload.update(success=False, error="Skipped after an earlier item of this session failed")
+            continue
+        existing_chat, turn = stored
+        entry = by_session.get(session_id)
+        if entry is None:
+            by_session[session_id] = {"existing_chat": existing_chat, "turn": dict(turn), "prompt": job["prompt"],
+                                      "payloads": [payload]}
+            continue
+        merged = entry["turn"]
+        merged["messages"] = merged["messages"] + turn["messages"]
+        merged["chat_fields"] = {**merged["chat_fields"], **turn["chat_fields"]}
+        merged["chat_title"] = turn["chat_title"]
+        entry["payloads"].append(payload)
+    if not by_session:
+        return
+
+    turns = [(user_id, session_id, entry["turn"]["messages"], entry["turn"]["chat_fields"])
+             for session_id, entry in by_session.items()]
+    failed = append_batch_turns(user_id, turns)
+    if failed:
+        # Usually another worker wrote to these chats meanwhile: renumber after it and retry once.
+        retry = []
+        for session_id in failed:
+            entry = by_session[session_id]
+            try:
+                forget_chat(user_id, session_id)
+                entry["existing_chat"] = read_chat(user_id, session_id)
+            except Exception as e:
+                print(f"[BATCH ERROR] re-reading {session_id}: {e}")
+                continue
+            entry["turn"] = rebase_turn(entry["existing_chat"], entry["turn"])
+            retry.append((user_id, session_id, entry["turn"]["messages"], entry["turn"]["chat_fields"]))
+        failed = (failed - {turn[1] for turn in retry}) | append_batch_turns(user_id, retry)
+
+    for session_id, entry in by_session.items():
+        if session_id in failed:
+            broken.add(session_id)
+            forget_chat(user_id, session_id)
+            for payload in entry["payloads"]:
+                payload.update(success=False, error="Could not save this turn")
+            continue
+        chat_title, title_pending = finish_stored_turn(
+            user_id, session_id, entry["existing_chat"], entry["turn"], entry["prompt"]
+        )
+        for payload in entry["payloads"]:
+            payload.update(chat_title=chat_title, title_pending=title_pending)
+
+
+def append_batch_turns(user_id: str, turns: list) -> set:
+    """append_turns(); returns the session ids whose turn was not written."""
+    if not turns:
+        return set()
+    try:
+        with metrics.stage("storage_write"):
+            return {turn[1] for turn in chat_store.append_turns(turns)}
+    except Exception as e:
+        print(f"[BATCH ERROR] storing {len(turns)} turns: {e}")
+        return {turn[1] for turn in turns}
+
+
+def iter_batch_results(user_id: str, groups: list, concurrency: int):
+    """
+    Run batch groups on batch_executor, at most `concurrency` at a time, and yield
+    (job, payload) as items finish. Everything that finished while the previous
+    results were being written and sent is stored together, so writes batch up
+    under load without holding back results when traffic is light.
+    """
+    # Fresh metadata for every stored chat in one read; the groups take it from the cache.
+    stored_sessions = [session_id for session_id, _ in groups if session_id]
+    if stored_sessions:
+        try:
+            with metrics.stage("storage_read"):
+                chats = chat_store.get_chats(user_id, stored_sessions)
+            for session_id, chat in chats.items():
+                chat_cache.put((user_id, session_id), chat)
+        except Exception as e:
+            # Each group falls back to its own read.
+            print(f"[BATCH ERROR] batched read: {e}")
+
+    results = queue.Queue()
+    stop = threading.Event()
+    broken = set()
+    waiting = list(reversed(groups))
+    running = 0
+
+    def launch():
+        nonlocal running
+        while waiting and running < concurrency:
+            session_id, jobs = waiting.pop()
+            future = batch_executor.submit(
+                metrics.bind_context(run_batch_group), user_id, session_id, jobs, results, stop, broken
+            )
+            # None marks a finished group; it is queued after that group's last result.
+            future.add_done_callback(lambda _: results.put(None))
+            running += 1
+
+    try:
+        launch()
+        while running:
+            finished = []
+            entry = results.get()
+            while True:
+                if entry is None:
+                    running -= 1
+                else:
+                    finished.append(entry)
+                try:
+                    entry = results.get_nowait()
+                except queue.Empty:
+                    break
+            store_batch_turns(user_id, finished, broken)
+            launch()
+            for job, payload, _ in finished:
+                yield job, payload
+    finally:
+        # Client gone or generator closed: queued groups never start, running ones stop after their current item.
+        stop.set()
+        waiting.clear()
+
+
+@bp.route("/api/chat/batch", methods=["POST"])
+def chat_batch():
+    """
+    Answer many prompts in one request (internal tools, evaluation scripts).
+
+    Request JSON:
+    {
+      "items": [ {"prompt": "...", "session_id": "optional", "id": "optional client ref",
+                  "is_incognito": false}, ... ],
+      "concurrency": optional, capped at CHAT_BATCH_CONCURRENCY
+    }
+
+    Items run concurrently; items sharing a session_id run in order so each sees the
+    previous turn, and are stored like /api/chat turns. Items without a session_id
+    (or incognito) are answered without history and not stored.
+
+    Response is NDJSON, one line per item in completion order:
+      {"index": 0, "id": ..., "success": true, "response": "...", "chat_title": ..., "title_pending": ...}
+    failed items carry "error" (and "retry_after" when rate limited), and the last
+    line is {"done": true, "succeeded": n, "failed": m}.
+    """
+    try:
+        data = request.get_json(force=True) or {}
+        items = data.get("items")
+        if not isinstance(items, list) or not items:
+            return jsonify({"success": False, "error": "items must be a non-empty list"}), 400
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({"success": False, "error": f"At most {BATCH_MAX_ITEMS} items per batch"}), 400
+        user_id = request_user_id()
+        try:
+            concurrency = parse_index(data.get("concurrency"), BATCH_CONCURRENCY) or BATCH_CONCURRENCY
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "error": "concurrency must be a non-negative integer"}), 400
+        concurrency = min(concurrency, BATCH_CONCURRENCY)
+        groups, rejected = batch_groups(items)
+    except Exception as e:
+        print(f"[BATCH ERROR] bad request: {e}")
+        return jsonify({"success": False, "error": "Invalid batch request"}), 400
+
+    def generate():
+        counts = {"succeeded": 0, "failed": len(rejected)}
+        for job, error in rejected:
+            yield json.dumps({"index": job["index"], "id": job["id"], "success": False, "error": error}) + "\n"
+        try:
+            for job, payload in iter_batch_results(user_id, groups, concurrency):
+                counts["succeeded" if payload.get("success") else "failed"] += 1
+                yield json.dumps({"index": job["index"], "id": job["id"], **payload}) + "\n"
+        except Exception as e:
+            print(f"[BATCH ERROR] {e}")
+            yield json.dumps({"done": True, "error": str(e), **counts}) + "\n"
+            return
+        yield json.dumps({"done": True, **counts}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+@bp.route("/api/chat/upload", methods=["POST"])
+def chat_upload():
+    """
+    Multipart request format:
+      - prompt: optional user text
+      - session_id: chat session id
+      - is_incognito: true/false
+      - history: optional JSON string list for incognito mode
+      - file: uploaded file/image
+
+    Honours `Accept: text/event-stream` the same way as /api/chat.
+    """
+    try:
+        streaming = wants_event_stream()
+        prompt = (request.form.get("prompt") or "").strip()
+        session_id = (request.form.get("session_id", "default") or "default").strip()
+        user_id = request_user_id()
+        is_incognito = parse_bool(request.form.get("is_incognito"))
+        incognito_history = load_incognito_history(request.form.get("history"))
+        upload = request.files.get("file")
+
+        if not upload:
+            return jsonify({"success": False, "error": "No file provided"}), 400
+
+        with metrics.stage("attachment"):
+            attachment = load_attachment(upload)
+        if attachment is None:
+            return jsonify({"success": False, "error": "File too large. Max size is 8MB."}), 400
+        filename = attachment["filename"]
+        mimetype = attachment["mimetype"]
+        file_size = attachment["file_size"]
+        if not file_size:
+            return jsonify({"success": False, "error": "Uploaded file is empty"}), 400
+
+        effective_prompt = prompt or "Please analyze this attachment and summarize key insights."
+        assistant_text = owner_profile_override(effective_prompt) if not file_size else None
+        deltas = [assistant_text] if assistant_text else None
+        file_summary = f"{filename} ({mimetype}, {file_size} bytes)"
+        existing_chat = None
+
+        if not assistant_text:
+            if attachment["is_image"]:
+                messages, existing_chat = build_context(user_id, session_id, is_incognito, incognito_history)
+                messages.append(vision_user_message(effective_prompt, attachment))
+
+                def call_vision_model(vision_model):
+                    completion_kwargs = dict(
+                        model=vision_model,
+                        messages=messages,
+                        temperature=0.4,
+                        max_tokens=1800,
+                        top_p=1.0,
+                    )
+                    if streaming:
+                        return open_text_stream(**completion_kwargs)
+                    response = llm.complete(stream=False, **completion_kwargs)
+                    return normalize_response_text(response.choices[0].message.content)
+
+                vision_result, vision_errors = run_vision_models(call_vision_model)
+                if streaming:
+                    deltas = vision_result
+                else:
+                    assistant_text = vision_result
+
+                if not assistant_text and not deltas:
+                    payload, status = vision_failure(vision_errors)
+                    return jsonify(payload), status
+            else:
+                with metrics.stage("attachment_analysis"):
+                    analysis_prompt = text_analysis_prompt(effective_prompt, attachment)
+                messages, existing_chat = build_messages(
+                    analysis_prompt, user_id, session_id, is_incognito, incognito_history
+                )
+                route = route_chat(effective_prompt, messages, attachment=True)
+                completion_kwargs = dict(
+                    messages=messages,
+                    temperature=0.5,
+                    max_tokens=1800,
+                    top_p=1.0,
+                )
+                if streaming:
+                    deltas = model_router.call(
+                        route, lambda model: open_text_stream(model=model, **completion_kwargs)
+                    ) or iter(())
+                else:
+                    assistant_text = model_router.call(
+                        route,
+                        lambda model: completion_text(llm.complete(model=model, stream=False, **completion_kwargs)),
+                    )
+
+        def finish_turn(final_text):
+            if is_incognito:
+                return None, False
+            prompt_to_store = f"{effective_prompt}\n\n[Attachment: {file_summary}]"
+            return persist_chat(user_id, session_id, prompt_to_store, final_text, existing_chat)
+
+        if streaming:
+            return sse_chat_response(deltas, finish_turn, {"file_summary": file_summary})
+
+        if not assistant_text:
+            return jsonify(EMPTY_ANSWER_PAYLOAD), 502
+        chat_title, title_pending = finish_turn(assistant_text)
+        return jsonify(
+            {
+                "success": True,
+                "response": assistant_text,
+                "chat_title": chat_title,
+                "title_pending": title_pending,
+                "file_summary": file_summary,
+            }
+        )
+    except RequestEntityTooLarge:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        print(f"[UPLOAD CHAT ERROR] {error_msg}")
+        retry_after = rate_limit_retry_after(e)
+        if retry_after is not None:
+            return (
+                jsonify({"success": False, "error": "Rate limit reached. Please wait a moment."}),
+                429,
+                {"Retry-After": str(retry_after)},
+            )
+        return jsonify({"success": False, "error": "Internal server error", "detail": error_msg[:260]}), 500
+
+
+def chat_etag(*parts) -> str:
+    """Weak ETag value (unquoted) for a history or chat-list response."""
+    return hashlib.sha1(json.dumps(parts, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+def not_modified(etag: str):
+    """A 304 when the GET's If-None-Match already names `etag`, else None."""
+    if request.method == "GET" and request.if_none_match.contains_weak(etag):
+        return conditional_response(Response(status=304), etag)
+    return None
+
+
+def conditional_response(response, etag: str):
+    response.set_etag(etag, weak=True)
+    # Revalidate every time: the client keeps its own copy and applies deltas.
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("X-User-Id")
+    return response
+
+
+def encode_page_token(updated_at, chat_id: str) -> str:
+    raw = json.dumps({"updated_at": updated_at, "id": chat_id}).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_page_token(token: str):
+    """Return (updated_at, chat_id) from a page token, or None if it is malformed."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        return data["updated_at"], str(data["id"])
+    except Exception:
+        return None
+
+
+@bp.route("/api/chats", methods=["GET"])
+def get_chats():
+    """
+    Return one page of chat sessions for the sidebar, newest first.
+    Query params: limit (default CHATS_PAGE_SIZE), page_token (from the previous page).
+    Only metadata fields are read; the response carries next_page_token or null.
+    The page has an ETag: a GET with a matching If-None-Match gets 304 and no body.
+    """
+    try:
+        user_id = request_user_id()
+        limit = max(1, min(request.args.get("limit", CHATS_PAGE_SIZE, type=int) or CHATS_PAGE_SIZE, 100))
+        cursor = None
+        page_token = (request.args.get("page_token") or "").strip()
+        if page_token:
+            cursor = decode_page_token(page_token)
+            if cursor is None:
+                return jsonify({"success": False, "error": "Invalid page_token", "chats": []}), 400
+
+        chats = []
+        next_page_token = None
+        last_doc_id = None
+        with metrics.stage("storage_read"):
+            page = chat_store.list_chats(user_id, CHAT_LIST_FIELDS, limit + 1, after=cursor)
+        for d in page:
+            if len(chats) == limit:
+                next_page_token = encode_page_token(chats[-1]["updated_at"], last_doc_id)
+                break
+            last_doc_id = d["id"]
+            chats.append(
+                {
+                    "id": d["id"],
+                    "title": d.get("title") or "New Chat",
+                    "updated_at": d.get("updated_at"),
+                    "created_at": d.get("created_at"),
+                    "preview": d.get("preview") or "",
+                }
+            )
+        etag = chat_etag(user_id, chats, next_page_token)
+        return not_modified(etag) or conditional_response(
+            jsonify({"success": True, "chats": chats, "next_page_token": next_page_token}), etag
+        )
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e), "chats": []}), 500
+
+
+@bp.route("/api/chat/history", methods=["GET", "POST"])
+def get_chat_history():
+    """
+    Return one page of history for a session_id, oldest message first.
+    Request JSON (or GET query params): {"session_id": "...", "limit": 50, "before": <message index>}
+    `before` pages backwards; pass the returned `start_index` to get older messages.
+
+    Delta sync: with "after_index" (alias "since") set to the index of the newest
+    message the client holds, only the messages after it are returned
+    ("delta": true, "has_newer" if more than `limit` are waiting). If the chat no
+    longer reaches that index, the newest page is returned with "delta": false
+    and the client should replace its copy.
+
+    The ETag names the chat's state (message count and updated_at), not the page,
+    so a GET that sends back the last ETag it saw gets 304 whenever nothing was
+    added since, whatever it asks for. Paging with `before` is never conditional.
+    Both come from the cached chat: this worker's own turns show up at once, turns
+    stored by another worker once the cached copy expires (CHAT_CACHE_TTL_SECONDS).
+    """
+    try:
+        data = request.args if request.method == "GET" else request.get_json(force=True)
+        session_id = (data.get("session_id") or "").strip()
+        if not session_id:
+            return jsonify({"success": False, "error": "session_id is required"}), 400
+        user_id = request_user_id()
+        try:
+            limit = max(1, min(parse_index(data.get("limit"), HISTORY_PAGE_SIZE), 500))
+            before = parse_index(data.get("before"))
+            after_index = parse_index(data.get("after_index", data.get("since")))
+        except (TypeError, ValueError):
+            return jsonify(
+                {"success": False, "error": "limit, before and after_index must be non-negative integers"}
+            ), 400
+        chat = load_chat(user_id, session_id)
+        message_count = chat_message_count(chat)
+
+        etag = None
+        if before is None:
+            etag = chat_etag(user_id, session_id, message_count, chat.get("updated_at"))
+            unchanged = not_modified(etag)
+            if unchanged is not None:
+                return unchanged
+
+        delta = after_index is not None and before is None and after_index < message_count
+        if delta:
+            start = after_index + 1
+            end = min(message_count, start + limit)
+            page = fetch_messages(user_id, session_id, chat, end - start, end)
+        else:
+            end = message_count if before is None else min(before, message_count)
+            page = fetch_messages(user_id, session_id, chat, limit, end)
+        history = [{"role": msg.get("role"), "content": msg.get("content", "")} for msg in page]
+        start_index = end - len(history)
+        payload = {
+            "success": True,
+            "history": history,
+            "start_index": start_index,
+            "message_count": message_count,
+            "has_more": start_index > 0,
+            "delta": delta,
+        }
+        if delta:
+            payload["has_newer"] = end < message_count
+        if etag is None:
+            return jsonify(payload)
+        return conditional_response(jsonify(payload), etag)
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+def iter_clear_progress(user_id: str):
+    """
+    Delete every chat of a user together with all of its messages, yielding a
+    progress dict after each page and a final one with done=True.
+    """
+    last = {"chats_deleted": 0, "documents_deleted": 0, "failed": 0}
+    try:
+        # The store's last yield is the final tally, so each page is reported one step late.
+        for index, progress in enumerate(chat_store.iter_clear(user_id, DELETE_PAGE_SIZE)):
+            if index:
+                yield {**last, "done": False}
+            last = progress
+    finally:
+        chat_cache.discard_user(user_id)
+        message_tail_cache.discard_user(user_id)
+    yield {**last, "done": True}
+
+
+@bp.route("/api/chat/delete", methods=["POST"])
+def delete_chat():
+    """Delete a stored chat session together with its messages and other subcollections."""
+    try:
+        data = request.get_json(force=True)
+        session_id = (data.get("session_id") or "").strip()
+        if not session_id:
+            return jsonify({"success": False, "error": "session_id is required"}), 400
+        user_id = request_user_id()
+        with metrics.stage("storage_delete"):
+            documents_deleted, failed = chat_store.delete_chat(user_id, session_id)
+        chat_cache.discard((user_id, session_id))
+        message_tail_cache.discard((user_id, session_id))
+
+        return jsonify({"success": not failed, "documents_deleted": documents_deleted, "failed": failed})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@bp.route("/api/chats/clear", methods=["POST"])
+def clear_chats():
+    """
+    Delete all stored chat sessions for current user.
+    Returns {"success", "deleted", "documents_deleted", "failed"}; with
+    `Accept: application/x-ndjson` one progress object is streamed per page instead.
+    """
+    try:
+        user_id = request_user_id()
+        if "application/x-ndjson" in (request.headers.get("Accept") or "").lower():
+            def generate():
+                try:
+                    for progress in iter_clear_progress(user_id):
+                        yield json.dumps(progress) + "\n"
+                except Exception as e:
+                    print(f"[CLEAR ERROR] {e}")
+                    yield json.dumps({"done": True, "error": str(e)}) + "\n"
+
+            return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+        for progress in iter_clear_progress(user_id):
+            pass
+        return jsonify(
+            {
+                "success": not progress["failed"],
+                "deleted": progress["chats_deleted"],
+                "documents_deleted": progress["documents_deleted"],
+                "failed": progress["failed"],
+            }
+        )
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@bp.cli.command("migrate-chats")
+def migrate_chats_command():
+    """Move every legacy `history` array into the messages subcollection."""
+    migrated = 0
+    for user_id, session_id, chat in chat_store.iter_legacy_chats():
+        migrate_legacy_chat(user_id, session_id, chat)
+        migrated += 1
+    print(f"Migrated {migrated} chat(s) to the messages subcollection.")
+
+
+# =========================
+# APP FACTORY / STARTUP
+# =========================
+
+WARMUP_ON_START = parse_bool(os.getenv("WARMUP_ON_START"))
+startup_stats = {"import_ms": None, "first_request_ms": None, "first_request_path": None, "warmed_up": False}
+first_request_lock = threading.Lock()
+
+
+def warmup():
+    """
+    Create the Groq gateway and the chat store and make one storage read, so the
+    first user request does not pay for client setup. Safe to call repeatedly.
+    """
+    started = time.perf_counter()
+    for resource in (llm, chat_store):
+        try:
+            resource.get()
+        except Exception as e:
+            print(f"[WARMUP ERROR] {resource.name}: {e}")
+    try:
+        # Opens the Firestore connection; for SQLite this is a local lookup.
+        chat_store.get_chat("__warmup__", "__warmup__")
+    except Exception as e:
+        print(f"[WARMUP ERROR] storage read: {e}")
+    startup_stats["warmed_up"] = True
+    print(f"[STARTUP] warmup finished in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+def startup_snapshot() -> dict:
+    clients = {
+        resource.name: {
+            "ready": resource.ready,
+            "init_ms": round(resource.init_seconds * 1000, 1) if resource.init_seconds is not None else None,
+        }
+        for resource in (llm, chat_store)
+    }
+    return {**startup_stats, "clients": clients}
+
+
+@bp.before_app_request
+def mark_request_start():
+    g.request_started_at = time.perf_counter()
+    metrics.start_request(request.url_rule.rule if request.url_rule else "unmatched")
+
+
+@bp.before_app_request
+def admit_request():
+    """Tag the request with its user for fair queuing; admit or reject model-backed routes."""
+    key = admission_key(request_user_id(), request.remote_addr, request.headers.get("X-Forwarded-For"))
+    admission.current_user.set(key)
+    if request.url_rule is None or request.url_rule.rule not in ADMISSION_ROUTES:
+        return None
+    try:
+        g.admission_ticket = admission_control.admit(key)
+    except AdmissionRejected as e:
+        payload, retry_after = admission_rejection(e)
+        return jsonify(payload), 429, {"Retry-After": str(retry_after)}
+    return None
+
+
+@bp.teardown_app_request
+def release_admission(_error=None):
+    # Streamed responses keep the request context (and so the ticket) until the stream ends.
+    ticket = g.pop("admission_ticket", None)
+    if ticket is not None:
+        ticket.release()
+
+
+@bp.after_app_request
+def add_server_timing(response):
+    timing = metrics.finish_request(request.method, response.status_code)
+    if timing is not None:
+        # Streamed responses only report the stages that ran before the first byte.
+        response.headers["Server-Timing"] = metrics.server_timing_header(timing)
+    return response
+
+
+@bp.after_app_request
+def record_first_request(response):
+    """Log the latency of the first request this process serves (time to response headers)."""
+    if startup_stats["first_request_ms"] is None:
+        with first_request_lock:
+            if startup_stats["first_request_ms"] is None:
+                elapsed_ms = round((time.perf_counter() - g.request_started_at) * 1000, 1)
+                startup_stats["first_request_ms"] = elapsed_ms
+                startup_stats["first_request_path"] = request.path
+                print(f"[STARTUP] first request {request.path} took {elapsed_ms:.0f} ms")
+    return response
+
+
+def create_app() -> Flask:
+    """
+    Build the Flask app. Clients are created lazily on first use; set
+    WARMUP_ON_START=1 to build them in the background as soon as the app exists.
+    """
+    flask_app = Flask(__name__, template_folder="templates", static_folder="static")
+    # Werkzeug rejects larger bodies before buffering them.
+    flask_app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES + MAX_FORM_OVERHEAD_BYTES
+    flask_app.register_blueprint(bp)
+    if WRITE_BEHIND_JOURNAL_DIR:
+        # Replays journals left by a crashed worker now, not on the first request.
+        chat_store.get()
+    if WARMUP_ON_START:
+        threading.Thread(target=warmup, name="warmup", daemon=True).start()
+    return flask_app
+
+
+app = create_app()
+startup_stats["import_ms"] = round((time.perf_counter() - IMPORT_STARTED_AT) * 1000, 1)
+print(f"[STARTUP] app imported in {startup_stats['import_ms']:.0f} ms")
+
+
+if __name__ == "__main__":
+    print("=" * 60)
+    print("🚀 RED AI Assistant ")
+    print("🤖 Persona: RED (named after the red, high-energy UI)")
+    print("=" * 60)
+    if GROQ_API_KEY:
+        print(f"✅ Groq API Key Loaded: {GROQ_API_KEY[:9]}...***")
+    else:
+        print("❌ GROQ_API_KEY not set: model calls will fail until it is added to .env")
+    print("=" * 60)
+    app.run(debug=True, host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
@@ -0,0 +1,678 @@
+"""
+ASGI entry point with a native asyncio request path:
+
+    hypercorn asgi:app --workers 2
+
+/api/chat, /api/chat/upload and /api/voice/process run as coroutines on AsyncGroq
+and Firestore's AsyncClient (SQLite calls go to worker threads), so one worker
+keeps hundreds of conversations in flight without a thread per request. Request
+and response formats match the Flask routes in app.py, which still serve every
+other path through asgiref's WSGI adapter.
+"""
+
+import asyncio
+import os
+import time
+from asyncio import FIRST_COMPLETED
+
+from asgiref.wsgi import WsgiToAsgi
+from quart import Quart, Response, g, jsonify, request
+from quart.wrappers.response import IterableBody
+from werkzeug.exceptions import RequestEntityTooLarge
+
+import admission
+import app as red
+import metrics
+from admission import AdmissionRejected
+from chat_store import AppendConflict, create_async_chat_store
+from idempotency import IdempotencyMismatch, request_fingerprint
+from llm_gateway import AsyncLLMGateway
+
+
+ASYNC_ROUTES = {"/api/chat", "/api/chat/upload", "/api/voice/process"}
+# In-flight Groq calls per worker on the async path; requests/tokens per minute
+# are still paced by the limiters shared with the sync gateway.
+ASYNC_MAX_CONCURRENCY = int(os.getenv("GROQ_ASYNC_MAX_CONCURRENCY", "256"))
+
+
+def create_async_llm_gateway() -> AsyncLLMGateway:
+    from groq import AsyncGroq
+
+    # Building the sync gateway first checks GROQ_API_KEY and provides the shared limiters.
+    gateway = red.llm.get()
+    client = AsyncGroq(api_key=red.GROQ_API_KEY, max_retries=0)
+    return AsyncLLMGateway(client, gateway, max_concurrency=ASYNC_MAX_CONCURRENCY)
+
+
+# Created on first use inside the server's event loop (both clients bind to it).
+async_llm = red.LazyResource("groq (async)", create_async_llm_gateway)
+async_chat_store = red.LazyResource(
+    "chat store (async)",
+    lambda: create_async_chat_store(red.chat_store.get(), red.init_firestore_async_client),
+)
+
+quart_app = Quart(__name__)
+quart_app.config["MAX_CONTENT_LENGTH"] = red.MAX_UPLOAD_BYTES + red.MAX_FORM_OVERHEAD_BYTES
+flask_app = WsgiToAsgi(red.app)
+
+
+async def app(scope, receive, send):
+    """Route the async endpoints (and lifespan events) to Quart, everything else to Flask."""
+    if scope["type"] != "http" or scope["path"] in ASYNC_ROUTES:
+        await quart_app(scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
+
+
+@quart_app.before_serving
+async def warm_async_clients():
+    if red.WARMUP_ON_START:
+        await asyncio.to_thread(red.warmup)
+        async_llm.get()
+        async_chat_store.get()
+
+
+@quart_app.before_request
+async def start_request_timing():
+    metrics.start_request(request.url_rule.rule if request.url_rule else "unmatched")
+
+
+@quart_app.before_request
+async def admit_request():
+    key = red.admission_key(request_user_id(), request.remote_addr, request.headers.get("X-Forwarded-For"))
+    admission.current_user.set(key)
+    if request.url_rule is None or request.url_rule.rule not in red.ADMISSION_ROUTES:
+        return None
+    try:
+        g.admission_ticket = red.admission_control.admit(key)
+    except AdmissionRejected as e:
+        payload, retry_after = red.admission_rejection(e)
+        return jsonify(payload), 429, {"Retry-After": str(retry_after)}
+    return None
+
+
+async def release_when_done(chunks, ticket):
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        ticket.release()
+
+
+@quart_app.after_request
+async def add_server_timing(response):
+    timing = metrics.finish_request(request.method, response.status_code)
+    if timing is not None:
+        response.headers["Server-Timing"] = metrics.server_timing_header(timing)
+    ticket = g.pop("admission_ticket", None)
+    if ticket is not None:
+        # Quart sends the body after the request context is gone, so a streamed
+        # reply holds its admission slot until the last event is written.
+        if isinstance(response.response, IterableBody):
+            response.response = IterableBody(release_when_done(response.response.iter, ticket))
+        else:
+            ticket.release()
+    return response
+
+
+@quart_app.teardown_request
+async def release_admission(_error=None):
+    ticket = g.pop("admission_ticket", None)
+    if ticket is not None:
+        ticket.release()
+
+
+# =========================
+# ASYNC HELPERS
+# =========================
+
+def request_user_id() -> str:
+    user_id = (request.headers.get("X-User-Id") or "anonymous").strip()
+    return user_id if user_id else "anonymous"
+
+
+def wants_event_stream() -> bool:
+    return "text/event-stream" in (request.headers.get("Accept") or "").lower()
+
+
+async def iter_items(items):
+    for item in items:
+        yield item
+
+
+async def load_chat(user_id: str, session_id: str) -> dict:
+    """Async red.load_chat(): may trail other workers' writes."""
+    cached = red.chat_cache.get((user_id, session_id))
+    if cached is not None:
+        return cached
+    return await read_chat(user_id, session_id)
+
+
+async def read_chat(user_id: str, session_id: str) -> dict:
+    """Async red.read_chat(): always reads the store."""
+    with metrics.stage("storage_read"):
+        chat = await async_chat_store.get_chat(user_id, session_id)
+    red.chat_cache.put((user_id, session_id), chat)
+    return chat
+
+
+def prefetch_chat(user_id: str, session_id: str):
+    """Start reading chat metadata now; returns (session_id, task) for build_context()."""
+    if not session_id:
+        return None
+    return session_id, asyncio.create_task(read_chat(user_id, session_id))
+
+
+def discard_prefetch(prefetched):
+    if prefetched is not None and not prefetched[1].done():
+        prefetched[1].cancel()
+
+
+async def fetch_messages(user_id: str, session_id: str, chat: dict, limit: int, before: int = None) -> list:
+    count, start, end = red.message_range(chat, limit, before)
+    if start >= end:
+        return []
+    if red.is_legacy_chat(chat):
+        return chat["history"][start:end]
+
+    key = (user_id, session_id)
+    cached = red.cached_messages(key, count, start, end)
+    if cached is not None:
+        return cached
+    with metrics.stage("storage_read"):
+        page = await async_chat_store.fetch_messages(user_id, session_id, start, end)
+    red.remember_messages(key, count, start, end, page)
+    return page
+
+
+async def build_context(user_id: str, session_id: str, is_incognito: bool, incognito_history: list, prefetched=None):
+    if is_incognito:
+        return red.assemble_context(incognito_history or [])
+    if prefetched is not None and prefetched[0] == session_id:
+        existing_chat = await prefetched[1]
+    else:
+        existing_chat = await read_chat(user_id, session_id)
+    history = await fetch_messages(user_id, session_id, existing_chat, red.CONTEXT_MESSAGE_LIMIT)
+    return red.assemble_context(history, existing_chat, (user_id, session_id))
+
+
+async def persist_chat(user_id: str, session_id: str, prompt: str, assistant_text: str, existing_chat: dict = None):
+    """Async red.persist_chat(): `existing_chat` is what the prompt was built from."""
+    if existing_chat is None:
+        existing_chat = await load_chat(user_id, session_id)
+    if red.is_legacy_chat(existing_chat):
+        existing_chat = await asyncio.to_thread(red.migrate_legacy_chat, user_id, session_id, existing_chat)
+    turn = red.prepare_turn(user_id, session_id, existing_chat, prompt, assistant_text)
+    try:
+        with metrics.stage("storage_write"):
+            await async_chat_store.append_messages(user_id, session_id, turn["messages"], turn["chat_fields"])
+    except AppendConflict as e:
+        print(f"[CHAT STORE] {session_id}: index {turn['messages'][0]['index']} taken, retrying ({e})")
+        red.forget_chat(user_id, session_id)
+        existing_chat = await read_chat(user_id, session_id)
+        turn = red.prepare_turn(user_id, session_id, existing_chat, prompt, assistant_text)
+        with metrics.stage("storage_write"):
+            await async_chat_store.append_messages(user_id, session_id, turn["messages"], turn["chat_fields"])
+    return red.finish_stored_turn(user_id, session_id, existing_chat, turn, prompt)
+
+
+async def completion_text(pending) -> str:
+    """Async red.completion_text() for an awaitable completion."""
+    return red.completion_text(await pending)
+
+
+async def iter_completion_deltas(completion_stream):
+    async for chunk in completion_stream:
+        if not chunk.choices:
+            continue
+        delta = red.normalize_response_text(chunk.choices[0].delta.content)
+        if delta:
+            yield delta
+
+
+async def prepend_delta(first_delta: str, deltas):
+    yield first_delta
+    async for delta in deltas:
+        yield delta
+
+
+async def open_text_stream(**completion_kwargs):
+    """Async open_text_stream(): the first delta is awaited before the response starts."""
+    with metrics.stage("llm_first_token"):
+        deltas = iter_completion_deltas(await async_llm.complete(stream=True, **completion_kwargs))
+        first_delta = await anext(deltas, "")
+    if not first_delta:
+        return None
+    return prepend_delta(first_delta, deltas)
+
+
+def sse_chat_response(deltas, on_complete, extra_fields=None, on_empty=None):
+    async def generate():
+        parts = []
+        try:
+            async for delta in deltas:
+                parts.append(delta)
+                yield red.sse_event("delta", {"content": delta})
+            assistant_text = "".join(parts)
+            if not assistant_text.strip():
+                if on_empty is not None:
+                    on_empty()
+                yield red.sse_event("error", red.EMPTY_ANSWER_PAYLOAD)
+                return
+            chat_title, title_pending = await on_complete(assistant_text)
+            done_payload = {
+                "success": True,
+                "response": assistant_text,
+                "chat_title": chat_title,
+                "title_pending": title_pending,
+            }
+            done_payload.update(extra_fields or {})
+            yield red.sse_event("done", done_payload)
+        except Exception as e:
+            print(f"[STREAM ERROR] {e}")
+            yield red.sse_event("error", {"success": False, "error": "Stream interrupted", "detail": str(e)[:260]})
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def timed_vision_call(model: str, call):
+    started = time.monotonic()
+    try:
+        result = await call(model)
+    except Exception as e:
+        red.vision_health.record_failure(model, e)
+        raise
+    if result:
+        red.vision_health.record_success(model, time.monotonic() - started)
+    else:
+        red.vision_health.record_failure(model)
+    return result
+
+
+async def run_vision_models(call):
+    """Async run_vision_models(): same ordering and hedging, but losing attempts are cancelled."""
+    models = red.vision_health.ordered(red.VISION_MODELS)
+    errors = []
+
+    if not red.VISION_HEDGE:
+        for model in models:
+            try:
+                result = await timed_vision_call(model, call)
+                if result:
+                    return result, errors
+            except Exception as e:
+                errors.append(f"{model}: {e}")
+        return None, errors
+
+    pending = {}
+    remaining = list(models)
+    last_model = None
+
+    def launch():
+        nonlocal last_model
+        last_model = remaining.pop(0)
+        pending[asyncio.create_task(timed_vision_call(last_model, call))] = last_model
+
+    launch()
+    try:
+        while pending:
+            timeout = red.vision_health.hedge_delay(last_model) if remaining else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                print(f"[VISION HEDGE] {last_model} slower than {timeout:.2f}s, starting {remaining[0]}")
+                launch()
+                continue
+            for task in done:
+                model = pending.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    errors.append(f"{model}: {e}")
+                    continue
+                if result:
+                    return result, errors
+            if not pending and remaining:
+                launch()
+        return None, errors
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def chat_turn_key(user_id: str, session_id: str, prompt: str, is_incognito: bool, incognito_history: list,
+                        prefetched=None):
+    """Async red.chat_turn_key()."""
+    fingerprint = request_fingerprint(session_id, prompt, is_incognito)
+    client_key = (request.headers.get("Idempotency-Key") or "").strip()[:200]
+    if client_key:
+        return ("key", user_id, client_key), fingerprint
+    if is_incognito:
+        history_length = len(incognito_history)
+    elif prefetched is not None and prefetched[0] == session_id:
+        history_length = red.chat_message_count(await prefetched[1])
+    else:
+        history_length = red.chat_message_count(await load_chat(user_id, session_id))
+    return ("turn", user_id, request_fingerprint(session_id, prompt, is_incognito, history_length)), fingerprint
+
+
+async def replayed_chat_response(flight, streaming: bool):
+    """Async red.replayed_chat_response(); waits on the flight from a worker thread."""
+    metrics.record_idempotent_replay("stored" if flight.done else "inflight")
+    headers = {"Idempotent-Replayed": "true"}
+    if streaming:
+        return sse_replay_response(flight, headers)
+    if not await asyncio.to_thread(flight.wait, red.IDEMPOTENCY_WAIT_SECONDS):
+        return (
+            jsonify({"success": False, "error": "The original request is still in progress. Please retry shortly."}),
+            409,
+            {"Retry-After": "2", **headers},
+        )
+    return jsonify(flight.payload), flight.status, headers
+
+
+def sse_replay_response(flight, headers: dict):
+    async def generate():
+        seen = 0
+        deadline = time.monotonic() + red.IDEMPOTENCY_WAIT_SECONDS
+        while True:
+            chunks, done = await asyncio.to_thread(
+                flight.chunks_after, seen, max(0.0, deadline - time.monotonic())
+            )
+            for chunk in chunks:
+                yield red.sse_event("delta", {"content": chunk})
+            seen += len(chunks)
+            if done:
+                break
+            if not chunks and time.monotonic() >= deadline:
+                yield red.sse_event("error", {"success": False, "error": "The original request is still in progress."})
+                return
+        payload = flight.payload
+        if payload.get("success") and not seen and payload.get("response"):
+            yield red.sse_event("delta", {"content": payload["response"]})
+        yield red.sse_event("done" if payload.get("success") else "error", payload)
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **headers},
+    )
+
+
+def rate_limited_response(e, message: str):
+    retry_after = red.rate_limit_retry_after(e)
+    if retry_after is None:
+        return None
+    return jsonify({"success": False, "error": message}), 429, {"Retry-After": str(retry_after)}
+
+
+# =========================
+# ASYNC ROUTES
+# =========================
+
+@quart_app.errorhandler(RequestEntityTooLarge)
+async def request_too_large(_error):
+    return jsonify({"success": False, "error": "File too large. Max size is 8MB."}), 413
+
+
+@quart_app.route("/api/voice/process", methods=["POST"])
+async def process_voice_text():
+    """Async /api/voice/process; same request and response as the Flask route."""
+    text = ""
+    try:
+        data = await request.get_json(force=True)
+        text = (data.get("text") or "").strip()
+        target_lang = (data.get("target_lang") or "en").strip().lower()
+
+        if not text:
+            return jsonify({"success": False, "error": "text is required"}), 400
+
+        shortcut = red.voice_shortcut(text, target_lang)
+        if shortcut is not None:
+            metrics.record_voice_result(shortcut[1])
+            return jsonify({"success": True, "processed_text": shortcut[0], "source": shortcut[1]})
+
+        response = await async_llm.complete(
+            model=red.VOICE_MODEL,
+            messages=red.voice_messages(text, target_lang),
+            temperature=0.1,
+            max_tokens=300,
+            top_p=1.0,
+            stream=False,
+        )
+        processed = (response.choices[0].message.content or "").strip()
+        if processed:
+            red.remember_voice_text(text, target_lang, processed)
+        else:
+            processed = text
+        metrics.record_voice_result("model")
+        return jsonify({"success": True, "processed_text": processed, "source": "model"})
+    except Exception as e:
+        print(f"[VOICE PROCESS ERROR] {e}")
+        return jsonify({"success": False, "processed_text": text}), 200
+
+
+@quart_app.route("/api/chat", methods=["POST"])
+async def chat():
+    """
+    Async /api/chat; same formats as the Flask route. When the client sends an
+    X-Session-Id header the chat read starts before the JSON body has arrived.
+    """
+    user_id = request_user_id()
+    prefetched = prefetch_chat(user_id, (request.headers.get("X-Session-Id") or "").strip())
+    flight = None
+    try:
+        data = await request.get_json(force=True)
+        prompt = data.get("prompt", "").strip()
+        session_id = (data.get("session_id", "default") or "default").strip()
+        is_incognito = bool(data.get("is_incognito", False))
+        incognito_history = data.get("history", []) or []
+        streaming = wants_event_stream()
+
+        if not prompt:
+            return jsonify({"success": False, "error": "No prompt provided"})
+
+        try:
+            flight, leader = red.chat_flights.begin(
+                *await chat_turn_key(user_id, session_id, prompt, is_incognito, incognito_history, prefetched)
+            )
+        except IdempotencyMismatch as e:
+            return jsonify({"success": False, "error": str(e)}), 422
+        if not leader:
+            return await replayed_chat_response(flight, streaming)
+
+        # Fixed profile response for founder/owner/creator queries.
+        assistant_text = red.owner_profile_override(prompt)
+        deltas = iter_items([assistant_text]) if assistant_text else None
+        existing_chat = None
+
+        if not assistant_text:
+            messages, existing_chat = await build_context(
+                user_id, session_id, is_incognito, incognito_history, prefetched
+            )
+            messages.append({"role": "user", "content": prompt})
+            route = red.route_chat(prompt, messages)
+            completion_kwargs = dict(
+                messages=messages,
+                temperature=0.7,
+                max_tokens=2048,
+                top_p=1.0,
+            )
+            if streaming:
+                deltas = await red.model_router.call_async(
+                    route, lambda model: open_text_stream(model=model, **completion_kwargs)
+                ) or iter_items([])
+            else:
+                assistant_text = await red.model_router.call_async(
+                    route,
+                    lambda model: completion_text(async_llm.complete(model=model, stream=False, **completion_kwargs)),
+                )
+
+        async def finish_turn(final_text):
+            try:
+                chat_title, title_pending = (
+                    (None, False)
+                    if is_incognito
+                    else await persist_chat(user_id, session_id, prompt, final_text, existing_chat)
+                )
+            except Exception:
+                flight.fail({"success": False, "error": "Internal server error"}, 500)
+                raise
+            flight.finish(
+                {"success": True, "response": final_text, "chat_title": chat_title, "title_pending": title_pending}
+            )
+            return chat_title, title_pending
+
+        if streaming:
+            return sse_chat_response(
+                flight.relay_async(deltas), finish_turn, on_empty=lambda: flight.fail(red.EMPTY_ANSWER_PAYLOAD, 502)
+            )
+
+        if not assistant_text:
+            flight.fail(red.EMPTY_ANSWER_PAYLOAD, 502)
+            return jsonify(red.EMPTY_ANSWER_PAYLOAD), 502
+        await finish_turn(assistant_text)
+        return jsonify(flight.payload)
+    except RequestEntityTooLarge:
+        raise
+    except Exception as e:
+        print(f"[CHAT ERROR] {e}")
+        message = "Rate limit reached. Please wait a moment. (Free tier: 30 requests/minute)"
+        limited = rate_limited_response(e, message)
+        if flight is not None:
+            flight.fail({"success": False, "error": message if limited is not None else "Internal server error"},
+                        429 if limited is not None else 500)
+        if limited is not None:
+            return limited
+        return jsonify({"success": False, "error": "Internal server error"}), 500
+    finally:
+        discard_prefetch(prefetched)
+
+
+@quart_app.route("/api/chat/upload", methods=["POST"])
+async def chat_upload():
+    """
+    Async /api/chat/upload; same formats as the Flask route. Attachment processing
+    runs in a worker thread while the chat history is read concurrently.
+    """
+    user_id = request_user_id()
+    prefetched = prefetch_chat(user_id, (request.headers.get("X-Session-Id") or "").strip())
+    try:
+        streaming = wants_event_stream()
+        form = await request.form
+        files = await request.files
+        prompt = (form.get("prompt") or "").strip()
+        session_id = (form.get("session_id", "default") or "default").strip()
+        is_incognito = red.parse_bool(form.get("is_incognito"))
+        incognito_history = red.load_incognito_history(form.get("history"))
+        upload = files.get("file")
+
+        if not upload:
+            return jsonify({"success": False, "error": "No file provided"}), 400
+        if not is_incognito and (prefetched is None or prefetched[0] != session_id):
+            discard_prefetch(prefetched)
+            prefetched = prefetch_chat(user_id, session_id)
+
+        with metrics.stage("attachment"):
+            attachment = await asyncio.to_thread(red.load_attachment, upload)
+        if attachment is None:
+            return jsonify({"success": False, "error": "File too large. Max size is 8MB."}), 400
+        filename = attachment["filename"]
+        mimetype = attachment["mimetype"]
+        file_size = attachment["file_size"]
+        if not file_size:
+            return jsonify({"success": False, "error": "Uploaded file is empty"}), 400
+
+        effective_prompt = prompt or "Please analyze this attachment and summarize key insights."
+        deltas = None
+        assistant_text = None
+        file_summary = f"{filename} ({mimetype}, {file_size} bytes)"
+
+        if attachment["is_image"]:
+            messages, existing_chat = await build_context(
+                user_id, session_id, is_incognito, incognito_history, prefetched
+            )
+            messages.append(red.vision_user_message(effective_prompt, attachment))
+
+            async def call_vision_model(vision_model):
+                completion_kwargs = dict(
+                    model=vision_model,
+                    messages=messages,
+                    temperature=0.4,
+                    max_tokens=1800,
+                    top_p=1.0,
+                )
+                if streaming:
+                    return await open_text_stream(**completion_kwargs)
+                response = await async_llm.complete(stream=False, **completion_kwargs)
+                return red.normalize_response_text(response.choices[0].message.content)
+
+            vision_result, vision_errors = await run_vision_models(call_vision_model)
+            if streaming:
+                deltas = vision_result
+            else:
+                assistant_text = vision_result
+
+            if not assistant_text and not deltas:
+                payload, status = red.vision_failure(vision_errors)
+                return jsonify(payload), status
+        else:
+            # Map-reduce of large files uses the sync gateway's thread pool.
+            with metrics.stage("attachment_analysis"):
+                analysis_prompt = await asyncio.to_thread(red.text_analysis_prompt, effective_prompt, attachment)
+            messages, existing_chat = await build_context(
+                user_id, session_id, is_incognito, incognito_history, prefetched
+            )
+            messages.append({"role": "user", "content": analysis_prompt})
+            route = red.route_chat(effective_prompt, messages, attachment=True)
+            completion_kwargs = dict(
+                messages=messages,
+                temperature=0.5,
+                max_tokens=1800,
+                top_p=1.0,
+            )
+            if streaming:
+                deltas = await red.model_router.call_async(
+                    route, lambda model: open_text_stream(model=model, **completion_kwargs)
+                ) or iter_items([])
+            else:
+                assistant_text = await red.model_router.call_async(
+                    route,
+                    lambda model: completion_text(async_llm.complete(model=model, stream=False, **completion_kwargs)),
+                )
+
+        async def finish_turn(final_text):
+            if is_incognito:
+                return None, False
+            prompt_to_store = f"{effective_prompt}\n\n[Attachment: {file_summary}]"
+            return await persist_chat(user_id, session_id, prompt_to_store, final_text, existing_chat)
+
+        if streaming:
+            return sse_chat_response(deltas, finish_turn, {"file_summary": file_summary})
+
+        if not assistant_text:
+            return jsonify(red.EMPTY_ANSWER_PAYLOAD), 502
+        chat_title, title_pending = await finish_turn(assistant_text)
+        return jsonify(
+            {
+                "success": True,
+                "response": assistant_text,
+                "chat_title": chat_title,
+                "title_pending": title_pending,
+                "file_summary": file_summary,
+            }
+        )
+    except RequestEntityTooLarge:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        print(f"[UPLOAD CHAT ERROR] {error_msg}")
+        limited = rate_limited_response(e, "Rate limit reached. Please wait a moment.")
+        if limited is not None:
+            return limited
+        return jsonify({"success": False, "error": "Internal server error", "detail": error_msg[:260]}), 500
+    finally:
+        discard_prefetch(prefetched)
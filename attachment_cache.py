@@ -0,0 +1,253 @@
+"""
+Content-addressed cache for processed attachments.
+
+Entries are keyed by the SHA-256 of the uploaded bytes plus the processing
+settings that produced them, so re-uploading the same file skips text
+extraction, image recompression and (for large text files) the map step.
+Two stores are available: an in-process LRU and a directory on disk; both
+evict by total size and by age.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def hash_stream(stream, chunk_bytes: int, limit: int):
+    """
+    Return (sha256 hexdigest, size) of a file-like object and rewind it.
+    Returns (None, size) as soon as more than `limit` bytes have been read.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = stream.read(chunk_bytes)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            return None, size
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest(), size
+
+
+class MemoryAttachmentStore:
+    def __init__(self, max_bytes: int, ttl_seconds: float):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.time() - stored_at > self.ttl_seconds:
+                self._size -= len(value)
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous[1])
+            self._entries[key] = (time.time(), value)
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def delete(self, key: str):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= len(entry[1])
+
+
+class DiskAttachmentStore:
+    """
+    One file per entry. mtime is the write time used for the TTL; atime is bumped
+    on reads so size-based eviction drops the least recently used files first.
+
+    The directory is only scanned when the running size total passes max_bytes
+    (eviction then goes down to 90% of it) or every `rescan_every` writes, which
+    picks up what other processes sharing the directory have written.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl_seconds: float, rescan_every: int = 100):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.rescan_every = rescan_every
+        # Bytes on disk at the last scan plus this process's writes since; None until the first scan.
+        self._size = None
+        self._puts_since_scan = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+            if time.time() - stat.st_mtime > self.ttl_seconds:
+                os.remove(path)
+                return None
+            with open(path, "rb") as handle:
+                value = handle.read()
+            # Refresh the access time so eviction is least-recently-used.
+            os.utime(path, (time.time(), stat.st_mtime))
+            return value
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            # Unreadable entry: drop it and let the caller recompute.
+            print(f"[ATTACHMENT CACHE ERROR] reading {path}: {e}")
+            self.delete(key)
+            return None
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def put(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            replaced = os.stat(path).st_size
+        except FileNotFoundError:
+            replaced = 0
+        with open(tmp_path, "wb") as handle:
+            handle.write(value)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._puts_since_scan += 1
+            if self._size is not None:
+                self._size += len(value) - replaced
+            due = self._size is None or self._size > self.max_bytes or self._puts_since_scan >= self.rescan_every
+        if due:
+            self._evict()
+
+    def _evict(self):
+        with self._lock:
+            now = time.time()
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if now - stat.st_mtime > self.ttl_seconds:
+                    # Includes temp files left by a process that died mid-write.
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                if name.endswith(".tmp"):
+                    continue
+                entries.append((stat.st_atime, stat.st_size, path))
+                total += stat.st_size
+            # Leave headroom so the next few writes don't trigger another scan.
+            target = self.max_bytes if total <= self.max_bytes else int(self.max_bytes * 0.9)
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self._size = total
+            self._puts_since_scan = 0
+
+
+class AttachmentCache:
+    """Typed helpers over a byte store; a None store disables caching."""
+
+    def __init__(self, store=None):
+        self.store = store
+
+    def _get(self, key: str):
+        if self.store is None:
+            return None
+        try:
+            return self.store.get(key)
+        except OSError as e:
+            print(f"[ATTACHMENT CACHE ERROR] {e}")
+            return None
+
+    def _discard(self, key: str, error):
+        """Drop an entry that could not be decoded (truncated or corrupt); the caller treats it as a miss."""
+        print(f"[ATTACHMENT CACHE ERROR] dropping unreadable entry: {error}")
+        try:
+            self.store.delete(key)
+        except OSError as e:
+            print(f"[ATTACHMENT CACHE ERROR] {e}")
+
+    def _put(self, key: str, value: bytes):
+        if self.store is None:
+            return
+        try:
+            self.store.put(key, value)
+        except OSError as e:
+            print(f"[ATTACHMENT CACHE ERROR] {e}")
+
+    def get_json(self, key: str):
+        raw = self._get(key)
+        if raw is None:
+            return None
+        try:
+            return json.loads(raw.decode("utf-8"))
+        except ValueError as e:
+            self._discard(key, e)
+            return None
+
+    def put_json(self, key: str, value):
+        self._put(key, json.dumps(value).encode("utf-8"))
+
+    def get_image(self, key: str):
+        """Return (bytes, mimetype) or None."""
+        raw = self._get(key)
+        if raw is None:
+            return None
+        mimetype, separator, data = raw.partition(b"\n")
+        try:
+            if not separator or not data:
+                raise ValueError("truncated image entry")
+            return data, mimetype.decode("ascii")
+        except ValueError as e:
+            self._discard(key, e)
+            return None
+
+    def put_image(self, key: str, data: bytes, mimetype: str):
+        self._put(key, mimetype.encode("ascii") + b"\n" + bytes(data))
+
+
+def create_attachment_cache(backend: str, directory: str, max_bytes: int, ttl_seconds: float) -> AttachmentCache:
+    backend = (backend or "memory").strip().lower()
+    if backend == "disk":
+        return AttachmentCache(DiskAttachmentStore(directory, max_bytes, ttl_seconds))
+    if backend in {"off", "none", "disabled"}:
+        return AttachmentCache(None)
+    return AttachmentCache(MemoryAttachmentStore(max_bytes, ttl_seconds))
@@ -0,0 +1,7 @@
+"""
+Offline benchmark harness: a fake Groq server, an in-memory Firestore and a load
+driver, so the service can be measured without Groq or Firebase credentials.
+
+    python -m bench.run --endpoints chat,history --concurrency 1,16,64 --history 0,200
+    python -m bench.fake_groq --port 8090 --latency-ms 300 --rate-limit-ratio 0.05
+"""
@@ -0,0 +1,246 @@
+"""
+Stand-in for Groq's OpenAI-compatible chat completions endpoint.
+
+Point the app at it with GROQ_BASE_URL=http://127.0.0.1:<port> (the groq SDK reads
+it) and any GROQ_API_KEY. Responses take `latency` seconds before the first token
+and then arrive at `tokens_per_second`; a `rate_limit_ratio` share of calls is
+rejected with 429 and a Retry-After header, like a real per-minute limit.
+GET /stats returns request counters.
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COMPLETIONS_PATH = "/openai/v1/chat/completions"
+FILLER_WORDS = (
+    "the service answered with a clear and careful response that covers the question "
+    "step by step while keeping the explanation short enough to read quickly"
+).split()
+
+
+@dataclass
+class FakeGroqConfig:
+    latency: float = 0.3
+    latency_jitter: float = 0.1
+    tokens_per_second: float = 400.0
+    completion_tokens: int = 120
+    rate_limit_ratio: float = 0.0
+    retry_after: float = 1.0
+    seed: int = None
+
+
+class FakeGroqStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.streams = 0
+        self.rate_limited = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "streams": self.streams,
+                "rate_limited": self.rate_limited,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+            }
+
+
+def estimate_prompt_tokens(messages: list) -> int:
+    chars = 0
+    for msg in messages or []:
+        content = msg.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            # Vision parts: count text, charge a flat amount per image.
+            for part in content:
+                chars += len(part.get("text") or "") if part.get("type") == "text" else 4000
+    return max(1, chars // 4)
+
+
+def completion_words(count: int) -> list:
+    return [FILLER_WORDS[i % len(FILLER_WORDS)] for i in range(count)]
+
+
+class FakeGroqHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeGroq/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.server.stats.snapshot())
+        else:
+            self.send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path != COMPLETIONS_PATH:
+            self.send_json(404, {"error": {"message": "Not found"}})
+            return
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            self.send_json(400, {"error": {"message": "Invalid JSON", "type": "invalid_request_error"}})
+            return
+
+        config = self.server.config
+        stats = self.server.stats
+        with stats.lock:
+            stats.requests += 1
+            rate_limited = self.server.random.random() < config.rate_limit_ratio
+            if rate_limited:
+                stats.rate_limited += 1
+        if rate_limited:
+            self.send_json(
+                429,
+                {"error": {"message": "Rate limit reached (fake)", "type": "tokens", "code": "rate_limit_exceeded"}},
+                {"Retry-After": f"{config.retry_after:g}"},
+            )
+            return
+
+        model = payload.get("model") or "fake-model"
+        prompt_tokens = estimate_prompt_tokens(payload.get("messages"))
+        max_tokens = payload.get("max_tokens") or payload.get("max_completion_tokens") or config.completion_tokens
+        words = completion_words(max(1, min(int(max_tokens), config.completion_tokens)))
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(words),
+            "total_tokens": prompt_tokens + len(words),
+        }
+        with stats.lock:
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += len(words)
+            stats.streams += 1 if payload.get("stream") else 0
+
+        time.sleep(max(0.0, config.latency + self.server.random.uniform(-1, 1) * config.latency_jitter))
+        if payload.get("stream"):
+            self.stream_completion(model, words, usage)
+        else:
+            time.sleep(len(words) / config.tokens_per_second if config.tokens_per_second > 0 else 0)
+            self.send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": " ".join(words)},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+
+    def stream_completion(self, model: str, words: list, usage: dict):
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def chunk(delta: dict, finish_reason=None, **extra) -> dict:
+            return {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                **extra,
+            }
+
+        # Tokens are flushed in ~20ms slices so high token rates don't mean one write per token.
+        tokens_per_second = self.server.config.tokens_per_second
+        per_slice = max(1, int(tokens_per_second * 0.02)) if tokens_per_second > 0 else len(words)
+        events = [chunk({"role": "assistant", "content": ""})]
+        for start in range(0, len(words), per_slice):
+            piece = " ".join(words[start:start + per_slice])
+            events.append(chunk({"content": piece if start == 0 else " " + piece}))
+        events.append(chunk({}, "stop", x_groq={"id": completion_id, "usage": usage}))
+
+        for index, event in enumerate(events):
+            if 1 < index < len(events) - 1 and tokens_per_second > 0:
+                time.sleep(per_slice / tokens_per_second)
+            self.write_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+class FakeGroqServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, config: FakeGroqConfig):
+        super().__init__(address, FakeGroqHandler)
+        self.config = config
+        self.stats = FakeGroqStats()
+        self.random = random.Random(config.seed)
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-response (timeouts, cancelled hedges, app shutdown) are expected.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def serve(host: str, port: int, config: FakeGroqConfig, ready=None):
+    server = FakeGroqServer((host, port), config)
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Groq chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="time to first token")
+    parser.add_argument("--jitter-ms", type=float, default=100.0)
+    parser.add_argument("--tokens-per-second", type=float, default=400.0)
+    parser.add_argument("--completion-tokens", type=int, default=120)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="share of calls answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    config = FakeGroqConfig(
+        latency=args.latency_ms / 1000,
+        latency_jitter=args.jitter_ms / 1000,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        rate_limit_ratio=args.rate_limit_ratio,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    print(f"[FAKE GROQ] listening on http://{args.host}:{args.port}")
+    serve(args.host, args.port, config)
+
+
+if __name__ == "__main__":
+    main()
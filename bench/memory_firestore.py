@@ -0,0 +1,356 @@
+"""
+In-memory stand-in for the google-cloud-firestore client.
+
+Covers the surface FirestoreChatStore uses: document get/set(merge)/update/create/
+delete, ordered and projected queries with start_at/start_after cursors and
+limit, collection-group style recursive() queries, write batches, BulkWriter and
+recursive_delete. Documents are deep-copied in and out, like a real round trip,
+and an optional per-call `latency` stands in for network time.
+"""
+
+import copy
+import threading
+import time
+import uuid
+
+from google.api_core.exceptions import AlreadyExists, NotFound
+from google.cloud.firestore_v1 import DELETE_FIELD
+
+DOCUMENT_ID = "__name__"
+
+
+def apply_fields(target: dict, fields: dict) -> dict:
+    for key, value in fields.items():
+        if value is DELETE_FIELD:
+            target.pop(key, None)
+        else:
+            target[key] = copy.deepcopy(value)
+    return target
+
+
+class MemoryDocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self._data = data
+
+    @property
+    def id(self) -> str:
+        return self.reference.id
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field: str):
+        return (self._data or {}).get(field)
+
+
+class MemoryDocumentReference:
+    def __init__(self, client, path: tuple):
+        self.client = client
+        self.path = path
+
+    @property
+    def id(self) -> str:
+        return self.path[-1]
+
+    @property
+    def parent(self):
+        return MemoryCollectionReference(self.client, self.path[:-1])
+
+    def collection(self, name: str):
+        return MemoryCollectionReference(self.client, self.path + (name,))
+
+    def get(self, *args, **kwargs) -> MemoryDocumentSnapshot:
+        self.client.round_trip()
+        with self.client.lock:
+            return MemoryDocumentSnapshot(self, copy.deepcopy(self.client.read(self.path)))
+
+    def set(self, data: dict, merge: bool = False):
+        self.client.round_trip()
+        with self.client.lock:
+            self.client.write("set", self.path, data, merge)
+
+    def update(self, data: dict):
+        self.client.round_trip()
+        with self.client.lock:
+            self.client.check("update", self.path)
+            self.client.write("update", self.path, data)
+
+    def create(self, data: dict):
+        self.client.round_trip()
+        with self.client.lock:
+            self.client.check("create", self.path)
+            self.client.write("create", self.path, data)
+
+    def delete(self):
+        self.client.round_trip()
+        with self.client.lock:
+            self.client.remove(self.path)
+
+
+class MemoryQuery:
+    def __init__(self, client, parent_path: tuple, all_descendants=False, projection=None,
+                 orders=(), cursor=None, limit=None):
+        self.client = client
+        self.parent_path = parent_path
+        self.all_descendants = all_descendants
+        self.projection = projection
+        self.orders = orders
+        self.cursor = cursor
+        self.limit_count = limit
+
+    def _copy(self, **changes):
+        options = {
+            "all_descendants": self.all_descendants,
+            "projection": self.projection,
+            "orders": self.orders,
+            "cursor": self.cursor,
+            "limit": self.limit_count,
+        }
+        options.update(changes)
+        return MemoryQuery(self.client, self.parent_path, **options)
+
+    def recursive(self):
+        return self._copy(all_descendants=True)
+
+    def select(self, field_paths):
+        return self._copy(projection=tuple(field_paths))
+
+    def order_by(self, field: str, direction: str = "ASCENDING"):
+        return self._copy(orders=self.orders + ((field, direction),))
+
+    def limit(self, count: int):
+        return self._copy(limit=count)
+
+    def start_at(self, values):
+        return self._copy(cursor=(values, True))
+
+    def start_after(self, values):
+        return self._copy(cursor=(values, False))
+
+    def _effective_orders(self) -> tuple:
+        if any(field == DOCUMENT_ID for field, _ in self.orders):
+            return self.orders
+        return self.orders + ((DOCUMENT_ID, "ASCENDING"),)
+
+    def _sort_key(self, path: tuple, data: dict, orders: tuple) -> tuple:
+        return tuple(path if field == DOCUMENT_ID else data.get(field) for field, _ in orders)
+
+    def _cursor_key(self, orders: tuple) -> tuple:
+        values, _inclusive = self.cursor
+        if isinstance(values, MemoryDocumentSnapshot):
+            with self.client.lock:
+                data = self.client.read(values.reference.path) or {}
+            return self._sort_key(values.reference.path, data, orders)
+        key = []
+        for field, _ in orders:
+            if field not in values:
+                break
+            value = values[field]
+            if field == DOCUMENT_ID and isinstance(value, str):
+                value = self.parent_path + (value,)
+            key.append(value)
+        return tuple(key)
+
+    @staticmethod
+    def _compare(left: tuple, right: tuple, orders: tuple) -> int:
+        for a, b, (_, direction) in zip(left, right, orders):
+            if a != b:
+                result = -1 if a < b else 1
+                return -result if direction == "DESCENDING" else result
+        return 0
+
+    def stream(self, *args, **kwargs):
+        self.client.round_trip()
+        orders = self._effective_orders()
+        with self.client.lock:
+            rows = [
+                (path, data)
+                for path, data in self.client.iter_documents(self.parent_path, self.all_descendants)
+                if all(field == DOCUMENT_ID or field in data for field, _ in orders)
+            ]
+        # Stable multi-key sort, least significant key first.
+        for position in reversed(range(len(orders))):
+            field, direction = orders[position]
+            rows.sort(
+                key=lambda row: row[0] if field == DOCUMENT_ID else row[1][field],
+                reverse=direction == "DESCENDING",
+            )
+        if self.cursor is not None:
+            cursor_key = self._cursor_key(orders)
+            inclusive = self.cursor[1]
+            kept = []
+            for path, data in rows:
+                order = self._compare(self._sort_key(path, data, orders)[:len(cursor_key)], cursor_key, orders)
+                if order > 0 or (inclusive and order == 0):
+                    kept.append((path, data))
+            rows = kept
+        if self.limit_count is not None:
+            rows = rows[:self.limit_count]
+        for path, data in rows:
+            if self.projection is not None:
+                data = {field: data[field] for field in self.projection if field in data}
+            yield MemoryDocumentSnapshot(MemoryDocumentReference(self.client, path), copy.deepcopy(data))
+
+    def get(self, *args, **kwargs) -> list:
+        return list(self.stream())
+
+
+class MemoryCollectionReference(MemoryQuery):
+    def __init__(self, client, path: tuple):
+        super().__init__(client, path)
+
+    @property
+    def id(self) -> str:
+        return self.parent_path[-1]
+
+    @property
+    def parent(self):
+        if len(self.parent_path) < 2:
+            return None
+        return MemoryDocumentReference(self.client, self.parent_path[:-1])
+
+    def document(self, document_id: str = None) -> MemoryDocumentReference:
+        return MemoryDocumentReference(self.client, self.parent_path + (document_id or uuid.uuid4().hex[:20],))
+
+    def list_documents(self, *args, **kwargs) -> list:
+        # Like Firestore, ids that only have subcollections (no document data) are listed too.
+        depth = len(self.parent_path)
+        with self.client.lock:
+            ids = {
+                path[depth] for path, _data in self.client.iter_documents(self.parent_path, all_descendants=True)
+            }
+        return [self.document(document_id) for document_id in sorted(ids)]
+
+
+class MemoryWriteBatch:
+    def __init__(self, client):
+        self.client = client
+        self.operations = []
+
+    def create(self, reference, data: dict):
+        self.operations.append(("create", reference.path, data, False))
+
+    def set(self, reference, data: dict, merge: bool = False):
+        self.operations.append(("set", reference.path, data, merge))
+
+    def update(self, reference, data: dict):
+        self.operations.append(("update", reference.path, data, False))
+
+    def delete(self, reference):
+        self.operations.append(("delete", reference.path, None, False))
+
+    def commit(self):
+        """Apply every write or none of them."""
+        self.client.round_trip()
+        with self.client.lock:
+            for kind, path, _data, _merge in self.operations:
+                self.client.check(kind, path)
+            for kind, path, data, merge in self.operations:
+                self.client.write(kind, path, data, merge)
+        self.operations = []
+
+
+class MemoryBulkWriter:
+    def __init__(self, client):
+        self.client = client
+        self.pending = []
+        self.error_callback = None
+
+    def on_write_error(self, callback):
+        self.error_callback = callback
+
+    def delete(self, reference):
+        self.pending.append(reference.path)
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.client.round_trip()
+        with self.client.lock:
+            for path in self.pending:
+                self.client.remove(path)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+
+
+class MemoryFirestore:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        # collection path -> {document id: data}; callers hold `lock`.
+        self.collections = {}
+        self.lock = threading.RLock()
+
+    def round_trip(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def read(self, path: tuple):
+        return self.collections.get(path[:-1], {}).get(path[-1])
+
+    def remove(self, path: tuple):
+        documents = self.collections.get(path[:-1])
+        if documents is not None:
+            documents.pop(path[-1], None)
+            if not documents:
+                del self.collections[path[:-1]]
+
+    def iter_documents(self, collection_path: tuple, all_descendants: bool = False):
+        if not all_descendants:
+            for document_id, data in self.collections.get(collection_path, {}).items():
+                yield collection_path + (document_id,), data
+            return
+        depth = len(collection_path)
+        for path, documents in self.collections.items():
+            if path[:depth] == collection_path:
+                for document_id, data in documents.items():
+                    yield path + (document_id,), data
+
+    def check(self, kind: str, path: tuple):
+        if kind == "create" and self.read(path) is not None:
+            raise AlreadyExists(f"Document already exists: {'/'.join(path)}")
+        if kind == "update" and self.read(path) is None:
+            raise NotFound(f"No document to update: {'/'.join(path)}")
+
+    def write(self, kind: str, path: tuple, data: dict, merge: bool = False):
+        if kind == "delete":
+            self.remove(path)
+            return
+        documents = self.collections.setdefault(path[:-1], {})
+        if kind == "update" or (kind == "set" and merge):
+            documents[path[-1]] = apply_fields(documents.get(path[-1]) or {}, data)
+        else:
+            documents[path[-1]] = apply_fields({}, data)
+
+    def collection(self, name: str) -> MemoryCollectionReference:
+        return MemoryCollectionReference(self, (name,))
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        self.round_trip()
+        with self.lock:
+            snapshots = [MemoryDocumentSnapshot(ref, copy.deepcopy(self.read(ref.path))) for ref in references]
+        yield from snapshots
+
+    def batch(self) -> MemoryWriteBatch:
+        return MemoryWriteBatch(self)
+
+    def bulk_writer(self) -> MemoryBulkWriter:
+        return MemoryBulkWriter(self)
+
+    def recursive_delete(self, reference, bulk_writer=None) -> int:
+        self.round_trip()
+        with self.lock:
+            if isinstance(reference, MemoryDocumentReference):
+                doomed = [reference.path] if self.read(reference.path) is not None else []
+                doomed += [path for path, _data in self.iter_documents(reference.path, all_descendants=True)]
+            else:
+                doomed = [path for path, _data in self.iter_documents(reference.parent_path, all_descendants=True)]
+            for path in doomed:
+                self.remove(path)
+        return len(doomed)
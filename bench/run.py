@@ -0,0 +1,569 @@
+"""
+Load driver for the offline benchmark.
+
+Each scenario (endpoint x concurrency x history length) gets a fresh app process
+backed by the in-memory Firestore and pointed at the fake Groq server; the chats
+are seeded first, then `--requests` calls are made from `concurrency` keep-alive
+connections. Latency (to the last byte), time to first byte, throughput, the
+server's Server-Timing stages and the app process's memory are written as JSON:
+
+    python -m bench.run --endpoints chat,chat_stream,upload,chats,history \\
+        --concurrency 1,16,64 --history 0,200 --output bench_results.json
+    python -m bench.run ... --compare baseline.json --max-regression 0.15
+
+Endpoints: chat, chat_stream (SSE), batch (--batch-size prompts per request),
+upload, chats, history. --server asgi runs asgi.app under hypercorn instead of
+the threaded WSGI server.
+"""
+
+import argparse
+import http.client
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from bench.fake_groq import FakeGroqConfig, serve as serve_fake_groq
+
+ENDPOINTS = ("chat", "chat_stream", "batch", "upload", "chats", "history")
+RESULTS_VERSION = 1
+# Generous app-side Groq limits so the benchmark measures the service, not the
+# client-side pacing tuned for a free-tier key; override with --env.
+APP_ENV_DEFAULTS = {
+    "GROQ_RPM": "1000000",
+    "GROQ_TPM": "1000000000",
+    "GROQ_MAX_CONCURRENCY": "256",
+    "ADMISSION_USER_MAX_IN_FLIGHT": "0",
+    "ADMISSION_USER_RPM": "0",
+    "WARMUP_ON_START": "0",
+}
+SEED_TEXT = (
+    "Here is a reasonably long chat message used to seed history for the benchmark, "
+    "roughly the size of a typical question or a short answer in a real conversation. "
+)
+
+
+# =========================
+# APP PROCESS
+# =========================
+
+def seed_chats(store, users: int, sessions: int, history_length: int):
+    base = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for user_index in range(users):
+        for session_index in range(sessions):
+            timestamp = (base + timedelta(minutes=session_index)).isoformat().replace("+00:00", "Z")
+            messages = [
+                {
+                    "index": index,
+                    "role": "user" if index % 2 == 0 else "assistant",
+                    "content": f"{index}: {SEED_TEXT}",
+                    "created_at": timestamp,
+                }
+                for index in range(history_length)
+            ]
+            session_id = f"bench-{session_index}"
+            store.append_messages(f"user-{user_index}", session_id, messages, {
+                "id": session_id,
+                "user_id": f"user-{user_index}",
+                "message_count": history_length,
+                "preview": SEED_TEXT[:90],
+                "title": f"Benchmark chat {session_index}",
+                "title_pending": False,
+                "created_at": timestamp,
+                "updated_at": timestamp,
+            })
+
+
+def serve_app(options: dict, ready):
+    """Child process: seed an in-memory Firestore, then serve the app on options["port"]."""
+    os.environ.update(options["env"])
+    if not options["verbose"]:
+        sys.stdout = open(os.devnull, "w")
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    import app as red
+    from bench.memory_firestore import MemoryFirestore
+    from chat_store import AsyncChatStore, FirestoreChatStore
+
+    store = FirestoreChatStore(MemoryFirestore(latency=options["firestore_latency"]))
+    red.chat_store._value = store
+    seed_chats(store, options["users"], options["sessions"], options["history"])
+
+    if options["server"] == "asgi":
+        import asyncio
+
+        from hypercorn.asyncio import serve
+        from hypercorn.config import Config
+
+        import asgi
+
+        asgi.async_chat_store._value = AsyncChatStore(store)
+        config = Config()
+        config.bind = [f"127.0.0.1:{options['port']}"]
+        config.accesslog = None
+        config.errorlog = None
+        ready.put(os.getpid())
+        asyncio.run(serve(asgi.app, config))
+    else:
+        from werkzeug.serving import make_server
+
+        server = make_server("127.0.0.1", options["port"], red.app, threaded=True)
+        server.socket.listen(1024)
+        ready.put(os.getpid())
+        server.serve_forever()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_healthy(port: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            connection.request("GET", "/health")
+            if connection.getresponse().status == 200:
+                connection.close()
+                return
+        except OSError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"App did not become healthy on port {port}")
+        time.sleep(0.05)
+
+
+def process_memory_mb(pid: int) -> dict:
+    """Resident and peak resident memory of a process (Linux /proc only)."""
+    values = {}
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                name, _, rest = line.partition(":")
+                if name in {"VmRSS", "VmHWM"}:
+                    values[name] = round(int(rest.split()[0]) / 1024, 1)
+    except OSError:
+        return {"rss": None, "peak": None}
+    return {"rss": values.get("VmRSS"), "peak": values.get("VmHWM")}
+
+
+# =========================
+# LOAD GENERATION
+# =========================
+
+def encode_multipart(fields: dict, file_name: str, file_bytes: bytes):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{file_name}"\r\n'
+        f"Content-Type: text/plain\r\n\r\n".encode()
+    )
+    parts.append(file_bytes + f"\r\n--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def build_request(endpoint: str, number: int, options: dict):
+    """(method, path, body, headers, response format) for request `number` of a scenario."""
+    user_id = f"user-{number % options['users']}"
+    if options["history"] > 0:
+        session_id = f"bench-{(number // options['users']) % options['sessions']}"
+    else:
+        session_id = f"bench-new-{number}"
+    headers = {"X-User-Id": user_id}
+
+    if endpoint in {"chat", "chat_stream"}:
+        body = json.dumps({"prompt": f"Question {number}: how do I profile a slow web request?",
+                           "session_id": session_id}).encode()
+        headers.update({"Content-Type": "application/json", "X-Session-Id": session_id})
+        if endpoint == "chat_stream":
+            headers["Accept"] = "text/event-stream"
+        return "POST", "/api/chat", body, headers, "sse" if endpoint == "chat_stream" else "json"
+    if endpoint == "batch":
+        items = [
+            {"prompt": f"Question {number}.{index}: what is a good cache eviction policy?", "id": str(index)}
+            for index in range(options["batch_size"])
+        ]
+        # Half the items are stored (each in a new chat) so batched storage writes are exercised too.
+        for item in items[::2]:
+            item["session_id"] = f"batch-{number}-{item['id']}"
+        headers["Content-Type"] = "application/json"
+        return "POST", "/api/chat/batch", json.dumps({"items": items}).encode(), headers, "ndjson"
+    if endpoint == "upload":
+        # A unique first line keeps every upload out of the attachment cache.
+        text = f"Report {number} {uuid.uuid4().hex}\n".encode() + b"x" * (options["upload_kb"] * 1024)
+        body, content_type = encode_multipart(
+            {"prompt": "Summarize this file", "session_id": session_id}, f"report-{number}.txt", text
+        )
+        headers["Content-Type"] = content_type
+        return "POST", "/api/chat/upload", body, headers, "json"
+    if endpoint == "chats":
+        return "GET", "/api/chats?limit=30", None, headers, "json"
+    if endpoint == "history":
+        body = json.dumps({"session_id": f"bench-{number % options['sessions']}", "limit": 50}).encode()
+        headers["Content-Type"] = "application/json"
+        return "POST", "/api/chat/history", body, headers, "json"
+    raise ValueError(f"Unknown endpoint: {endpoint}")
+
+
+def parse_server_timing(header: str) -> dict:
+    stages = {}
+    for entry in (header or "").split(","):
+        name, _, params = entry.strip().partition(";")
+        if name and params.startswith("dur="):
+            try:
+                stages[name] = float(params[4:])
+            except ValueError:
+                pass
+    return stages
+
+
+def response_ok(status: int, body: bytes, body_format: str) -> bool:
+    if status != 200:
+        return False
+    if body_format == "sse":
+        return b"event: done" in body
+    try:
+        if body_format == "ndjson":
+            last = json.loads(body.strip().splitlines()[-1])
+            return bool(last.get("done")) and not last.get("failed")
+        return bool(json.loads(body).get("success"))
+    except ValueError:
+        return False
+
+
+def drive(port: int, endpoint: str, concurrency: int, total: int, options: dict, first_number: int = 0) -> list:
+    """Issue `total` requests from `concurrency` threads; returns one sample dict per request."""
+    numbers = itertools.count(first_number)
+    last_number = first_number + total
+    numbers_lock = threading.Lock()
+    samples = []
+    samples_lock = threading.Lock()
+
+    def worker():
+        connection = None
+        local = []
+        while True:
+            with numbers_lock:
+                number = next(numbers)
+            if number >= last_number:
+                break
+            method, path, body, headers, body_format = build_request(endpoint, number, options)
+            started = time.perf_counter()
+            try:
+                if connection is None:
+                    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=options["timeout"])
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                first_byte = time.perf_counter()
+                payload = response.read()
+                finished = time.perf_counter()
+                if response.getheader("Connection", "").lower() == "close":
+                    connection.close()
+                    connection = None
+                local.append({
+                    "latency": finished - started,
+                    "ttfb": first_byte - started,
+                    "status": response.status,
+                    "ok": response_ok(response.status, payload, body_format),
+                    "stages": parse_server_timing(response.getheader("Server-Timing")),
+                })
+            except (OSError, http.client.HTTPException) as e:
+                if connection is not None:
+                    connection.close()
+                connection = None
+                local.append({
+                    "latency": time.perf_counter() - started,
+                    "ttfb": None,
+                    "status": type(e).__name__,
+                    "ok": False,
+                    "stages": {},
+                })
+        if connection is not None:
+            connection.close()
+        with samples_lock:
+            samples.extend(local)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+# =========================
+# REPORTING
+# =========================
+
+def percentile(sorted_values: list, pct: float):
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def distribution_ms(values: list) -> dict:
+    values = sorted(v * 1000 for v in values if v is not None)
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    return {
+        "p50": round(percentile(values, 50), 2),
+        "p95": round(percentile(values, 95), 2),
+        "p99": round(percentile(values, 99), 2),
+        "mean": round(sum(values) / len(values), 2),
+        "max": round(values[-1], 2),
+    }
+
+
+def summarize(samples: list, elapsed: float) -> dict:
+    status_counts = {}
+    stage_totals = {}
+    for sample in samples:
+        status_counts[str(sample["status"])] = status_counts.get(str(sample["status"]), 0) + 1
+        for name, duration in sample["stages"].items():
+            total, count = stage_totals.get(name, (0.0, 0))
+            stage_totals[name] = (total + duration, count + 1)
+    ok = sum(1 for sample in samples if sample["ok"])
+    return {
+        "requests": len(samples),
+        "ok": ok,
+        "errors": len(samples) - ok,
+        "status_counts": status_counts,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed > 0 else None,
+        "latency_ms": distribution_ms([sample["latency"] for sample in samples]),
+        "ttfb_ms": distribution_ms([sample["ttfb"] for sample in samples]),
+        "server_timing_mean_ms": {
+            name: round(total / count, 2) for name, (total, count) in sorted(stage_totals.items())
+        },
+    }
+
+
+def fetch_fake_groq_stats(port: int) -> dict:
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    try:
+        connection.request("GET", "/stats")
+        return json.loads(connection.getresponse().read())
+    finally:
+        connection.close()
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(current: dict, baseline: dict, max_regression: float) -> list:
+    """Print p50/p95/p99 and throughput changes per scenario; returns the regressed scenario names."""
+    baseline_scenarios = {scenario["name"]: scenario for scenario in baseline.get("scenarios", [])}
+    regressions = []
+    for scenario in current["scenarios"]:
+        before = baseline_scenarios.get(scenario["name"])
+        if before is None:
+            continue
+        changes = []
+        for key in ("p50", "p95", "p99"):
+            old, new = before["latency_ms"][key], scenario["latency_ms"][key]
+            if old and new is not None:
+                changes.append(f"{key} {old:.0f}->{new:.0f}ms ({(new - old) / old:+.0%})")
+        old_rps, new_rps = before["throughput_rps"], scenario["throughput_rps"]
+        if old_rps and new_rps is not None:
+            changes.append(f"rps {old_rps:.1f}->{new_rps:.1f} ({(new_rps - old_rps) / old_rps:+.0%})")
+        regressed = max_regression is not None and (
+            (before["latency_ms"]["p95"] and scenario["latency_ms"]["p95"] is not None
+             and scenario["latency_ms"]["p95"] > before["latency_ms"]["p95"] * (1 + max_regression))
+            or (old_rps and new_rps is not None and new_rps < old_rps * (1 - max_regression))
+        )
+        if regressed:
+            regressions.append(scenario["name"])
+        print(f"[COMPARE] {scenario['name']}: {', '.join(changes)}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+# =========================
+# SCENARIOS
+# =========================
+
+def run_scenario(endpoint: str, concurrency: int, history: int, args, groq_port: int) -> dict:
+    port = free_port()
+    options = {
+        "port": port,
+        "server": args.server,
+        "users": args.users,
+        "sessions": args.sessions,
+        "history": history,
+        "upload_kb": args.upload_kb,
+        "batch_size": args.batch_size,
+        "timeout": args.timeout,
+        "firestore_latency": args.firestore_latency_ms / 1000,
+        "verbose": args.verbose,
+        "env": {
+            **APP_ENV_DEFAULTS,
+            **args.env,
+            "GROQ_API_KEY": "bench",
+            "GROQ_BASE_URL": f"http://127.0.0.1:{groq_port}",
+        },
+    }
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    process = context.Process(target=serve_app, args=(options, ready), daemon=True)
+    process.start()
+    try:
+        pid = ready.get(timeout=60)
+        wait_until_healthy(port)
+        drive(port, endpoint, concurrency, args.warmup if args.warmup is not None else concurrency, options,
+              first_number=10 ** 6)
+        memory_before = process_memory_mb(pid)
+        groq_before = fetch_fake_groq_stats(groq_port)
+        started = time.perf_counter()
+        samples = drive(port, endpoint, concurrency, args.requests, options)
+        elapsed = time.perf_counter() - started
+        memory_after = process_memory_mb(pid)
+        groq_after = fetch_fake_groq_stats(groq_port)
+    finally:
+        process.terminate()
+        process.join(10)
+
+    result = {
+        "name": f"{endpoint}/c{concurrency}/h{history}",
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "history": history,
+        **summarize(samples, elapsed),
+        "memory_mb": {
+            "rss_before": memory_before["rss"],
+            "rss_after": memory_after["rss"],
+            "peak": memory_after["peak"],
+        },
+        "fake_groq": {key: groq_after[key] - groq_before.get(key, 0) for key in groq_after},
+    }
+    latency = result["latency_ms"]
+    print(
+        f"[BENCH] {result['name']}: {result['throughput_rps']} req/s, "
+        f"p50 {latency['p50']}ms p95 {latency['p95']}ms p99 {latency['p99']}ms, "
+        f"errors {result['errors']}/{result['requests']}, rss {result['memory_mb']['rss_after']} MB"
+    )
+    return result
+
+
+def parse_int_list(value: str) -> list:
+    return [int(part) for part in value.split(",") if part.strip()]
+
+
+def parse_env(values: list) -> dict:
+    env = {}
+    for item in values or []:
+        name, sep, value = item.partition("=")
+        if not sep:
+            raise argparse.ArgumentTypeError(f"--env expects NAME=VALUE, got {item!r}")
+        env[name] = value
+    return env
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmark for the chat API")
+    parser.add_argument("--endpoints", default="chat,upload,chats,history",
+                        help=f"comma-separated, from: {', '.join(ENDPOINTS)}")
+    parser.add_argument("--concurrency", default="1,16", help="comma-separated client concurrency levels")
+    parser.add_argument("--history", default="0,100", help="comma-separated seeded history lengths")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=None, help="unmeasured requests first (default: concurrency)")
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--sessions", type=int, default=20, help="seeded chats per user")
+    parser.add_argument("--upload-kb", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=20, help="prompts per /api/chat/batch request")
+    parser.add_argument("--server", choices=("wsgi", "asgi"), default="wsgi")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="fake Groq time to first token")
+    parser.add_argument("--jitter-ms", type=float, default=50.0)
+    parser.add_argument("--tokens-per-second", type=float, default=400.0)
+    parser.add_argument("--completion-tokens", type=int, default=120)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="share of Groq calls answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--firestore-latency-ms", type=float, default=0.0, help="simulated Firestore round trip")
+    parser.add_argument("--env", action="append", metavar="NAME=VALUE", help="extra app environment (repeatable)")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", metavar="BASELINE_JSON")
+    parser.add_argument("--max-regression", type=float, default=None,
+                        help="with --compare: fail if p95 grows or throughput drops by more than this fraction")
+    parser.add_argument("--verbose", action="store_true", help="show the app's own output")
+    args = parser.parse_args(argv)
+    args.env = parse_env(args.env)
+
+    endpoints = [name.strip() for name in args.endpoints.split(",") if name.strip()]
+    unknown = sorted(set(endpoints) - set(ENDPOINTS))
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(unknown)}")
+
+    groq_config = FakeGroqConfig(
+        latency=args.latency_ms / 1000,
+        latency_jitter=args.jitter_ms / 1000,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        rate_limit_ratio=args.rate_limit_ratio,
+        retry_after=args.retry_after,
+        seed=1,
+    )
+    context = multiprocessing.get_context("spawn")
+    groq_ready = context.Queue()
+    groq_process = context.Process(target=serve_fake_groq, args=("127.0.0.1", 0, groq_config, groq_ready), daemon=True)
+    groq_process.start()
+    try:
+        groq_port = groq_ready.get(timeout=30)
+        scenarios = [
+            run_scenario(endpoint, concurrency, history, args, groq_port)
+            for endpoint in endpoints
+            for history in parse_int_list(args.history)
+            for concurrency in parse_int_list(args.concurrency)
+        ]
+    finally:
+        groq_process.terminate()
+        groq_process.join(10)
+
+    results = {
+        "version": RESULTS_VERSION,
+        "created_at": datetime.now(timezone.utc).replace(microsecond=0).isoformat().replace("+00:00", "Z"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            key: value for key, value in vars(args).items()
+            if key not in {"output", "compare", "max_regression", "verbose"}
+        },
+        "scenarios": scenarios,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"[BENCH] wrote {len(scenarios)} scenarios to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(results, json.load(f), args.max_regression)
+        if regressions:
+            print(f"[BENCH] regressions: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,554 @@
+"""
+Chat persistence behind one small interface.
+
+The app only talks to a ChatStore: read chat metadata, read a range of
+messages, append a turn, patch metadata, list chats, delete one chat and
+clear a user's chats. Two backends ship with it: Firestore (the original
+layout, users/{uid}/chats/{sid}/messages/{index}) and a local SQLite file in
+WAL mode for single-node deployments and offline runs.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+
+# firebase-admin is imported by FirestoreChatStore itself, so the SQLite backend
+# neither needs the package nor pays its (sizeable) import time.
+
+
+class AppendConflict(Exception):
+    """append_messages() found one of the turn's message indexes already taken (another writer got there first)."""
+
+
+class ChatStore:
+    """
+    Chats are metadata dicts (id, user_id, title, message_count, updated_at, ...);
+    messages are {"index", "role", "content", "created_at"} with contiguous indexes.
+    """
+
+    def get_chat(self, user_id: str, session_id: str) -> dict:
+        """Return the chat metadata, or {} when the chat does not exist."""
+        raise NotImplementedError
+
+    def get_chats(self, user_id: str, session_ids: list) -> dict:
+        """Return {session_id: metadata or {}} for several chats, in as few reads as possible."""
+        return {session_id: self.get_chat(user_id, session_id) for session_id in session_ids}
+
+    def fetch_messages(self, user_id: str, session_id: str, start: int, end: int) -> list:
+        """Return messages with start <= index < end, oldest first."""
+        raise NotImplementedError
+
+    def append_messages(self, user_id: str, session_id: str, messages: list, chat_fields: dict):
+        """
+        Atomically insert new messages and merge `chat_fields` into the chat
+        (creating it). Raises AppendConflict if one of the message indexes is
+        already taken, in which case nothing was written.
+        """
+        raise NotImplementedError
+
+    def append_turns(self, turns: list) -> list:
+        """
+        append_messages() for several (user_id, session_id, messages, chat_fields)
+        tuples with as few commits as possible; each turn still lands atomically.
+        Returns the turns that could not be written.
+        """
+        failed = []
+        for turn in turns:
+            try:
+                self.append_messages(*turn)
+            except Exception as e:
+                print(f"[CHAT STORE] append failed for {turn[1]}: {e}")
+                failed.append(turn)
+        return failed
+
+    def update_chat(self, user_id: str, session_id: str, fields: dict) -> bool:
+        """Merge `fields` into an existing chat; returns False if the chat is gone."""
+        raise NotImplementedError
+
+    def list_chats(self, user_id: str, fields: list, limit: int, after=None) -> list:
+        """
+        Return up to `limit` chats, newest `updated_at` first (ties by id, descending),
+        projected to `fields` plus "id". `after` is an (updated_at, id) cursor.
+        """
+        raise NotImplementedError
+
+    def delete_chat(self, user_id: str, session_id: str):
+        """Delete a chat and everything stored under it. Returns (documents_deleted, failed)."""
+        raise NotImplementedError
+
+    def iter_clear(self, user_id: str, page_size: int):
+        """
+        Delete every chat of a user, yielding
+        {"chats_deleted", "documents_deleted", "failed"} after each page.
+        """
+        raise NotImplementedError
+
+    def migrate_legacy_chat(self, user_id: str, session_id: str, chat: dict) -> dict:
+        """Move a legacy `history` array into messages; returns the migrated metadata."""
+        return chat
+
+    def iter_legacy_chats(self):
+        """Yield (user_id, session_id, chat) for chats still in the legacy layout."""
+        return iter(())
+
+
+def message_doc_id(index: int) -> str:
+    # Zero-padded so document ids sort in message order.
+    return f"{index:08d}"
+
+
+class FirestoreChatStore(ChatStore):
+    def __init__(self, db, batch_limit: int = 450, bulk_write_max_attempts: int = 5):
+        from firebase_admin import firestore
+        from google.api_core.exceptions import Conflict, NotFound
+        from google.cloud.firestore_v1.field_path import FieldPath
+
+        self.firestore = firestore
+        self.not_found_error = NotFound
+        # AlreadyExists (from batch.create) is a Conflict.
+        self.conflict_error = Conflict
+        self.field_path = FieldPath
+        self.db = db
+        self.batch_limit = batch_limit
+        self.bulk_write_max_attempts = bulk_write_max_attempts
+
+    def chats_collection(self, user_id: str):
+        return self.db.collection("users").document(user_id).collection("chats")
+
+    def chat_doc_ref(self, user_id: str, session_id: str):
+        return self.chats_collection(user_id).document(session_id)
+
+    def messages_collection(self, user_id: str, session_id: str):
+        return self.chat_doc_ref(user_id, session_id).collection("messages")
+
+    def get_chat(self, user_id: str, session_id: str) -> dict:
+        doc = self.chat_doc_ref(user_id, session_id).get()
+        return (doc.to_dict() or {}) if doc.exists else {}
+
+    def get_chats(self, user_id: str, session_ids: list) -> dict:
+        # One BatchGetDocuments call instead of a round trip per chat.
+        chats = {session_id: {} for session_id in session_ids}
+        refs = [self.chat_doc_ref(user_id, session_id) for session_id in chats]
+        for doc in self.db.get_all(refs) if refs else ():
+            if doc.exists:
+                chats[doc.id] = doc.to_dict() or {}
+        return chats
+
+    def fetch_messages(self, user_id: str, session_id: str, start: int, end: int) -> list:
+        docs = (
+            self.messages_collection(user_id, session_id)
+            .order_by("index")
+            .start_at({"index": start})
+            .limit(end - start)
+        )
+        return [doc.to_dict() or {} for doc in docs.stream()]
+
+    def append_messages(self, user_id: str, session_id: str, messages: list, chat_fields: dict):
+        batch = self.db.batch()
+        self._add_turn(batch, user_id, session_id, messages, chat_fields)
+        try:
+            batch.commit()
+        except self.conflict_error as e:
+            raise AppendConflict(str(e)) from e
+
+    def _add_turn(self, batch, user_id: str, session_id: str, messages: list, chat_fields: dict):
+        # create() fails instead of overwriting if a concurrent turn took the same index.
+        collection = self.messages_collection(user_id, session_id)
+        for msg in messages:
+            batch.create(collection.document(message_doc_id(msg["index"])), msg)
+        # Merge so a title written by the background job is never clobbered by a later turn.
+        batch.set(self.chat_doc_ref(user_id, session_id), chat_fields, merge=True)
+
+    def append_turns(self, turns: list) -> list:
+        # Whole turns are packed into batches of up to batch_limit writes; a failed
+        # commit fails only the turns it carried.
+        failed = []
+        chunks = []
+        chunk, writes = [], 0
+        for turn in turns:
+            turn_writes = len(turn[2]) + 1
+            if chunk and writes + turn_writes > self.batch_limit:
+                chunks.append(chunk)
+                chunk, writes = [], 0
+            chunk.append(turn)
+            writes += turn_writes
+        if chunk:
+            chunks.append(chunk)
+
+        for chunk in chunks:
+            batch = self.db.batch()
+            for turn in chunk:
+                self._add_turn(batch, *turn)
+            try:
+                batch.commit()
+            except Exception as e:
+                print(f"[CHAT STORE] batch of {len(chunk)} turns failed: {e}")
+                failed.extend(chunk)
+        return failed
+
+    def update_chat(self, user_id: str, session_id: str, fields: dict) -> bool:
+        # update() rather than set(): a chat deleted in the meantime must stay deleted.
+        try:
+            self.chat_doc_ref(user_id, session_id).update(fields)
+            return True
+        except self.not_found_error:
+            return False
+
+    def list_chats(self, user_id: str, fields: list, limit: int, after=None) -> list:
+        query = (
+            self.chats_collection(user_id)
+            .select(fields)
+            .order_by("updated_at", direction=self.firestore.Query.DESCENDING)
+            .order_by("__name__", direction=self.firestore.Query.DESCENDING)
+        )
+        if after is not None:
+            query = query.start_after({"updated_at": after[0], "__name__": after[1]})
+        return [{**(doc.to_dict() or {}), "id": doc.id} for doc in query.limit(limit).stream()]
+
+    def new_bulk_writer(self, failures: list):
+        """BulkWriter (parallel batched commits) that records writes still failing after a few retries."""
+        bulk_writer = self.db.bulk_writer()
+
+        def on_write_error(failure, _bulk_writer):
+            if failure.attempts < self.bulk_write_max_attempts:
+                return True
+            failures.append(failure.message)
+            return False
+
+        bulk_writer.on_write_error(on_write_error)
+        return bulk_writer
+
+    def delete_chat(self, user_id: str, session_id: str):
+        failures = []
+        documents_deleted = self.db.recursive_delete(
+            self.chat_doc_ref(user_id, session_id), bulk_writer=self.new_bulk_writer(failures)
+        )
+        return documents_deleted, len(failures)
+
+    def iter_clear(self, user_id: str, page_size: int):
+        # Documents (chats and every descendant) are listed id-only, page by page,
+        # and deleted through one BulkWriter.
+        failures = []
+        bulk_writer = self.new_bulk_writer(failures)
+        progress = {"chats_deleted": 0, "documents_deleted": 0, "failed": 0}
+        query = self.chats_collection(user_id).recursive().select([self.field_path.document_id()]).limit(page_size)
+        last_snapshot = None
+        try:
+            while True:
+                page_query = query.start_after(last_snapshot) if last_snapshot is not None else query
+                page = list(page_query.stream())
+                for snapshot in page:
+                    bulk_writer.delete(snapshot.reference)
+                    progress["documents_deleted"] += 1
+                    # users/{uid}/chats/{sid} is a chat; anything deeper is a descendant.
+                    if snapshot.reference.parent.id == "chats":
+                        progress["chats_deleted"] += 1
+                if len(page) < page_size:
+                    break
+                last_snapshot = page[-1]
+                bulk_writer.flush()
+                progress["failed"] = len(failures)
+                yield dict(progress)
+        finally:
+            bulk_writer.close()
+        progress["failed"] = len(failures)
+        yield dict(progress)
+
+    def migrate_legacy_chat(self, user_id: str, session_id: str, chat: dict) -> dict:
+        history = chat.get("history") or []
+        timestamp = chat.get("updated_at") or chat.get("created_at")
+        collection = self.messages_collection(user_id, session_id)
+        for batch_start in range(0, len(history), self.batch_limit):
+            batch = self.db.batch()
+            for index, msg in enumerate(history[batch_start:batch_start + self.batch_limit], start=batch_start):
+                batch.set(
+                    collection.document(message_doc_id(index)),
+                    {
+                        "index": index,
+                        "role": msg.get("role") or "assistant",
+                        "content": msg.get("content") or "",
+                        "created_at": msg.get("created_at") or timestamp,
+                    },
+                )
+            batch.commit()
+
+        # Message docs are written first, so an interrupted migration is simply retried.
+        self.chat_doc_ref(user_id, session_id).update(
+            {"history": self.firestore.DELETE_FIELD, "message_count": len(history)}
+        )
+        migrated = {k: v for k, v in chat.items() if k != "history"}
+        migrated["message_count"] = len(history)
+        return migrated
+
+    def iter_legacy_chats(self):
+        for user_ref in self.db.collection("users").list_documents():
+            for doc in user_ref.collection("chats").stream():
+                chat = doc.to_dict() or {}
+                if "history" in chat:
+                    yield user_ref.id, doc.id, chat
+
+
+class SQLiteChatStore(ChatStore):
+    """
+    Single-file store in WAL mode. Chat metadata is a JSON document per row (so
+    merges behave like Firestore's set(merge=True)); messages are append-only rows.
+    Each thread keeps its own connection.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chats (
+            user_id TEXT NOT NULL,
+            id TEXT NOT NULL,
+            updated_at TEXT NOT NULL DEFAULT '',
+            data TEXT NOT NULL,
+            PRIMARY KEY (user_id, id)
+        );
+        CREATE INDEX IF NOT EXISTS chats_by_updated ON chats (user_id, updated_at DESC, id DESC);
+        CREATE TABLE IF NOT EXISTS messages (
+            user_id TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TEXT,
+            PRIMARY KEY (user_id, chat_id, idx)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: str, busy_timeout_ms: int = 5000):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(self.SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit; write paths open explicit transactions.
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=self.busy_timeout_ms / 1000)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+            self._local.conn = conn
+        return conn
+
+    def _write(self):
+        return _Transaction(self._connection())
+
+    def get_chat(self, user_id: str, session_id: str) -> dict:
+        row = self._connection().execute(
+            "SELECT data FROM chats WHERE user_id = ? AND id = ?", (user_id, session_id)
+        ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def get_chats(self, user_id: str, session_ids: list) -> dict:
+        chats = {session_id: {} for session_id in session_ids}
+        ids = list(chats)
+        # Stay well under SQLite's bound-parameter limit.
+        for start in range(0, len(ids), 500):
+            page = ids[start:start + 500]
+            rows = self._connection().execute(
+                f"SELECT id, data FROM chats WHERE user_id = ? AND id IN ({','.join('?' * len(page))})",
+                [user_id, *page],
+            )
+            for chat_id, data in rows:
+                chats[chat_id] = json.loads(data)
+        return chats
+
+    def fetch_messages(self, user_id: str, session_id: str, start: int, end: int) -> list:
+        rows = self._connection().execute(
+            "SELECT idx, role, content, created_at FROM messages"
+            " WHERE user_id = ? AND chat_id = ? AND idx >= ? AND idx < ? ORDER BY idx",
+            (user_id, session_id, start, end),
+        ).fetchall()
+        return [
+            {"index": idx, "role": role, "content": content, "created_at": created_at}
+            for idx, role, content, created_at in rows
+        ]
+
+    def _merge_chat(self, conn, user_id: str, session_id: str, fields: dict, create: bool) -> bool:
+        row = conn.execute("SELECT data FROM chats WHERE user_id = ? AND id = ?", (user_id, session_id)).fetchone()
+        if row is None and not create:
+            return False
+        chat = {**(json.loads(row[0]) if row else {}), **fields}
+        conn.execute(
+            "INSERT INTO chats (user_id, id, updated_at, data) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (user_id, id) DO UPDATE SET updated_at = excluded.updated_at, data = excluded.data",
+            (user_id, session_id, chat.get("updated_at") or "", json.dumps(chat)),
+        )
+        return True
+
+    def append_messages(self, user_id: str, session_id: str, messages: list, chat_fields: dict):
+        try:
+            with self._write() as conn:
+                self._insert_turn(conn, user_id, session_id, messages, chat_fields)
+        except sqlite3.IntegrityError as e:
+            raise AppendConflict(str(e)) from e
+
+    def append_turns(self, turns: list) -> list:
+        # One transaction; a savepoint per turn lets a conflicting turn fail alone.
+        failed = []
+        with self._write() as conn:
+            for turn in turns:
+                conn.execute("SAVEPOINT turn")
+                try:
+                    self._insert_turn(conn, *turn)
+                except sqlite3.Error as e:
+                    print(f"[CHAT STORE] append failed for {turn[1]}: {e}")
+                    conn.execute("ROLLBACK TO turn")
+                    failed.append(turn)
+                conn.execute("RELEASE turn")
+        return failed
+
+    def _insert_turn(self, conn, user_id: str, session_id: str, messages: list, chat_fields: dict):
+        # Plain INSERT: a concurrent turn that took the same index raises IntegrityError.
+        conn.executemany(
+            "INSERT INTO messages (user_id, chat_id, idx, role, content, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    user_id,
+                    session_id,
+                    msg["index"],
+                    msg.get("role") or "assistant",
+                    msg.get("content") or "",
+                    msg.get("created_at"),
+                )
+                for msg in messages
+            ],
+        )
+        self._merge_chat(conn, user_id, session_id, chat_fields, create=True)
+
+    def update_chat(self, user_id: str, session_id: str, fields: dict) -> bool:
+        with self._write() as conn:
+            return self._merge_chat(conn, user_id, session_id, fields, create=False)
+
+    def list_chats(self, user_id: str, fields: list, limit: int, after=None) -> list:
+        sql = "SELECT id, data FROM chats WHERE user_id = ?"
+        params = [user_id]
+        if after is not None:
+            sql += " AND (updated_at < ? OR (updated_at = ? AND id < ?))"
+            params += [after[0] or "", after[0] or "", after[1]]
+        sql += " ORDER BY updated_at DESC, id DESC LIMIT ?"
+        params.append(limit)
+        chats = []
+        for chat_id, data in self._connection().execute(sql, params):
+            chat = json.loads(data)
+            chats.append({**{field: chat.get(field) for field in fields}, "id": chat_id})
+        return chats
+
+    def delete_chat(self, user_id: str, session_id: str):
+        with self._write() as conn:
+            messages = conn.execute(
+                "DELETE FROM messages WHERE user_id = ? AND chat_id = ?", (user_id, session_id)
+            ).rowcount
+            chats = conn.execute("DELETE FROM chats WHERE user_id = ? AND id = ?", (user_id, session_id)).rowcount
+        return messages + chats, 0
+
+    def iter_clear(self, user_id: str, page_size: int):
+        # Local deletes are cheap; one transaction keeps the clear all-or-nothing.
+        with self._write() as conn:
+            messages = conn.execute("DELETE FROM messages WHERE user_id = ?", (user_id,)).rowcount
+            chats = conn.execute("DELETE FROM chats WHERE user_id = ?", (user_id,)).rowcount
+        yield {"chats_deleted": chats, "documents_deleted": messages + chats, "failed": 0}
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK around a block, yielding the connection."""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        return False
+
+
+class AsyncChatStore:
+    """
+    The request-path subset of ChatStore for the async (ASGI) app. This default runs
+    the sync store's calls in worker threads, which is the right thing for SQLite.
+    """
+
+    def __init__(self, store: ChatStore):
+        self.store = store
+
+    async def get_chat(self, user_id: str, session_id: str) -> dict:
+        return await asyncio.to_thread(self.store.get_chat, user_id, session_id)
+
+    async def fetch_messages(self, user_id: str, session_id: str, start: int, end: int) -> list:
+        return await asyncio.to_thread(self.store.fetch_messages, user_id, session_id, start, end)
+
+    async def append_messages(self, user_id: str, session_id: str, messages: list, chat_fields: dict):
+        await asyncio.to_thread(self.store.append_messages, user_id, session_id, messages, chat_fields)
+
+
+class AsyncFirestoreChatStore(AsyncChatStore):
+    """Same reads and writes as FirestoreChatStore, on Firestore's AsyncClient."""
+
+    def __init__(self, store: FirestoreChatStore, async_db):
+        super().__init__(store)
+        self.db = async_db
+        # Reuses the document layout helpers, bound to the async client.
+        self.layout = FirestoreChatStore(async_db)
+
+    async def get_chat(self, user_id: str, session_id: str) -> dict:
+        doc = await self.layout.chat_doc_ref(user_id, session_id).get()
+        return (doc.to_dict() or {}) if doc.exists else {}
+
+    async def fetch_messages(self, user_id: str, session_id: str, start: int, end: int) -> list:
+        docs = (
+            self.layout.messages_collection(user_id, session_id)
+            .order_by("index")
+            .start_at({"index": start})
+            .limit(end - start)
+        )
+        return [doc.to_dict() or {} async for doc in docs.stream()]
+
+    async def append_messages(self, user_id: str, session_id: str, messages: list, chat_fields: dict):
+        batch = self.db.batch()
+        collection = self.layout.messages_collection(user_id, session_id)
+        for msg in messages:
+            batch.create(collection.document(message_doc_id(msg["index"])), msg)
+        batch.set(self.layout.chat_doc_ref(user_id, session_id), chat_fields, merge=True)
+        try:
+            await batch.commit()
+        except self.layout.conflict_error as e:
+            raise AppendConflict(str(e)) from e
+
+
+def create_async_chat_store(store: ChatStore, firestore_async_client_factory=None) -> AsyncChatStore:
+    if isinstance(store, FirestoreChatStore):
+        return AsyncFirestoreChatStore(store, firestore_async_client_factory())
+    return AsyncChatStore(store)
+
+
+CHAT_STORE_BACKENDS = ("firestore", "sqlite")
+
+
+def chat_store_backend(name: str) -> str:
+    """Normalised backend name (firestore when unset); ValueError for anything else, e.g. a typo."""
+    backend = (name or "firestore").strip().lower()
+    if backend not in CHAT_STORE_BACKENDS:
+        raise ValueError(
+            f"Unknown CHAT_STORE_BACKEND {name!r}; expected one of: {', '.join(CHAT_STORE_BACKENDS)}"
+        )
+    return backend
+
+
+def create_chat_store(backend: str, sqlite_path: str, firestore_client_factory=None, **firestore_options) -> ChatStore:
+    """
+    CHAT_STORE_BACKEND=firestore (default) or sqlite. The Firestore client is only
+    created (and credentials only required) when that backend is selected.
+    """
+    backend = chat_store_backend(backend)
+    if backend == "sqlite":
+        return SQLiteChatStore(sqlite_path)
+    return FirestoreChatStore(firestore_client_factory(), **firestore_options)
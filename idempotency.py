@@ -0,0 +1,166 @@
+"""
+Idempotency keys and in-flight coalescing for chat turns.
+
+A chat request is identified by its Idempotency-Key header or, without one, by
+a hash of (user, session, prompt, history length). The first request with a
+key runs the turn; duplicates that arrive while it is running attach to it and
+get the same answer (streamed requests receive its deltas as they are
+produced), and retries within the TTL get the stored result. Either way the
+model is called once and one turn is stored. Without a key a turn is known by
+the history it was sent against, so asking the same thing again once the
+answer has been stored is a new turn, not a replay.
+
+Only successful results are kept: when the running request fails its waiters
+get the same error, and the next retry runs the turn again. State is per
+process, so duplicates only coalesce when they reach the same worker.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+def request_fingerprint(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, default=str).encode("utf-8")).hexdigest()
+
+
+class IdempotencyMismatch(Exception):
+    """The Idempotency-Key was already used for a different request."""
+
+
+class Flight:
+    """
+    One run of a request. The running request publish()es stream deltas and
+    then calls finish() or fail(); duplicates wait on it.
+    """
+
+    def __init__(self, store, key, fingerprint: str):
+        self.store = store
+        self.key = key
+        self.fingerprint = fingerprint
+        self.chunks = []
+        self.payload = None
+        self.status = None
+        self.done = False
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self._cond = threading.Condition()
+
+    def publish(self, chunk: str):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    def relay(self, deltas):
+        """Pass a delta iterator through, publishing each delta; a stream that breaks or is closed fails the flight."""
+        try:
+            for delta in deltas:
+                self.publish(delta)
+                yield delta
+        except GeneratorExit:
+            # The client went away mid-answer; nothing was stored, so a retry runs again.
+            self.fail({"success": False, "error": "The original request was cancelled"}, 503)
+            raise
+        except Exception as e:
+            self.fail({"success": False, "error": "Stream interrupted", "detail": str(e)[:260]}, 500)
+            raise
+
+    async def relay_async(self, deltas):
+        """relay() for an async delta iterator."""
+        try:
+            async for delta in deltas:
+                self.publish(delta)
+                yield delta
+        except GeneratorExit:
+            self.fail({"success": False, "error": "The original request was cancelled"}, 503)
+            raise
+        except Exception as e:
+            self.fail({"success": False, "error": "Stream interrupted", "detail": str(e)[:260]}, 500)
+            raise
+
+    def finish(self, payload: dict, status: int = 200):
+        if self._settle(payload, status):
+            self.store._finished(self)
+
+    def fail(self, payload: dict, status: int):
+        if self._settle(payload, status):
+            self.store._forget(self)
+
+    def _settle(self, payload: dict, status: int) -> bool:
+        with self._cond:
+            if self.done:
+                return False
+            self.payload = payload
+            self.status = status
+            self.done = True
+            self.finished_at = time.monotonic()
+            self._cond.notify_all()
+            return True
+
+    def wait(self, timeout: float) -> bool:
+        """Block until the flight has a result; False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.done, timeout)
+
+    def chunks_after(self, seen: int, timeout: float):
+        """(new chunks, done) once there is something past `seen` or the flight has ended; blocks up to timeout."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.done or len(self.chunks) > seen, timeout)
+            return self.chunks[seen:], self.done
+
+
+class IdempotencyStore:
+    """
+    Flights by key: finished ones are kept for ttl_seconds, and a running one
+    older than stale_after_seconds is presumed lost (its worker died or never
+    settled it) and replaced by the next request.
+    """
+
+    def __init__(self, ttl_seconds: float = 600.0, max_entries: int = 10_000, stale_after_seconds: float = 300.0):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.stale_after_seconds = stale_after_seconds
+        self._flights = OrderedDict()
+        self._lock = threading.Lock()
+
+    def begin(self, key, fingerprint: str):
+        """
+        Return (flight, leader). leader=True means the caller must run the request
+        and settle the flight; otherwise the flight is running or already done.
+        """
+        now = time.monotonic()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and (
+                now - flight.finished_at > self.ttl_seconds
+                if flight.done
+                else now - flight.started_at > self.stale_after_seconds
+            ):
+                del self._flights[key]
+                flight = None
+            if flight is not None:
+                if flight.fingerprint != fingerprint:
+                    raise IdempotencyMismatch("Idempotency-Key was already used for a different request.")
+                self._flights.move_to_end(key)
+                return flight, False
+            flight = self._flights[key] = Flight(self, key, fingerprint)
+            while len(self._flights) > self.max_entries:
+                self._flights.popitem(last=False)
+            return flight, True
+
+    def _finished(self, flight: Flight):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                self._flights.move_to_end(flight.key)
+
+    def _forget(self, flight: Flight):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            running = sum(1 for flight in self._flights.values() if not flight.done)
+            return {"running": running, "stored": len(self._flights) - running}
@@ -0,0 +1,722 @@
+"""
+Single entry point for Groq chat completions.
+
+Every model call in the app goes through LLMGateway.complete(), which paces
+requests with per-(API key, model) token buckets for requests/minute and
+tokens/minute, bounds concurrency with a weighted fair queue across callers,
+applies a per-call timeout and retries transient failures with jittered backoff
+that honours Retry-After.
+"""
+
+import asyncio
+import hashlib
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+def retryable_errors() -> tuple:
+    # groq is imported on first use so importing the app stays cheap.
+    import groq
+
+    return (
+        groq.RateLimitError,
+        groq.APIConnectionError,
+        groq.APITimeoutError,
+        groq.InternalServerError,
+    )
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token plus per-message overhead)."""
+    return len(text or "") // 4 + 4
+
+
+def estimate_message_tokens(messages: list) -> int:
+    total = 0
+    for msg in messages or []:
+        content = msg.get("content")
+        if isinstance(content, list):
+            content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+        total += estimate_tokens(content if isinstance(content, str) else "")
+    return total
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a call cannot be admitted within the gateway's queue wait."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Refills `capacity` units per minute; debits may push the level below zero."""
+
+    def __init__(self, capacity: float):
+        self.capacity = float(capacity)
+        self.level = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.capacity / 60.0)
+        self.updated_at = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60.0 / self.capacity
+
+    def take(self, amount: float):
+        self.level -= amount
+
+
+class ModelLimiter:
+    """Requests-per-minute and tokens-per-minute buckets for one (API key, model)."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.lock = threading.Lock()
+
+    def try_acquire(self, tokens: int) -> float:
+        """Take one request and `tokens` if available now; otherwise return the seconds to wait."""
+        with self.lock:
+            now = time.monotonic()
+            wait = max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+            if wait <= 0:
+                self.requests.take(1)
+                self.tokens.take(min(tokens, self.tokens.capacity))
+            return wait
+
+    def acquire(self, tokens: int, max_wait: float):
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            if time.monotonic() + wait > deadline:
+                raise RateLimitExceeded("Rate limit reached: model request queue is full.", retry_after=wait)
+            time.sleep(min(wait, 1.0))
+
+    async def acquire_async(self, tokens: int, max_wait: float):
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            if time.monotonic() + wait > deadline:
+                raise RateLimitExceeded("Rate limit reached: model request queue is full.", retry_after=wait)
+            await asyncio.sleep(min(wait, 1.0))
+
+    def debit_tokens(self, tokens: int):
+        with self.lock:
+            self.tokens.take(tokens)
+
+
+class _Waiter:
+    __slots__ = ("key", "grant", "granted", "cancelled")
+
+    def __init__(self, key: str, grant):
+        self.key = key
+        self.grant = grant
+        self.granted = False
+        self.cancelled = False
+
+
+class FairQueue:
+    """
+    Concurrency slots handed out in weighted fair order (start-time fair queuing).
+    Each call is tagged max(virtual time, the key's previous tag) + 1/weight, and a
+    freed slot goes to the waiter with the smallest tag, so a key with many calls
+    queued waits behind other keys' new calls instead of in front of them. Each key
+    may have at most `max_waiting_per_key` calls queued; beyond that acquire()
+    fails at once with an estimated Retry-After.
+    """
+
+    def __init__(self, capacity: int, weights: dict = None, max_waiting_per_key: int = 32, max_keys: int = 10_000):
+        self.capacity = capacity
+        self.weights = weights or {}
+        self.max_waiting_per_key = max_waiting_per_key
+        self.max_keys = max_keys
+        self._free = capacity
+        self._heap = []
+        self._sequence = itertools.count()
+        self._tags = {}
+        self._waiting = {}
+        self._virtual_time = 0.0
+        self._hold_seconds = 1.0
+        self._lock = threading.Lock()
+
+    def weight(self, key: str) -> float:
+        return max(0.01, float(self.weights.get(key, self.weights.get("*", 1.0))))
+
+    def _tag(self, key: str) -> float:
+        start = max(self._virtual_time, self._tags.get(key, 0.0))
+        self._tags[key] = start + 1.0 / self.weight(key)
+        if len(self._tags) > self.max_keys:
+            # Keys whose tags the virtual clock has passed carry no backlog; forget them.
+            self._tags = {k: tag for k, tag in self._tags.items() if tag > self._virtual_time}
+        return start
+
+    def _estimated_wait(self) -> float:
+        queued = sum(self._waiting.values())
+        return max(1.0, (queued + 1) / max(1, self.capacity) * self._hold_seconds)
+
+    def _try_take(self, key: str):
+        """Under the lock: a slot now, or None after checking the key may queue (raises if not)."""
+        if self._free > 0 and not self._heap:
+            self._free -= 1
+            self._virtual_time = self._tag(key)
+            return _Lease(self)
+        if self._waiting.get(key, 0) >= self.max_waiting_per_key:
+            raise RateLimitExceeded("Rate limit reached: too many queued model calls.", self._estimated_wait())
+        return None
+
+    def _enqueue(self, key: str, grant) -> _Waiter:
+        waiter = _Waiter(key, grant)
+        heapq.heappush(self._heap, (self._tag(key), next(self._sequence), waiter))
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        return waiter
+
+    def _leave(self, waiter: _Waiter):
+        count = self._waiting.get(waiter.key, 1) - 1
+        if count > 0:
+            self._waiting[waiter.key] = count
+        else:
+            self._waiting.pop(waiter.key, None)
+
+    def _timed_out(self, waiter: _Waiter):
+        """Under the lock: give up waiting; returns a lease if the slot was granted meanwhile."""
+        if waiter.granted:
+            return _Lease(self)
+        waiter.cancelled = True
+        self._leave(waiter)
+        return None
+
+    def acquire(self, key: str, timeout: float):
+        """Block for a slot; returns a lease whose release() frees it."""
+        with self._lock:
+            lease = self._try_take(key)
+            if lease is not None:
+                return lease
+            event = threading.Event()
+            waiter = self._enqueue(key, event.set)
+        if event.wait(timeout):
+            return _Lease(self)
+        with self._lock:
+            lease = self._timed_out(waiter)
+            if lease is not None:
+                return lease
+            raise RateLimitExceeded("Rate limit reached: too many concurrent model calls.", self._estimated_wait())
+
+    async def acquire_async(self, key: str, timeout: float):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def grant():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        with self._lock:
+            lease = self._try_take(key)
+            if lease is not None:
+                return lease
+            waiter = self._enqueue(key, grant)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+            return _Lease(self)
+        except BaseException as e:
+            with self._lock:
+                lease = self._timed_out(waiter)
+                retry_after = self._estimated_wait()
+            timed_out = isinstance(e, asyncio.TimeoutError)
+            if lease is not None:
+                if timed_out:
+                    return lease
+                lease.release()
+            if timed_out:
+                raise RateLimitExceeded("Rate limit reached: too many concurrent model calls.", retry_after)
+            raise
+
+    def _release(self, held_seconds: float):
+        with self._lock:
+            self._hold_seconds = 0.8 * self._hold_seconds + 0.2 * held_seconds
+            while self._heap:
+                tag, _, waiter = heapq.heappop(self._heap)
+                if waiter.cancelled:
+                    continue
+                waiter.granted = True
+                self._leave(waiter)
+                self._virtual_time = tag
+                waiter.grant()
+                return
+            self._free += 1
+
+
+class _Lease:
+    """One held FairQueue slot; release() is idempotent."""
+
+    __slots__ = ("queue", "acquired_at", "released")
+
+    def __init__(self, queue: FairQueue):
+        self.queue = queue
+        self.acquired_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.queue._release(time.monotonic() - self.acquired_at)
+
+
+def parse_key_weights(raw: str) -> dict:
+    """Parse "user=weight,user2=weight" ("*" sets the default) into {key: weight}."""
+    weights = {}
+    for item in (raw or "").split(","):
+        if "=" not in item:
+            continue
+        key, weight = item.split("=", 1)
+        try:
+            weights[key.strip()] = float(weight)
+        except ValueError:
+            continue
+    return weights
+
+
+def parse_model_limits(raw: str) -> dict:
+    """Parse "model=rpm/tpm,model2=rpm/tpm" into {model: (rpm, tpm)}."""
+    limits = {}
+    for item in (raw or "").split(","):
+        if "=" not in item or "/" not in item:
+            continue
+        model, rates = item.split("=", 1)
+        rpm, tpm = rates.split("/", 1)
+        try:
+            limits[model.strip()] = (int(rpm), int(tpm))
+        except ValueError:
+            continue
+    return limits
+
+
+def retry_after_seconds(error) -> float:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    raw = headers.get("retry-after") or headers.get("Retry-After")
+    try:
+        return max(0.0, float(raw))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def stream_chunk_usage(chunk):
+    """Token usage carried by the final chunk of a Groq stream (x_groq.usage), if any."""
+    return getattr(chunk, "usage", None) or getattr(getattr(chunk, "x_groq", None), "usage", None)
+
+
+class CallObservation:
+    """
+    Timing of one gateway call for the optional observer callback, which is invoked
+    as observer(model, seconds, usage=None, error=None, queued=0.0, retry=False).
+    """
+
+    def __init__(self, observer, model: str, prompt_tokens: int):
+        self.observer = observer
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.entered_at = time.perf_counter()
+        self.started_at = self.entered_at
+
+    def attempt_started(self):
+        self.started_at = time.perf_counter()
+
+    def retry(self):
+        if self.observer:
+            self.observer(self.model, time.perf_counter() - self.started_at, retry=True)
+
+    def finished(self, usage=None, error=None, completion_chars: int = 0):
+        if not self.observer:
+            return
+        if usage is None and error is None and completion_chars:
+            usage = EstimatedUsage(self.prompt_tokens, completion_chars // 4)
+        now = time.perf_counter()
+        if error is not None:
+            self.observer(self.model, now - self.entered_at, error=error)
+            return
+        self.observer(self.model, now - self.started_at, usage=usage, queued=self.started_at - self.entered_at)
+
+
+class EstimatedUsage:
+    def __init__(self, prompt_tokens: int, completion_tokens: int):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+
+
+class LLMGateway:
+    def __init__(
+        self,
+        client,
+        api_key: str,
+        default_rpm: int = 30,
+        default_tpm: int = 12_000,
+        model_limits: dict = None,
+        max_concurrency: int = 8,
+        max_retries: int = 3,
+        timeout: float = 60.0,
+        max_queue_wait: float = 20.0,
+        backoff_base: float = 0.5,
+        backoff_cap: float = 8.0,
+        observer=None,
+        queue_key=None,
+        key_weights: dict = None,
+        max_queued_per_key: int = 32,
+    ):
+        self.client = client
+        self.key_id = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:12]
+        self.default_limits = (default_rpm, default_tpm)
+        self.model_limits = model_limits or {}
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.max_queue_wait = max_queue_wait
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.observer = observer
+        # queue_key() names the caller (e.g. the current user) for fair queuing.
+        self.queue_key = queue_key or (lambda: "default")
+        self.key_weights = key_weights or {}
+        self.max_queued_per_key = max_queued_per_key
+        self._slots = FairQueue(max_concurrency, self.key_weights, max_queued_per_key)
+        self._limiters = {}
+        self._limiters_lock = threading.Lock()
+
+    def limits(self, model: str) -> tuple:
+        """(requests per minute, tokens per minute) configured for `model`."""
+        return self.model_limits.get(model, self.default_limits)
+
+    def limiter(self, model: str) -> ModelLimiter:
+        key = (self.key_id, model)
+        with self._limiters_lock:
+            if key not in self._limiters:
+                self._limiters[key] = ModelLimiter(*self.limits(model))
+            return self._limiters[key]
+
+    def backoff(self, attempt: int, error) -> float:
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+        return max(delay, retry_after_seconds(error))
+
+    def complete(self, **kwargs):
+        """
+        Drop-in for client.chat.completions.create(**kwargs). Streaming calls keep
+        their concurrency slot until the returned iterator is exhausted or closed.
+        `queue_wait` (not passed on) overrides max_queue_wait for this call.
+        """
+        max_queue_wait = kwargs.pop("queue_wait", self.max_queue_wait)
+        kwargs.setdefault("timeout", self.timeout)
+        model = kwargs.get("model")
+        limiter = self.limiter(model)
+        prompt_tokens = estimate_message_tokens(kwargs.get("messages"))
+        observation = CallObservation(self.observer, model, prompt_tokens)
+
+        try:
+            slot = self._slots.acquire(self.queue_key(), max_queue_wait)
+        except RateLimitExceeded as error:
+            observation.finished(error=error)
+            raise
+        try:
+            attempt = 0
+            while True:
+                limiter.acquire(prompt_tokens, max_queue_wait)
+                observation.attempt_started()
+                try:
+                    response = self.client.chat.completions.create(**kwargs)
+                    break
+                except retryable_errors() as e:
+                    if attempt >= self.max_retries:
+                        raise
+                    observation.retry()
+                    delay = self.backoff(attempt, e)
+                    attempt += 1
+                    print(f"[LLM RETRY] {model} attempt {attempt} in {delay:.2f}s: {e}")
+                    time.sleep(delay)
+        except BaseException as e:
+            slot.release()
+            observation.finished(error=e)
+            raise
+
+        if kwargs.get("stream"):
+            return GuardedStream(response, slot, limiter, observation)
+        slot.release()
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            limiter.debit_tokens(getattr(usage, "completion_tokens", 0) or 0)
+        observation.finished(usage=usage)
+        return response
+
+
+class GuardedStream:
+    """Iterates a streaming completion and frees its gateway slot exactly once."""
+
+    def __init__(self, stream, slot, limiter: ModelLimiter, observation: CallObservation = None):
+        self._source = stream
+        self._stream = iter(stream)
+        self._slot = slot
+        self._limiter = limiter
+        self._observation = observation
+        self._completion_chars = 0
+        self._usage = None
+        self._released = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._stream)
+        except BaseException:
+            self.close()
+            raise
+        if chunk.choices:
+            self._completion_chars += len(chunk.choices[0].delta.content or "")
+        self._usage = stream_chunk_usage(chunk) or self._usage
+        return chunk
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        self._slot.release()
+        settle_stream(self._limiter, self._observation, self._usage, self._completion_chars)
+        close_stream = getattr(self._source, "close", None)
+        if close_stream:
+            close_stream()
+
+    def __del__(self):
+        self.close()
+
+
+def settle_stream(limiter: ModelLimiter, observation, usage, completion_chars: int):
+    """Debit a finished stream's completion tokens (reported, else estimated) and report it."""
+    if usage is not None:
+        limiter.debit_tokens(getattr(usage, "completion_tokens", 0) or 0)
+    else:
+        limiter.debit_tokens(completion_chars // 4)
+    if observation is not None:
+        observation.finished(usage=usage, completion_chars=completion_chars)
+
+
+class AsyncLLMGateway:
+    """
+    asyncio counterpart of LLMGateway for the ASGI path. It shares the sync gateway's
+    per-model limiters, observer and fair-queue settings, so both paths draw on one
+    requests/tokens budget; only the concurrency bound is separate.
+    """
+
+    def __init__(self, client, gateway: LLMGateway, max_concurrency: int = 256):
+        self.client = client
+        self.gateway = gateway
+        self._slots = FairQueue(max_concurrency, gateway.key_weights, gateway.max_queued_per_key)
+
+    async def complete(self, **kwargs):
+        """Drop-in for `await client.chat.completions.create(**kwargs)` on an AsyncGroq client."""
+        gateway = self.gateway
+        kwargs.setdefault("timeout", gateway.timeout)
+        model = kwargs.get("model")
+        limiter = gateway.limiter(model)
+        prompt_tokens = estimate_message_tokens(kwargs.get("messages"))
+        observation = CallObservation(gateway.observer, model, prompt_tokens)
+
+        try:
+            slot = await self._slots.acquire_async(gateway.queue_key(), gateway.max_queue_wait)
+        except RateLimitExceeded as error:
+            observation.finished(error=error)
+            raise
+        try:
+            attempt = 0
+            while True:
+                await limiter.acquire_async(prompt_tokens, gateway.max_queue_wait)
+                observation.attempt_started()
+                try:
+                    response = await self.client.chat.completions.create(**kwargs)
+                    break
+                except retryable_errors() as e:
+                    if attempt >= gateway.max_retries:
+                        raise
+                    observation.retry()
+                    delay = gateway.backoff(attempt, e)
+                    attempt += 1
+                    print(f"[LLM RETRY] {model} attempt {attempt} in {delay:.2f}s: {e}")
+                    await asyncio.sleep(delay)
+        except BaseException as e:
+            slot.release()
+            observation.finished(error=e)
+            raise
+
+        if kwargs.get("stream"):
+            return AsyncGuardedStream(response, slot, limiter, observation)
+        slot.release()
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            limiter.debit_tokens(getattr(usage, "completion_tokens", 0) or 0)
+        observation.finished(usage=usage)
+        return response
+
+
+class AsyncGuardedStream:
+    """Async iterator over a streaming completion that frees its gateway slot exactly once."""
+
+    def __init__(self, stream, slot, limiter: ModelLimiter, observation: CallObservation = None):
+        self._source = stream
+        self._stream = stream.__aiter__()
+        self._slot = slot
+        self._limiter = limiter
+        self._observation = observation
+        self._completion_chars = 0
+        self._usage = None
+        self._released = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await self._stream.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+        if chunk.choices:
+            self._completion_chars += len(chunk.choices[0].delta.content or "")
+        self._usage = stream_chunk_usage(chunk) or self._usage
+        return chunk
+
+    def _release(self) -> bool:
+        if self._released:
+            return False
+        self._released = True
+        self._slot.release()
+        settle_stream(self._limiter, self._observation, self._usage, self._completion_chars)
+        return True
+
+    async def aclose(self):
+        if self._release():
+            close_stream = getattr(self._source, "close", None)
+            if close_stream:
+                await close_stream()
+
+    def __del__(self):
+        # Can't await here; the HTTP response is closed when the stream is collected.
+        self._release()
+
+
+def is_permanent_model_error(error) -> bool:
+    """Errors that will not go away by retrying the same model (unknown or retired models)."""
+    import groq
+
+    if isinstance(error, groq.NotFoundError):
+        return True
+    message = str(error).lower()
+    return "model" in message and ("not found" in message or "decommissioned" in message)
+
+
+class ModelHealthTracker:
+    """
+    Per-model EWMA latency and success rate with a simple circuit breaker.
+    Used to order fallback models and to pick the hedging deadline.
+    """
+
+    def __init__(
+        self,
+        alpha: float = 0.3,
+        failure_threshold: int = 3,
+        cooldown_seconds: float = 60.0,
+        permanent_cooldown_seconds: float = 600.0,
+        hedge_percentile: float = 0.9,
+        default_hedge_delay: float = 6.0,
+        sample_size: int = 50,
+    ):
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.permanent_cooldown_seconds = permanent_cooldown_seconds
+        self.hedge_percentile = hedge_percentile
+        self.default_hedge_delay = default_hedge_delay
+        self.sample_size = sample_size
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _model_stats(self, model: str) -> dict:
+        if model not in self._stats:
+            self._stats[model] = {
+                "latency": None,
+                "success_rate": 1.0,
+                "consecutive_failures": 0,
+                "open_until": 0.0,
+                "samples": [],
+            }
+        return self._stats[model]
+
+    def record_success(self, model: str, latency: float):
+        with self._lock:
+            stats = self._model_stats(model)
+            previous = stats["latency"]
+            stats["latency"] = latency if previous is None else self.alpha * latency + (1 - self.alpha) * previous
+            stats["success_rate"] = self.alpha + (1 - self.alpha) * stats["success_rate"]
+            stats["consecutive_failures"] = 0
+            stats["open_until"] = 0.0
+            stats["samples"] = (stats["samples"] + [latency])[-self.sample_size:]
+
+    def record_failure(self, model: str, error=None):
+        with self._lock:
+            stats = self._model_stats(model)
+            stats["success_rate"] = (1 - self.alpha) * stats["success_rate"]
+            stats["consecutive_failures"] += 1
+            if error is not None and is_permanent_model_error(error):
+                stats["open_until"] = time.monotonic() + self.permanent_cooldown_seconds
+            elif stats["consecutive_failures"] >= self.failure_threshold:
+                stats["open_until"] = time.monotonic() + self.cooldown_seconds
+
+    def ordered(self, models: list) -> list:
+        """
+        Healthy models first, fastest expected (latency / success rate) first; models
+        never tried keep their configured position ahead of measured ones so they get
+        probed. Circuit-broken models are skipped unless nothing else is left.
+        """
+        now = time.monotonic()
+        with self._lock:
+            ranked = []
+            for position, model in enumerate(models):
+                stats = self._stats.get(model)
+                if stats is None:
+                    ranked.append((False, 0.0, position, model))
+                    continue
+                is_open = stats["open_until"] > now
+                if stats["latency"] is None:
+                    # Only failures so far: rank behind every model that has answered.
+                    score = float("inf") if stats["consecutive_failures"] else 0.0
+                else:
+                    score = stats["latency"] / max(stats["success_rate"], 0.05)
+                ranked.append((is_open, score, position, model))
+        ranked.sort()
+        available = [model for is_open, _, _, model in ranked if not is_open]
+        return available or [model for _, _, _, model in ranked]
+
+    def hedge_delay(self, model: str) -> float:
+        with self._lock:
+            samples = sorted(self._stats.get(model, {}).get("samples", []))
+        if len(samples) < 5:
+            return self.default_hedge_delay
+        return samples[min(len(samples) - 1, int(len(samples) * self.hedge_percentile))]
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                model: {
+                    "latency": stats["latency"],
+                    "success_rate": round(stats["success_rate"], 3),
+                    "circuit_open": stats["open_until"] > now,
+                }
+                for model, stats in self._stats.items()
+            }
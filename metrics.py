@@ -0,0 +1,256 @@
+"""
+Dependency-free request instrumentation.
+
+Code paths are timed with `with stage("name"):`. Each request collects its own
+stage timings (sent back as a Server-Timing header) and every observation also
+lands in Prometheus-style histograms and counters, exposed in the text format by
+render(). Recording is a perf_counter() pair, a bisect and one short lock, so it
+is cheap enough for the hot path.
+"""
+
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names: tuple, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last one is +Inf), sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = sorted((labels, (list(s[0]), s[1], s[2])) for labels, s in self._series.items())
+        for labels, (counts, total, count) in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                bucket_labels = _format_labels(self.label_names, labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {total:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, help_text: str, label_names: tuple) -> Counter:
+        metric = Counter(name, help_text, label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, label_names: tuple, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, label_names, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+REQUESTS = registry.counter(
+    "red_requests_total", "HTTP requests by endpoint and status.", ("endpoint", "method", "status")
+)
+REQUEST_SECONDS = registry.histogram("red_request_seconds", "Time to response headers.", ("endpoint",))
+STAGE_SECONDS = registry.histogram("red_stage_seconds", "Time spent per processing stage.", ("endpoint", "stage"))
+LLM_SECONDS = registry.histogram(
+    "red_llm_call_seconds", "Groq call duration (streams: until closed).", ("endpoint", "model")
+)
+LLM_QUEUE_SECONDS = registry.histogram(
+    "red_llm_queue_seconds", "Wait for a gateway slot and rate-limit budget.", ("endpoint", "model")
+)
+LLM_CALLS = registry.counter(
+    "red_llm_calls_total", "Groq calls by outcome (ok, retry, error).", ("endpoint", "model", "outcome")
+)
+LLM_TOKENS = registry.counter(
+    "red_llm_tokens_total",
+    "Tokens reported by Groq (estimated for streams without usage).",
+    ("endpoint", "model", "kind"),
+)
+
+ADMISSION_REJECTED = registry.counter(
+    "red_admission_rejected_total", "Requests turned away by per-user admission control.", ("endpoint", "reason")
+)
+
+VOICE_RESULTS = registry.counter(
+    "red_voice_results_total", "Voice transcripts by how they were processed (local, cache, model).", ("source",)
+)
+
+IDEMPOTENT_REPLAYS = registry.counter(
+    "red_idempotent_replays_total",
+    "Duplicate requests answered from another request (inflight) or its stored result (stored).",
+    ("endpoint", "kind"),
+)
+
+ROUTED_CALLS = registry.counter(
+    "red_routed_calls_total",
+    "Model calls by routed tier, the tier that finally served them and the routing reason.",
+    ("endpoint", "tier", "served_tier", "reason", "outcome"),
+)
+ROUTED_SECONDS = registry.histogram(
+    "red_routed_seconds", "Routed call time (to first token for streams) by serving tier.", ("endpoint", "served_tier")
+)
+
+
+class RequestTiming:
+    __slots__ = ("endpoint", "started", "stages")
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.stages = []
+
+
+_current_timing = contextvars.ContextVar("red_request_timing", default=None)
+
+
+def start_request(endpoint: str) -> RequestTiming:
+    timing = RequestTiming(endpoint)
+    _current_timing.set(timing)
+    return timing
+
+
+def finish_request(method: str, status: int) -> RequestTiming:
+    """Record the request total; returns its timing (None outside a request)."""
+    timing = _current_timing.get()
+    if timing is None:
+        return None
+    REQUEST_SECONDS.observe((timing.endpoint,), time.perf_counter() - timing.started)
+    REQUESTS.inc((timing.endpoint, method, str(status)))
+    return timing
+
+
+def current_endpoint() -> str:
+    timing = _current_timing.get()
+    return timing.endpoint if timing is not None else "background"
+
+
+def record_stage(name: str, seconds: float):
+    timing = _current_timing.get()
+    if timing is not None:
+        timing.stages.append((name, seconds))
+    STAGE_SECONDS.observe((timing.endpoint if timing is not None else "background", name), seconds)
+
+
+@contextmanager
+def stage(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+def record_llm_call(model: str, seconds: float, usage=None, error=None, queued: float = 0.0, retry: bool = False):
+    """Observer for LLMGateway: one call (or one retried attempt when retry=True)."""
+    endpoint = current_endpoint()
+    labels = (endpoint, model or "unknown")
+    if retry:
+        LLM_CALLS.inc(labels + ("retry",))
+        return
+    LLM_CALLS.inc(labels + ("error" if error is not None else "ok",))
+    LLM_SECONDS.observe(labels, seconds)
+    if queued:
+        LLM_QUEUE_SECONDS.observe(labels, queued)
+    record_stage("llm", seconds)
+    if usage is not None:
+        LLM_TOKENS.inc(labels + ("prompt",), getattr(usage, "prompt_tokens", 0) or 0)
+        LLM_TOKENS.inc(labels + ("completion",), getattr(usage, "completion_tokens", 0) or 0)
+
+
+def record_admission_rejection(reason: str):
+    ADMISSION_REJECTED.inc((current_endpoint(), reason))
+
+
+def record_route(decision, served_tier: str, model: str, seconds: float, error=None):
+    """Observer for ModelRouter: one routed call, after any escalation."""
+    endpoint = current_endpoint()
+    outcome = "error" if error is not None else "ok"
+    ROUTED_CALLS.inc((endpoint, decision.tier, served_tier, decision.reason, outcome))
+    if error is None:
+        ROUTED_SECONDS.observe((endpoint, served_tier), seconds)
+
+
+def record_voice_result(source: str):
+    VOICE_RESULTS.inc((source,))
+
+
+def record_idempotent_replay(kind: str):
+    IDEMPOTENT_REPLAYS.inc((current_endpoint(), kind))
+
+
+def bind_context(fn):
+    """Wrap fn so it runs in (a copy of) the caller's context, e.g. on a thread pool."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+def server_timing_header(timing: RequestTiming) -> str:
+    """Server-Timing value: stages summed by name in first-seen order, plus the total."""
+    totals = {}
+    for name, seconds in list(timing.stages):
+        totals[name] = totals.get(name, 0.0) + seconds
+    totals["total"] = time.perf_counter() - timing.started
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in totals.items())
+
+
+def render() -> str:
+    return registry.render()
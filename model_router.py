@@ -0,0 +1,176 @@
+"""
+Complexity-based model routing.
+
+classify() puts a request into a tier from cheap features of the request
+itself: prompt length, how much history goes with it, whether an attachment is
+involved and keywords that signal code or multi-step reasoning. Each tier is an
+ordered list of models, cheapest tier first. A call that fails (or comes back
+empty) on every model of its tier is escalated to the next tier, so a wrong
+guess costs latency, never an answer.
+
+Every routed call is reported to an observer (tier chosen, tier that served
+it, reason, seconds to the result or first token) and summarised by
+snapshot(), so the thresholds can be tuned from real traffic.
+"""
+
+import re
+import threading
+import time
+
+from llm_gateway import estimate_tokens
+
+# Phrases that usually mean a long or multi-step answer.
+STRONG_KEYWORDS = re.compile(
+    r"\b(explain why|step[- ]by[- ]step|prove|proof|derive|analy[sz]e|analysis|compare|contrast|debug|"
+    r"refactor|implement|algorithm|optimi[sz]e|architecture|design a|essay|in detail|detailed|in depth|"
+    r"pros and cons|trade-?offs?|calculate|solve|equation|evaluate|critique|review my|translate)\b",
+    re.IGNORECASE,
+)
+CODE_MARKERS = re.compile(r"```|\bdef |\bclass |\bimport |#include|=>|\bfunction\s*\(|\bSELECT .+ FROM\b|</?\w+>")
+
+
+def parse_model_tiers(raw: str) -> dict:
+    """Parse "fast=llama-3.1-8b-instant;strong=llama-3.3-70b-versatile,other" into {tier: [models]}."""
+    tiers = {}
+    for item in (raw or "").split(";"):
+        name, _, models = item.partition("=")
+        models = [model.strip() for model in models.split(",") if model.strip()]
+        if name.strip() and models:
+            tiers[name.strip()] = models
+    return tiers
+
+
+class RouteDecision:
+    __slots__ = ("tier", "reason")
+
+    def __init__(self, tier: str, reason: str):
+        self.tier = tier
+        self.reason = reason
+
+    def __repr__(self):
+        return f"RouteDecision({self.tier!r}, {self.reason!r})"
+
+
+class ModelRouter:
+    """
+    `tiers` maps tier name to models, in escalation order (cheapest first).
+    With enabled=False every request goes to the last (strongest) tier.
+    """
+
+    def __init__(self, tiers: dict, fast_max_prompt_tokens: int = 150, fast_max_history: int = 12,
+                 enabled: bool = True, observer=None, alpha: float = 0.2):
+        if not tiers:
+            raise ValueError("ModelRouter needs at least one tier")
+        self.tiers = dict(tiers)
+        self.tier_names = list(self.tiers)
+        self.fast_max_prompt_tokens = fast_max_prompt_tokens
+        self.fast_max_history = fast_max_history
+        self.enabled = enabled
+        self.observer = observer
+        self.alpha = alpha
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @property
+    def cheapest(self) -> str:
+        return self.tier_names[0]
+
+    @property
+    def strongest(self) -> str:
+        return self.tier_names[-1]
+
+    def classify(self, prompt: str, history_messages: int = 0, attachment: bool = False) -> RouteDecision:
+        if not self.enabled:
+            return RouteDecision(self.strongest, "disabled")
+        if attachment:
+            return RouteDecision(self.strongest, "attachment")
+        if CODE_MARKERS.search(prompt):
+            return RouteDecision(self.strongest, "code")
+        if STRONG_KEYWORDS.search(prompt):
+            return RouteDecision(self.strongest, "keyword")
+        if estimate_tokens(prompt) > self.fast_max_prompt_tokens:
+            return RouteDecision(self.strongest, "long_prompt")
+        if history_messages > self.fast_max_history:
+            return RouteDecision(self.strongest, "deep_history")
+        return RouteDecision(self.cheapest, "simple")
+
+    def for_task(self, task: str) -> RouteDecision:
+        """Fixed, low-stakes jobs (titles) always start on the cheapest tier."""
+        return RouteDecision(self.cheapest if self.enabled else self.strongest, task)
+
+    def plan(self, decision: RouteDecision) -> list:
+        """(tier, model) pairs to try: the decided tier, then every stronger one."""
+        start = self.tier_names.index(decision.tier) if decision.tier in self.tiers else len(self.tier_names) - 1
+        return [(tier, model) for tier in self.tier_names[start:] for model in self.tiers[tier]]
+
+    def call(self, decision: RouteDecision, invoke):
+        """
+        Return invoke(model) for the first model in the plan that answers with a
+        non-empty result; raise the last error if none does. invoke should return
+        the answer itself (text, or a stream that is None when empty) rather than
+        a response object, which is truthy even when it carries no text.
+        """
+        started = time.monotonic()
+        plan = self.plan(decision)
+        result, error = None, None
+        for position, (tier, model) in enumerate(plan):
+            try:
+                result, error = invoke(model), None
+            except Exception as e:
+                result, error = None, e
+                print(f"[ROUTER] {model} ({tier}) failed: {e}")
+            if result or position == len(plan) - 1:
+                break
+            print(f"[ROUTER] escalating {decision.reason} request past {model}")
+        self._finished(decision, tier, model, time.monotonic() - started, error)
+        if error is not None:
+            raise error
+        return result
+
+    async def call_async(self, decision: RouteDecision, invoke):
+        """call() for coroutines: invoke(model) returns an awaitable."""
+        started = time.monotonic()
+        plan = self.plan(decision)
+        result, error = None, None
+        for position, (tier, model) in enumerate(plan):
+            try:
+                result, error = await invoke(model), None
+            except Exception as e:
+                result, error = None, e
+                print(f"[ROUTER] {model} ({tier}) failed: {e}")
+            if result or position == len(plan) - 1:
+                break
+            print(f"[ROUTER] escalating {decision.reason} request past {model}")
+        self._finished(decision, tier, model, time.monotonic() - started, error)
+        if error is not None:
+            raise error
+        return result
+
+    def _finished(self, decision: RouteDecision, tier: str, model: str, seconds: float, error):
+        with self._lock:
+            stats = self._stats.setdefault(
+                tier, {"calls": 0, "errors": 0, "escalated_in": 0, "latency": None, "reasons": {}}
+            )
+            stats["calls"] += 1
+            stats["errors"] += 1 if error is not None else 0
+            stats["escalated_in"] += 1 if tier != decision.tier else 0
+            stats["reasons"][decision.reason] = stats["reasons"].get(decision.reason, 0) + 1
+            if error is None:
+                previous = stats["latency"]
+                stats["latency"] = seconds if previous is None else self.alpha * seconds + (1 - self.alpha) * previous
+        if self.observer is not None:
+            try:
+                self.observer(decision, tier, model, seconds, error)
+            except Exception as e:
+                print(f"[ROUTER] observer failed: {e}")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            tiers = {}
+            for tier in self.tier_names:
+                stats = dict(self._stats.get(tier) or {})
+                if stats:
+                    stats["reasons"] = dict(stats["reasons"])
+                    stats["latency"] = round(stats["latency"], 3) if stats["latency"] is not None else None
+                tiers[tier] = {"models": self.tiers[tier], **stats}
+        return {"enabled": self.enabled, "tiers": tiers}
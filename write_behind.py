@@ -0,0 +1,473 @@
+"""
+Write-behind persistence for chat turns.
+
+WriteBehindChatStore wraps another ChatStore. append_messages() appends the turn
+to a local journal, fsyncs it and returns, so the reply is not held up by the
+store round trip. A flusher thread then folds everything queued for a session
+into one turn and writes those with the wrapped store's append_turns(). Reads
+overlay what is still queued, so /api/chat/history and the next prompt see a
+turn as soon as append_messages() has returned.
+
+The queue and that overlay are per process. Another worker reads only what has
+been flushed, so until then it sees the chat without this worker's queued turn
+and may store its own turn at the same indexes. The store rejects the second
+write of an index; when a flush hits that, the queued messages are renumbered to
+follow what the store holds and written there, so both turns are kept.
+
+The journal is JSON lines in a per-process file under `journal_dir`:
+
+    {"seq": 1, "op": "turn", "user_id": ..., "session_id": ..., "messages": [...], "chat_fields": {...}}
+    {"seq": 2, "op": "update", "user_id": ..., "session_id": ..., "fields": {...}}
+    {"op": "done", "seqs": [1, 2]}
+    {"op": "drop", "user_id": ..., "session_id": ...}
+
+Each process holds an flock on its own file. At startup, journals whose lock is
+free were left by a process that died; their unfinished records are checked
+against the store (a turn may have been written just before the crash), copied
+into this process's journal and the old file removed. The journal must live on
+a disk that survives a restart of the process.
+"""
+
+import glob
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, so one process per journal directory.
+    fcntl = None
+
+from chat_store import AppendConflict, ChatStore
+
+
+class WriteConflict(AppendConflict):
+    """A turn was queued for message indexes that are already taken."""
+
+
+class _PendingChat:
+    """Everything queued for one session, folded into a single turn."""
+
+    __slots__ = ("seqs", "messages", "fields", "version", "attempts", "next_attempt_at", "queued_at")
+
+    def __init__(self):
+        self.seqs = []
+        self.messages = []
+        self.fields = {}
+        self.version = 0
+        self.attempts = 0
+        self.next_attempt_at = 0.0
+        self.queued_at = time.monotonic()
+
+    @property
+    def end(self) -> int:
+        return self.messages[-1]["index"] + 1 if self.messages else None
+
+
+def rebase_messages(messages: list, fields: dict, stored_count: int):
+    """Renumber queued messages (and their chat fields) to follow the `stored_count` messages in the store."""
+    offset = stored_count - messages[0]["index"]
+    fields = {**fields, "message_count": stored_count + len(messages)}
+    if messages[0]["index"] == 0:
+        # Another writer created the chat, so its title and creation time stand.
+        for name in ("title", "title_pending", "created_at"):
+            fields.pop(name, None)
+    return [{**msg, "index": msg["index"] + offset} for msg in messages], fields
+
+
+def same_messages(stored: list, queued: list) -> bool:
+    return [(m.get("index"), m.get("role"), m.get("content")) for m in stored] == [
+        (m.get("index"), m.get("role"), m.get("content")) for m in queued
+    ]
+
+
+class WriteBehindChatStore(ChatStore):
+    def __init__(self, store: ChatStore, journal_dir: str, flush_interval: float = 0.5,
+                 max_batch_turns: int = 200, max_attempts: int = 8):
+        self.store = store
+        self.journal_dir = journal_dir
+        self.flush_interval = flush_interval
+        self.max_batch_turns = max_batch_turns
+        self.max_attempts = max_attempts
+        self._pending = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+        # Held while a flush writes to the store, so delete/clear can't race a write.
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.flushed_turns = 0
+        self.dropped_turns = 0
+
+        os.makedirs(journal_dir, exist_ok=True)
+        self.journal_path = os.path.join(journal_dir, f"journal-{os.getpid()}-{time.time_ns()}.jsonl")
+        self._fd = os.open(self.journal_path, os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0o600)
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._sync_directory()
+        self.replay()
+
+        self._flusher = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._flusher.start()
+
+    # ----- journal -----
+
+    def _sync_directory(self):
+        if hasattr(os, "O_DIRECTORY"):
+            fd = os.open(self.journal_dir, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _journal(self, records: list, sync: bool = True):
+        """Append records to the journal (caller holds _lock); fsync unless told otherwise."""
+        data = "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+        os.write(self._fd, data.encode("utf-8"))
+        if sync:
+            os.fsync(self._fd)
+
+    def _next_seq(self) -> int:
+        self._seq += 1
+        return self._seq
+
+    def replay(self):
+        """Take over journals left by processes that are gone and queue their unfinished turns."""
+        for path in sorted(glob.glob(os.path.join(self.journal_dir, "journal-*.jsonl"))):
+            if path == self.journal_path:
+                continue
+            fd = os.open(path, os.O_RDWR)
+            try:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue  # still owned by a live process
+                chats = self._read_journal(path)
+                replayed = 0
+                for (user_id, session_id), pending in chats.items():
+                    fields = pending.fields
+                    stored_count, messages = self._reconcile(user_id, session_id, pending.messages)
+                    if messages is None:
+                        messages, fields = rebase_messages(pending.messages, fields, stored_count)
+                    queued = self._pending.get((user_id, session_id))
+                    if queued is not None and queued.end is not None:
+                        # Already taken over from another journal (a crash during an earlier replay).
+                        messages = [msg for msg in messages if msg["index"] >= queued.end]
+                    if messages:
+                        try:
+                            self.append_messages(user_id, session_id, messages, fields)
+                            replayed += 1
+                        except WriteConflict as e:
+                            print(f"[WRITE BEHIND] {e}")
+                    elif fields and self.store.update_chat(user_id, session_id, fields) is False:
+                        print(f"[WRITE BEHIND] replayed update for missing chat {session_id} skipped")
+                print(f"[WRITE BEHIND] replayed {replayed} queued chat(s) from {os.path.basename(path)}")
+                os.unlink(path)
+            finally:
+                os.close(fd)
+
+    @staticmethod
+    def _read_journal(path: str) -> dict:
+        records = []
+        with open(path, "r", encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A torn last line from a crash mid-write; its turn was never acknowledged.
+                    break
+        done = {seq for record in records if record.get("op") == "done" for seq in record.get("seqs") or []}
+        chats = {}
+        for record in records:
+            op = record.get("op")
+            key = (record.get("user_id"), record.get("session_id"))
+            if op == "drop":
+                chats.pop(key, None)
+            elif op in {"turn", "update"} and record.get("seq") not in done:
+                pending = chats.setdefault(key, _PendingChat())
+                pending.messages.extend(record.get("messages") or [])
+                pending.fields.update(record.get("chat_fields") or record.get("fields") or {})
+        return chats
+
+    def _reconcile(self, user_id: str, session_id: str, messages: list):
+        """
+        Drop queued messages the store already holds (written before an ack was
+        recorded). Returns (stored message_count, the rest), the rest being None
+        if another writer stored different messages at those indexes.
+        """
+        if not messages:
+            return None, messages
+        stored_count = int(self.store.get_chat(user_id, session_id).get("message_count") or 0)
+        first = messages[0]["index"]
+        if stored_count <= first:
+            return stored_count, messages
+        stored = self.store.fetch_messages(user_id, session_id, first, min(stored_count, messages[-1]["index"] + 1))
+        written = [msg for msg in messages if msg["index"] < stored_count]
+        if not same_messages(stored, written):
+            print(f"[WRITE BEHIND] {session_id}: store has other messages at {first}+, moving queued turn after them")
+            return stored_count, None
+        return stored_count, [msg for msg in messages if msg["index"] >= stored_count]
+
+    # ----- writes -----
+
+    def _queue(self, user_id: str, session_id: str, messages: list, chat_fields: dict) -> dict:
+        """Fold one turn into the session's pending entry; returns its journal record (caller holds _lock)."""
+        key = (user_id, session_id)
+        pending = self._pending.get(key)
+        if pending is not None and messages and pending.end is not None and messages[0]["index"] != pending.end:
+            raise WriteConflict(f"Chat {session_id} already has a turn queued at index {messages[0]['index']}")
+        if pending is None:
+            pending = self._pending[key] = _PendingChat()
+        seq = self._next_seq()
+        pending.seqs.append(seq)
+        pending.messages.extend(messages)
+        pending.fields.update(chat_fields)
+        pending.version += 1
+        return {
+            "seq": seq,
+            "op": "turn",
+            "user_id": user_id,
+            "session_id": session_id,
+            "messages": messages,
+            "chat_fields": chat_fields,
+        }
+
+    def append_messages(self, user_id: str, session_id: str, messages: list, chat_fields: dict):
+        with self._lock:
+            self._journal([self._queue(user_id, session_id, messages, chat_fields)])
+
+    def append_turns(self, turns: list) -> list:
+        # One journal write and one fsync for the lot.
+        failed, records = [], []
+        with self._lock:
+            for turn in turns:
+                try:
+                    records.append(self._queue(*turn))
+                except WriteConflict as e:
+                    print(f"[WRITE BEHIND] {e}")
+                    failed.append(turn)
+            if records:
+                self._journal(records)
+        return failed
+
+    def update_chat(self, user_id: str, session_id: str, fields: dict) -> bool:
+        with self._lock:
+            pending = self._pending.get((user_id, session_id))
+            if pending is not None:
+                # The chat may not exist in the store yet; ride along with the queued turn.
+                seq = self._next_seq()
+                pending.seqs.append(seq)
+                pending.fields.update(fields)
+                pending.version += 1
+                record = {"seq": seq, "op": "update", "user_id": user_id, "session_id": session_id, "fields": fields}
+                self._journal([record])
+                return True
+        return self.store.update_chat(user_id, session_id, fields)
+
+    def _drop(self, keys: list):
+        """Forget queued writes for chats that are being deleted (caller holds both locks)."""
+        records = []
+        for key in keys:
+            if self._pending.pop(key, None) is not None:
+                records.append({"op": "drop", "user_id": key[0], "session_id": key[1]})
+        if records:
+            self._journal(records)
+
+    def delete_chat(self, user_id: str, session_id: str):
+        with self._flush_lock, self._lock:
+            self._drop([(user_id, session_id)])
+        return self.store.delete_chat(user_id, session_id)
+
+    def iter_clear(self, user_id: str, page_size: int):
+        with self._flush_lock, self._lock:
+            self._drop([key for key in self._pending if key[0] == user_id])
+        yield from self.store.iter_clear(user_id, page_size)
+
+    # ----- reads -----
+
+    def _overlay(self, key, chat: dict) -> dict:
+        with self._lock:
+            pending = self._pending.get(key)
+            fields = dict(pending.fields) if pending is not None else None
+        return {**chat, **fields} if fields else chat
+
+    def get_chat(self, user_id: str, session_id: str) -> dict:
+        return self._overlay((user_id, session_id), self.store.get_chat(user_id, session_id))
+
+    def get_chats(self, user_id: str, session_ids: list) -> dict:
+        chats = self.store.get_chats(user_id, session_ids)
+        return {session_id: self._overlay((user_id, session_id), chat) for session_id, chat in chats.items()}
+
+    def fetch_messages(self, user_id: str, session_id: str, start: int, end: int) -> list:
+        with self._lock:
+            pending = self._pending.get((user_id, session_id))
+            queued = list(pending.messages) if pending is not None else []
+        if not queued:
+            return self.store.fetch_messages(user_id, session_id, start, end)
+        # Queued messages win for their indexes, even if a flush has just stored them too.
+        first = queued[0]["index"]
+        stored = self.store.fetch_messages(user_id, session_id, start, min(end, first)) if start < first else []
+        return stored + [msg for msg in queued if start <= msg["index"] < end]
+
+    def list_chats(self, user_id: str, fields: list, limit: int, after=None) -> list:
+        # The sidebar is ordered by the store, so the user's queued chats go out first.
+        self.flush(user_id)
+        return self.store.list_chats(user_id, fields, limit, after)
+
+    def migrate_legacy_chat(self, user_id: str, session_id: str, chat: dict) -> dict:
+        return self.store.migrate_legacy_chat(user_id, session_id, chat)
+
+    def iter_legacy_chats(self):
+        return self.store.iter_legacy_chats()
+
+    # ----- flushing -----
+
+    def _run(self):
+        # Turns queued within one interval are written together.
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[WRITE BEHIND] flush failed: {e}")
+
+    def flush(self, user_id: str = None) -> int:
+        """Write queued turns (only `user_id`'s when given) to the store; returns how many were stored."""
+        stored = 0
+        with self._flush_lock:
+            while True:
+                now = time.monotonic()
+                with self._lock:
+                    due = [
+                        (key, pending.version, list(pending.seqs), list(pending.messages), dict(pending.fields))
+                        for key, pending in self._pending.items()
+                        if (user_id is None or key[0] == user_id) and pending.next_attempt_at <= now
+                    ][:self.max_batch_turns]
+                if not due:
+                    return stored
+                turns = [(key[0], key[1], messages, fields) for key, _version, _seqs, messages, fields in due]
+                try:
+                    failed = self.store.append_turns(turns)
+                except Exception as e:
+                    print(f"[WRITE BEHIND] append_turns failed: {e}")
+                    failed = turns
+                failed_keys = {(turn[0], turn[1]) for turn in failed}
+                written = [entry for entry in due if entry[0] not in failed_keys]
+                retry = [entry for entry in due if entry[0] in failed_keys]
+                rebased = False
+                # A failed turn may have been stored after all (lost reply), or conflict for good.
+                for entry in retry:
+                    key, _version, _seqs, messages, _fields = entry
+                    try:
+                        stored_count, remaining = self._reconcile(key[0], key[1], messages)
+                    except Exception:
+                        remaining = messages
+                    if remaining == [] and messages:
+                        written.append(entry)
+                    elif remaining is None:
+                        rebased = self._rebase(key, stored_count) or rebased
+                    else:
+                        self._retry_later(entry, stored=len(messages) - len(remaining))
+                self._finish(written)
+                stored += len(written)
+                # Renumbered turns go straight back in, so close() writes them too.
+                if len(due) < self.max_batch_turns and not rebased:
+                    return stored
+
+    def _finish(self, written: list):
+        with self._lock:
+            seqs = []
+            for key, version, flushed_seqs, messages, _fields in written:
+                seqs.extend(flushed_seqs)
+                pending = self._pending.get(key)
+                if pending is None:
+                    continue
+                if pending.version == version:
+                    del self._pending[key]
+                else:
+                    # More arrived during the write: keep only that.
+                    pending.seqs = pending.seqs[len(flushed_seqs):]
+                    pending.messages = pending.messages[len(messages):]
+                    pending.attempts = 0
+                    pending.queued_at = time.monotonic()
+            self.flushed_turns += len(written)
+            if seqs:
+                # Not fsynced: a lost ack only means a replay finds the turn already stored.
+                self._journal([{"op": "done", "seqs": seqs}], sync=False)
+            if not self._pending:
+                os.ftruncate(self._fd, 0)
+
+    def _rebase(self, key, stored_count: int):
+        """
+        Move everything queued for a chat to follow the store's `stored_count`
+        messages; True if it can be retried at once. The journal gets the
+        renumbered turn in place of the old records, so a replay writes it where it
+        now belongs.
+        """
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None or not pending.messages:
+                return False
+            pending.messages, pending.fields = rebase_messages(pending.messages, pending.fields, stored_count)
+            seq = self._next_seq()
+            pending.seqs = [seq]
+            pending.version += 1
+            pending.attempts += 1
+            self._journal([
+                {"op": "drop", "user_id": key[0], "session_id": key[1]},
+                {
+                    "seq": seq,
+                    "op": "turn",
+                    "user_id": key[0],
+                    "session_id": key[1],
+                    "messages": pending.messages,
+                    "chat_fields": pending.fields,
+                },
+            ])
+            if pending.attempts < self.max_attempts:
+                pending.next_attempt_at = 0.0
+                return True
+            # Losing the race this often means a busy chat; back off rather than spin.
+            pending.next_attempt_at = time.monotonic() + min(30.0, 0.5 * 2 ** pending.attempts)
+            return False
+
+    def _retry_later(self, entry, stored: int = 0):
+        """Back off before the next attempt; `stored` leading messages turned out to be written already."""
+        key, _version, seqs, _messages, _fields = entry
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None:
+                return
+            pending.messages = pending.messages[stored:]
+            pending.attempts += 1
+            if pending.attempts >= self.max_attempts:
+                print(f"[WRITE BEHIND] giving up on {len(seqs)} queued write(s) for chat {key[1]}")
+                del self._pending[key]
+                self.dropped_turns += len(seqs)
+                self._journal([{"op": "drop", "user_id": key[0], "session_id": key[1]}])
+                return
+            pending.next_attempt_at = time.monotonic() + min(30.0, 0.5 * 2 ** pending.attempts)
+
+    def close(self):
+        """Stop the flusher and write out whatever is still queued."""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._flusher.join(timeout=5)
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"[WRITE BEHIND] final flush failed: {e}")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            oldest = min((pending.queued_at for pending in self._pending.values()), default=None)
+            return {
+                "queued_chats": len(self._pending),
+                "queued_messages": sum(len(pending.messages) for pending in self._pending.values()),
+                "oldest_queued_seconds": round(now - oldest, 2) if oldest is not None else None,
+                "retrying": sum(1 for pending in self._pending.values() if pending.attempts),
+                "flushed_turns": self.flushed_turns,
+                "dropped_turns": self.dropped_turns,
+            }